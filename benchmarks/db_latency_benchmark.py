@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+'''
+Stress benchmark: download concurrency with a slow database
+
+A local http server (in a thread) serves category pages with 50 article links each.
+The spider checks every category page against an artificially slow database, either
+- blocking: the query runs on the reactor thread (old behaviour of parse_category)
+- async:    the query runs in utils.db_pool, the callback awaits the deferred
+
+and the benchmark samples how many downloads are in flight.
+
+The slow database is simulated by a sleep of --db-latency seconds per query, or with
+--mongo-uri by a $where-sleep query against a local mongod.
+
+Run from the repository root:
+
+    python -m benchmarks.db_latency_benchmark --db-latency 0.2
+'''
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+
+import scrapy
+from scrapy import signals
+from scrapy.crawler import CrawlerRunner
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.reactor import install_reactor
+
+# scrapy's default reactor has to be installed before twisted.internet.reactor is imported
+install_reactor('twisted.internet.asyncioreactor.AsyncioSelectorReactor')
+from twisted.internet import defer, reactor, task
+
+from inews_crawler.db_pool import DbThreadPool
+
+ARTICLES_PER_PAGE = 50
+PAGE_DELAY = 0.05   # latency of the simulated news site
+
+
+class NewsSiteHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        time.sleep(PAGE_DELAY)
+        if self.path.startswith('/cat/'):
+            page = int(self.path.split('/')[2])
+            links = ''.join('<a class="teaser" href="/art/{}-{}">x</a>'.format(page, i)
+                            for i in range(ARTICLES_PER_PAGE))
+            body = '<html><body>{}</body></html>'.format(links)
+        else:
+            body = '<html><body><p>article</p></body></html>'
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SlowDb(object):
+
+    def __init__(self, latency, mongo_uri=None):
+        self.latency = latency
+        self.collection = None
+        if mongo_uri:
+            import pymongo
+            self.collection = pymongo.MongoClient(mongo_uri)['inews_benchmark']['db_latency_benchmark']
+            self.collection.update_one({'_id': 1}, {'$set': {'short_url': 'x'}}, upsert=True)
+
+    def filter_unseen(self, urls):
+        if self.collection is not None:
+            self.collection.find_one({'$where': 'sleep({}) || true'.format(int(self.latency * 1000))})
+        else:
+            time.sleep(self.latency)
+        return urls
+
+
+class BenchmarkSpider(scrapy.Spider):
+    name = 'db_latency_benchmark'
+    custom_settings = {
+        'CONCURRENT_REQUESTS': 16,
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 16,
+        'LOG_LEVEL': 'WARNING',
+        'ROBOTSTXT_OBEY': False,
+        'ITEM_PIPELINES': {},
+        'REQUEST_FINGERPRINTER_IMPLEMENTATION': '2.7',
+    }
+
+    def __init__(self, base_url, pages, mode, db, pool, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url
+        self.pages = pages
+        self.mode = mode
+        self.db = db
+        self.pool = pool
+
+    def start_requests(self):
+        for page in range(self.pages):
+            yield scrapy.Request('{}/cat/{}'.format(self.base_url, page), callback=self.parse_category)
+
+    async def parse_category(self, response):
+        links = response.css('a.teaser::attr(href)').getall()
+        if self.mode == 'async':
+            unseen = await maybe_deferred_to_future(self.pool.run(self.db.filter_unseen, links))
+        else:
+            unseen = self.db.filter_unseen(links)
+        for link in unseen[:5]:
+            yield response.follow(link, callback=self.parse_article)
+
+    def parse_article(self, response):
+        pass
+
+
+@defer.inlineCallbacks
+def run(args, base_url):
+    db = SlowDb(args.db_latency, args.mongo_uri)
+    pool = DbThreadPool(args.threads)
+    results = {}
+    for mode in ('blocking', 'async'):
+        runner = CrawlerRunner()
+        crawler = runner.create_crawler(BenchmarkSpider)
+        samples = []
+
+        def sample(crawler=crawler):
+            samples.append(len(crawler.engine.downloader.active))
+
+        sampler = task.LoopingCall(sample)
+
+        def start_sampling(sampler=sampler):
+            sampler.start(0.02)
+
+        crawler.signals.connect(start_sampling, signal=signals.spider_opened, weak=False)
+        start = time.perf_counter()
+        yield runner.crawl(crawler, base_url=base_url, pages=args.pages, mode=mode, db=db, pool=pool)
+        elapsed = time.perf_counter() - start
+        sampler.stop()
+        results[mode] = (elapsed, crawler.stats.get_value('downloader/response_count', 0),
+                         sum(samples) / max(len(samples), 1))
+    pool.stop()
+
+    print("db latency {:.0f} ms, {} category pages, {} db threads".format(
+        args.db_latency * 1000, args.pages, args.threads))
+    for mode, (elapsed, responses, active) in results.items():
+        print("{:9s} {:6.2f}s  {:6.1f} responses/s  {:5.1f} downloads in flight (of 16)".format(
+            mode, elapsed, responses / elapsed, active))
+    reactor.stop()
+
+
+def report_error(failure):
+    failure.printTraceback()
+    reactor.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-latency', type=float, default=0.2, help='seconds per db-query')
+    parser.add_argument('--pages', type=int, default=40, help='number of category pages')
+    parser.add_argument('--threads', type=int, default=4, help='size of the db thread pool')
+    parser.add_argument('--mongo-uri', help='use a $where-sleep query against this mongod')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), NewsSiteHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    reactor.callWhenRunning(lambda: run(args, base_url).addErrback(report_error))
+    reactor.run()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+'''
+Microbenchmark: field extraction of the article pages of the fixture corpus
+
+Compares the previous extraction (one get_item_* call per field as in utils at the baseline, every
+css/xpath expression translated and compiled again by parsel on every call) with the extraction spec of the spider,
+whose expressions are compiled once into lxml XPath objects and evaluated together by Spec.extract.
+Both variants start from a parsed HtmlResponse. The fields of both variants are compared before timing
+(lists as sets, the previous get_item_list did not keep the order).
+
+Run from the repository root:
+
+    python -m benchmarks.extraction_benchmark --repeat 500
+'''
+import argparse
+import json
+import os
+import time
+
+from scrapy.http import HtmlResponse
+
+from inews_crawler.spiders import heise_spider, postillon_spider, sueddeutsche_spider, taz_spider
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+SPECS = {
+    'heise': heise_spider.article_spec,
+    'taz': taz_spider.article_spec,
+    'sz': sueddeutsche_spider.article_spec,
+    'postillon': postillon_spider.ARTICLE_SPEC,
+}
+
+
+def load_article_pages():
+    # parse_article pages of corpus.json: news site -> HtmlResponse
+    with open(os.path.join(FIXTURES, 'corpus.json')) as f:
+        corpus = json.load(f)
+    pages = {}
+    for name in SPECS:
+        for page in corpus[name]['pages']:
+            if page['callback'] == 'parse_article':
+                with open(os.path.join(FIXTURES, page['fixture']), 'rb') as f:
+                    pages[name] = HtmlResponse(url=page['url'], body=f.read(), encoding='utf-8')
+                break
+    return pages
+
+
+# previous implementation: the get_item_* methods of utils at the baseline, unchanged except for the logging
+
+def get_item_string(response, sel, expr_list):
+    for expr in expr_list:
+        if sel=="css":
+            property = response.css(expr).get()
+        elif sel=="xpath":
+            property = response.xpath(expr).get()
+        else:
+            property = ""
+        if property is not None and len(property.strip()) > 0:
+            return property.strip()
+    return ""
+
+
+def get_item_list(response, sel, expr_list):
+    for expr in expr_list:
+        if sel=="css":
+            property = response.css(expr).extract()
+        elif sel=="xpath":
+            property = response.xpath(expr).extract()
+        else:
+            property = []
+        if property is not None:
+            return list(set(property))
+    return []
+
+
+def get_item_list_from_str(response, sel, expr_list, split_str):
+    for expr in expr_list:
+        if sel=="css":
+            property = response.css(expr).get()
+        elif sel=="xpath":
+            property = response.xpath(expr).get()
+        else:
+            property = ""
+        if property is not None:
+            return property.split(split_str)
+    return []
+
+
+def extract_before(spec, response):
+    # one call per field and selector type, the spiders passed either xpath or css expressions
+    values = {}
+    for f, _ in spec.fields:
+        sel = f.expressions[0][0]
+        expr_list = [expression for _, expression in f.expressions]
+        if f.kind == 'string':
+            value = get_item_string(response, sel, expr_list)
+        elif f.kind == 'split':
+            value = get_item_list_from_str(response, sel, expr_list, f.split)
+        else:
+            value = get_item_list(response, sel, expr_list)
+        values[f.name] = f.post(value) if f.post is not None else value
+    return values
+
+
+def extract_after(spec, response):
+    return spec.extract(response)[0]
+
+
+def comparable(values):
+    return dict((name, sorted(value) if isinstance(value, list) else value) for name, value in values.items())
+
+
+def measure(function, spec, response, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(spec, response)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=500, help='extractions per page and variant')
+    args = parser.parse_args()
+
+    pages = load_article_pages()
+    print("{:10s} {:>7s} {:>12s} {:>12s} {:>8s}".format('site', 'fields', 'before', 'after', 'speedup'))
+    for name, spec in SPECS.items():
+        response = pages[name]
+        if comparable(extract_before(spec, response)) != comparable(extract_after(spec, response)):
+            print("{:10s} output differs".format(name))
+            continue
+        time_before = measure(extract_before, spec, response, args.repeat)
+        time_after = measure(extract_after, spec, response, args.repeat)
+        fields = len(spec.fields)
+        print("{:10s} {:7d} {:>8.0f} f/s {:>8.0f} f/s {:7.1f}x".format(name, fields, fields / time_before,
+                                                                    fields / time_after, time_before / time_after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+'''
+Memory benchmark: peak RSS of scraped articles in flight
+
+Parses the article pages of the fixture corpus with the spiders (as benchmarks.spider_benchmark does)
+and builds --articles items from them, which are all kept in memory like the items in flight of an archive
+build. Every item gets its own copies of the extracted strings (as if every article had been downloaded
+and parsed), strings shared by the spider item (e.g. intro = description of golem and postillon) stay shared.
+Compares the previous scrapy.Item with the compacting ArticleItem, every variant runs in its own process
+and reports the growth of its peak RSS per 10k articles. The article text is most of an item, with
+--without-text the items are built without it to show the overhead of the item and of the other fields.
+
+Run from the repository root:
+
+    python -m benchmarks.item_memory_benchmark --articles 50000
+    python -m benchmarks.item_memory_benchmark --articles 50000 --without-text
+'''
+import argparse
+import gc
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+import scrapy
+
+from benchmarks import spider_benchmark
+from inews_crawler.items import ArticleItem
+
+VARIANTS = ('before', 'after')
+
+
+# previous implementation of ArticleItem
+
+class ArticleItemBefore(scrapy.Item):
+    crawl_time = scrapy.Field()
+    short_url = scrapy.Field()
+    long_url = scrapy.Field()
+    news_site = scrapy.Field()
+    title = scrapy.Field()
+    authors = scrapy.Field()
+    description = scrapy.Field()
+    intro = scrapy.Field()
+    text = scrapy.Field()
+    keywords = scrapy.Field()
+    published_time = scrapy.Field()
+    image_links = scrapy.Field()
+    links = scrapy.Field()
+    content_hash = scrapy.Field()
+    cluster_id = scrapy.Field()
+    near_duplicate = scrapy.Field()
+
+
+def template_items():
+    # one item per news site, parsed from the parse_article fixture of the corpus
+    logging.disable(logging.WARNING)
+    with open(os.path.join(spider_benchmark.FIXTURES, 'corpus.json')) as f:
+        corpus = json.load(f)
+    spider_benchmark.stub_database(corpus)
+    items = []
+    with tempfile.TemporaryDirectory() as state_dir:
+        for name, definition in corpus.items():
+            pages = [page for page in definition['pages'] if page['callback'] == 'parse_article']
+            if not pages:
+                continue
+            spider = spider_benchmark.load_spider(definition['spider'], state_dir)
+            try:
+                output = spider_benchmark.replay(spider, spider_benchmark.load_pages(pages)[0])
+            except Exception as e:
+                print("{:10s} skipped: {}".format(name, e), file=sys.stderr)
+                continue
+            items.extend(dict(obj) for obj in output if isinstance(obj, ArticleItem))
+    return items
+
+
+def copy_value(value, copies):
+    # a new object with the same value, objects shared in the template stay shared in the copy
+    if id(value) in copies:
+        return copies[id(value)]
+    if isinstance(value, str):
+        copy = value.encode('utf-8').decode('utf-8')
+    elif isinstance(value, list):
+        copy = [copy_value(v, copies) for v in value]
+    else:
+        copy = value
+    copies[id(value)] = copy
+    return copy
+
+
+def build_items(item_class, templates, count):
+    items = []
+    for i in range(count):
+        item = item_class()
+        copies = {}
+        for key, value in templates[i % len(templates)].items():
+            item[key] = copy_value(value, copies)
+        items.append(item)
+    return items
+
+
+def run_variant(variant, count, without_text):
+    templates = template_items()
+    if without_text:
+        for template in templates:
+            template.pop('text', None)
+    gc.collect()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    items = build_items(ArticleItem if variant == 'after' else ArticleItemBefore, templates, count)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'items': len(items), 'sites': len(templates), 'growth_kib': peak - baseline}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--articles', type=int, default=50000, help='articles in flight')
+    parser.add_argument('--without-text', action='store_true', help='build the items without the article text')
+    parser.add_argument('--variant', choices=VARIANTS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.variant:
+        run_variant(args.variant, args.articles, args.without_text)
+        return
+
+    results = {}
+    for variant in VARIANTS:
+        command = [sys.executable, '-m', 'benchmarks.item_memory_benchmark', '--variant', variant,
+                   '--articles', str(args.articles)] + (['--without-text'] if args.without_text else [])
+        output = subprocess.run(command, capture_output=True, text=True, check=True)
+        results[variant] = json.loads(output.stdout.splitlines()[-1])
+    print("{:d} articles of {:d} news sites in flight".format(args.articles, results['after']['sites']))
+    for variant in VARIANTS:
+        print("{:8s} peak RSS +{:7.1f} MiB, {:6.1f} MiB per 10k articles".format(
+            variant, results[variant]['growth_kib'] / 1024,
+            results[variant]['growth_kib'] / 1024 / args.articles * 10000))
+    print("saved: {:.0%}".format(1 - results['after']['growth_kib'] / results['before']['growth_kib']))
+
+
+if __name__ == '__main__':
+    main()
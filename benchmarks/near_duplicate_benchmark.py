@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+'''
+Benchmark: near-duplicate check per article against a large index
+
+Writes an index file with --articles unrelated articles (random signatures, as written by the
+compaction of a real index), opens it memory-mapped and checks --queries generated articles of
+--words words against it, like NearDuplicatePipeline.process_item: every second article is an
+edited copy (--edits of the words replaced) of an article checked before. Reports the time of the
+signature (depends on the length of the text) and of the index lookup (depends on the size of the index)
+per article, the recall of the copies and the false positives.
+
+Run from the repository root:
+
+    python -m benchmarks.near_duplicate_benchmark --articles 1000000
+'''
+import argparse
+import os
+import random
+import resource
+import tempfile
+import time
+from array import array
+
+from inews_crawler import near_duplicates
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def article_texts(count, words, edits, seed=1):
+    # (url, text, url of the original or None), words of a zipf-like vocabulary as in news texts
+    rng = random.Random(seed)
+    vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyzäöüß') for _ in range(rng.randint(2, 12)))
+                  for _ in range(50000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    originals = []
+    for i in range(count):
+        if i % 2 == 0 or not originals:
+            text = rng.choices(vocabulary, weights, k=words)
+            originals.append(('https://example.com/%d' % i, text))
+            yield originals[-1][0], ' '.join(text), None
+        else:
+            url, text = rng.choice(originals)
+            text = list(text)
+            for _ in range(int(words * edits)):
+                text[rng.randrange(words)] = rng.choice(vocabulary)
+            yield 'https://example.com/%d' % i, ' '.join(text), url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--articles', type=int, default=1000000, help='articles in the index file')
+    parser.add_argument('--queries', type=int, default=2000, help='checked articles')
+    parser.add_argument('--words', type=int, default=700, help='words per checked article')
+    parser.add_argument('--edits', type=float, default=0.01, help='share of replaced words in the copies')
+    parser.add_argument('--threshold', type=float, default=0.8)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='near_duplicate_benchmark')
+    path = os.path.join(directory, 'near_duplicates.index')
+    size, bands = 64, 16
+
+    start = time.perf_counter()
+    url_hashes = array('q')
+    url_hashes.frombytes(os.urandom(8 * args.articles))
+    near_duplicates.write_index(path, size, bands, url_hashes, url_hashes, os.urandom(size * args.articles))
+    write_time = time.perf_counter() - start
+    start = time.perf_counter()
+    index = near_duplicates.NearDuplicateIndex.open(path, size, bands)
+    open_time = time.perf_counter() - start
+    print("index: {:d} articles, {:.0f} MiB, written in {:.1f}s, opened in {:.1f}ms".format(
+        len(index), os.path.getsize(path) / 1024 / 1024, write_time, open_time * 1000))
+
+    queries = list(article_texts(args.queries, args.words, args.edits))
+    signature_times, lookup_times = [], []
+    found = copies = false_positives = 0
+    clusters = {}
+    for url, text, original in queries:
+        start = time.perf_counter()
+        signature = near_duplicates.signature(text, size)
+        signature_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        index.query(signature, near_duplicates.url_hash(url))
+        lookup_times.append(time.perf_counter() - start)
+        # the check of the pipeline: signature, lookup and adding the article
+        cluster_id, similarity = index.check(text, url, args.threshold)
+        clusters[url] = cluster_id
+        if original is None:
+            false_positives += similarity is not None
+        else:
+            copies += 1
+            found += similarity is not None and cluster_id == clusters[original]
+
+    check_times = [a + b for a, b in zip(signature_times, lookup_times)]
+    for name, times in (('signature', signature_times), ('lookup', lookup_times), ('check', check_times)):
+        print("{:10s} mean {:7.1f}us  p50 {:7.1f}us  p99 {:7.1f}us".format(
+            name, sum(times) / len(times) * 1e6, percentile(times, 50) * 1e6, percentile(times, 99) * 1e6))
+    print("copies found: {:d}/{:d}, false positives: {:d}/{:d}".format(found, copies, false_positives,
+                                                                       len(queries) - copies))
+
+    start = time.perf_counter()
+    index.save()
+    print("save of {:d} new articles: {:.1f}ms".format(len(queries), (time.perf_counter() - start) * 1000))
+    index.close()
+    print("peak RSS: {:.0f} MiB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
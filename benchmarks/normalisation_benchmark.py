@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+'''
+Microbenchmark: normalisation of long article texts
+
+Compares the throughput of the previous utils.remove_whitespace (split/join and seven chained
+str.replace passes) with normalise on long articles, built from the text fragments of the golem and SZ
+fixture pages as the spiders join them, and of normalise per paragraph with normalise_batch.
+The expected outputs of normalise and normalise_batch are checked by tests/test_normalisation.py.
+
+Run from the repository root:
+
+    python -m benchmarks.normalisation_benchmark --repeat 200
+'''
+import argparse
+import os
+import time
+
+from scrapy.http import HtmlResponse
+
+from inews_crawler.normalisation import normalise, normalise_batch
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# previous implementation of utils.remove_whitespace
+
+def remove_whitespace_before(string):
+    return ' '.join(string.split()) \
+        .replace(' ,', ',') \
+        .replace(' .', '.') \
+        .replace(' :', ':') \
+        .replace(' !', '!') \
+        .replace(' ?', '?') \
+        .replace(' ;', ',') \
+        .replace(' %', '%')
+
+
+def fixture_fragments():
+    # text fragments of the article pages, selected like the golem and SZ spiders do
+    def load(name, url):
+        with open(os.path.join(FIXTURES, name), 'rb') as f:
+            return HtmlResponse(url=url, body=f.read(), encoding='utf-8')
+    sz = load('sz_article.html', 'https://www.sueddeutsche.de/article')
+    golem = load('golem_article.html', 'https://www.golem.de/article')
+    return {
+        'sz': sz.xpath('//*[@itemprop="articleBody"]').css(
+            'p.css-13wylk3::text, p.css-13wylk3 h3::text, p.css-13wylk3 b::text, p.css-13wylk3 a::text, '
+            'p.css-13wylk3 i::text').extract(),
+        'golem': golem.xpath('//*[@id="screen"]/div[2]/article/div[1]').css(
+            'p::text, p a::text, h3::text, i::text').extract(),
+    }
+
+
+def long_article(fragments, characters):
+    # repeat the fragments up to the length, with German quotes and the spacing of the extracted text nodes
+    quoted = [fragment.replace(' ', ' „', 1).replace('.', '“ .', 1) if i % 5 == 0 else fragment
+              for i, fragment in enumerate(fragments)]
+    parts, length = [], 0
+    while length < characters:
+        fragment = quoted[len(parts) % len(quoted)]
+        parts.append(fragment)
+        length += len(fragment) + 1
+    return parts
+
+
+def measure(function, argument, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(argument)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=200, help='normalisations per article and variant')
+    parser.add_argument('--characters', type=int, default=100000, help='length of the long articles')
+    args = parser.parse_args()
+
+    print("{:8s} {:>9s} {:>12s} {:>12s} {:>8s}".format('site', 'chars', 'before', 'after', 'speedup'))
+    for name, fragments in fixture_fragments().items():
+        for characters in (2000, args.characters):
+            text = ' '.join(long_article(fragments, characters))
+            time_before = measure(remove_whitespace_before, text, args.repeat)
+            time_after = measure(normalise, text, args.repeat)
+            print("{:8s} {:9d} {:>7.1f} MB/s {:>7.1f} MB/s {:7.2f}x".format(
+                name, len(text), len(text) / time_before / 1e6, len(text) / time_after / 1e6,
+                time_before / time_after))
+
+    print("\n{:8s} {:>9s} {:>12s} {:>12s} {:>8s}".format('site', 'texts', 'per text', 'batch', 'speedup'))
+    for name, fragments in fixture_fragments().items():
+        texts = long_article(fragments, args.characters)
+        time_single = measure(lambda texts: [normalise(text) for text in texts], texts, args.repeat)
+        time_batch = measure(normalise_batch, texts, args.repeat)
+        print("{:8s} {:9d} {:>7.1f} MB/s {:>7.1f} MB/s {:7.2f}x".format(
+            name, len(texts), args.characters / time_single / 1e6, args.characters / time_batch / 1e6,
+            time_single / time_batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+'''
+Offline parse benchmark of all spiders
+
+Replays the stored pages of benchmarks/fixtures (listed in corpus.json) as HtmlResponses
+(TextResponses/XmlResponses for .json/.xml feeds) through the callbacks of each spider (parse, parse_category,
+parse_article, ...) and reports pages/s, latency percentiles per callback and the peak memory
+of the callbacks per spider.
+No network and no database are used: every news site gets an empty url index (all links
+are new), log events are written to a collection that discards them and the crawl state to
+a temporary file.
+
+The "expect" entries of the corpus (number of requests and items, title and non-empty fields
+of the item) are checked by tests/test_spiders.py, pages whose callback raises are not timed.
+
+Run from the repository root:
+
+    python -m benchmarks.spider_benchmark --repeat 50
+    python -m benchmarks.spider_benchmark --spider taz --spider heise
+'''
+import argparse
+import importlib
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+from scrapy.http import HtmlResponse, TextResponse, XmlResponse
+from scrapy.settings import Settings
+
+from inews_crawler import utils as utils_module
+from inews_crawler.event_log import EventLogger
+from inews_crawler.url_index import UrlIndex
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+# module level limits of the spiders, set to zero so the expectations do not depend on testrun settings
+LIMIT_SETTINGS = ('testrun_cats', 'testrun_arts')
+RESPONSE_CLASSES = {'.json': TextResponse, '.xml': XmlResponse}
+
+
+class NullCollection(object):
+    '''
+    Stand-in for a pymongo collection, finds nothing and discards all writes
+    '''
+
+    def find(self, *args, **kwargs):
+        return []
+
+    def find_one(self, *args, **kwargs):
+        return None
+
+    def insert_many(self, documents, **kwargs):
+        pass
+
+    def bulk_write(self, requests, **kwargs):
+        pass
+
+
+class NullDatabase(object):
+
+    def __getitem__(self, name):
+        return NullCollection()
+
+
+class NullConnection(object):
+    db = NullDatabase()
+    users = 1
+
+
+def stub_database(news_sites):
+    utils_module.connection = NullConnection()
+    utils_module.event_logger = EventLogger(NullCollection(), flush_interval=0)
+    for news_site in news_sites:
+        utils_module.url_indexes[news_site] = UrlIndex(news_site)
+
+
+def load_spider(path, state_dir):
+    module_name, class_name = path.rsplit('.', 1)
+    module = importlib.import_module(module_name)
+    for name in LIMIT_SETTINGS:
+        if hasattr(module, name):
+            setattr(module, name, 0)
+    spider = getattr(module, class_name)()
+    spider.settings = Settings({'CRAWL_STATE_PATH': os.path.join(state_dir, spider.name + '.json')})
+    return spider
+
+
+def load_pages(pages):
+    for page in pages:
+        response_class = RESPONSE_CLASSES.get(os.path.splitext(page['fixture'])[1], HtmlResponse)
+        with open(os.path.join(FIXTURES, page['fixture']), 'rb') as f:
+            page['response'] = response_class(url=page['url'], body=f.read(), encoding='utf-8')
+    return pages
+
+
+def drain(result):
+    '''
+    Collect the output of a callback: a generator, an async generator or None
+
+    The deferreds awaited by the async callbacks fire immediately, because the url index answers
+    without a database, so the async generator is stepped without a reactor.
+    '''
+    if result is None:
+        return []
+    if not hasattr(result, '__aiter__'):
+        return list(result)
+    output = []
+    while True:
+        step = result.__anext__()
+        try:
+            step.send(None)
+        except StopIteration as e:
+            output.append(e.value)
+            continue
+        except StopAsyncIteration:
+            return output
+        step.close()
+        raise RuntimeError('callback awaited a deferred that did not fire')
+
+
+def replay(spider, page):
+    callback = getattr(spider, page['callback'])
+    return drain(callback(page['response'], **page.get('cb_kwargs', {})))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def benchmark_spider(name, definition, repeat):
+    '''
+    Replay the pages of one spider
+
+    Returns
+    -------
+    (list of messages of the pages that were not timed, dict of results) for the report
+    '''
+    spider = load_spider(definition['spider'], tempfile.mkdtemp(prefix='inews-benchmark-'))
+    pages = load_pages(definition['pages'])
+    skipped = []
+    for page in list(pages):
+        try:
+            replay(spider, page)
+        except Exception as e:
+            pages.remove(page)
+            skipped.append('{} {} ({}): {}: {}'.format(name, page['callback'], page['fixture'], type(e).__name__, e))
+
+    latencies = dict((page['callback'], []) for page in pages)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for page in pages:
+            page_start = time.perf_counter()
+            replay(spider, page)
+            latencies[page['callback']].append(time.perf_counter() - page_start)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    for page in pages:
+        replay(spider, page)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return skipped, dict(pages_per_second=len(pages) * repeat / elapsed if pages else 0.0, peak=peak,
+                          latencies=latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=50, help='replays of every page')
+    parser.add_argument('--spider', action='append', help='only this spider (news site key of corpus.json)')
+    parser.add_argument('--corpus', default=os.path.join(FIXTURES, 'corpus.json'), help='corpus definition')
+    parser.add_argument('--verbose', action='store_true', help='show the log messages of the spiders')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    with open(args.corpus) as f:
+        corpus = json.load(f)
+    names = args.spider or list(corpus)
+    stub_database(names)
+
+    skipped = []
+    print("{:10s} {:15s} {:>9s} {:>9s} {:>9s} {:>9s} {:>10s}".format(
+        'spider', 'callback', 'pages/s', 'p50 ms', 'p90 ms', 'p99 ms', 'peak KiB'))
+    for name in names:
+        try:
+            spider_skipped, results = benchmark_spider(name, corpus[name], args.repeat)
+        except ImportError as e:
+            print("{:10s} skipped: {}".format(name, e))
+            continue
+        skipped += spider_skipped
+        print("{:10s} {:15s} {:9.1f} {:>9s} {:>9s} {:>9s} {:10.0f}".format(
+            name, 'all', results['pages_per_second'], '', '', '', results['peak'] / 1024))
+        for callback, values in results['latencies'].items():
+            print("{:10s} {:15s} {:9.1f} {:9.2f} {:9.2f} {:9.2f}".format(
+                '', callback, 1 / (sum(values) / len(values)), percentile(values, 50) * 1000,
+                percentile(values, 90) * 1000, percentile(values, 99) * 1000))
+
+    for message in skipped:
+        print("not timed:", message)
+
+
+if __name__ == '__main__':
+    main()
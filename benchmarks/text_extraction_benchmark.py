@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+'''
+Microbenchmark: article text extraction per fixture page
+
+Compares the previous extraction (serialise every paragraph with .extract() and parse it
+again with Selector(text=...)) with utils.extract_text, which reads the text nodes from the
+already parsed tree. Both variants start from a parsed HtmlResponse, the parse of the page
+itself is not measured. The texts of both variants are compared before timing.
+
+Run from the repository root:
+
+    python -m benchmarks.text_extraction_benchmark --repeat 200
+'''
+import argparse
+import os
+import time
+
+from scrapy import Selector
+from scrapy.http import HtmlResponse
+
+from inews_crawler.utils import utils
+from inews_crawler.spiders import heise_spider
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_fixture(name, url):
+    with open(os.path.join(FIXTURES, name), 'rb') as f:
+        return HtmlResponse(url=url, body=f.read(), encoding='utf-8')
+
+
+def join_paragraphs(paragraphs):
+    article_text = ""
+    for paragraph in paragraphs:
+        if paragraph:
+            article_text += paragraph + "\n\n"
+    return article_text.strip()
+
+
+# previous implementations, copied from the spiders
+
+def heise_before(response):
+    art_parags = []
+    tags = response.css(".article-content").xpath('p|a|h3').extract()
+    for tag in tags:
+        lines = ""
+        sel = Selector(text=tag)
+        for line in sel.xpath('//*/text()').extract():
+            lines += line
+        art_parags.append(lines)
+    return join_paragraphs(art_parags)
+
+
+def taz_before(response):
+    article_paragraphs = []
+    for tag in response.xpath('//article/*').extract():
+        line = ""
+        if "p xmlns=\"\" class=\"article" in tag or tag[2] == "6":
+            tag_selector = Selector(text=tag)
+            for text in tag_selector.xpath('//*/text()').extract():
+                line += text
+            article_paragraphs.append(line)
+    return join_paragraphs(article_paragraphs)
+
+
+def postillon_before(response):
+    article_paragraphs = []
+    for tag in response.xpath('//div[@class="post hentry"]//p|a|b').extract():
+        line = ""
+        tag_selector = Selector(text=tag)
+        for text_part in tag_selector.xpath('//text()').extract():
+            line += text_part
+        article_paragraphs.append(line)
+    return join_paragraphs(article_paragraphs)
+
+
+def heise_teasers_before(response):
+    articles = response.css(".stage--top article").extract() \
+               + response.xpath('//div[@class="article-index"]/article').extract()
+    teasers = []
+    for article in articles:
+        article_html = Selector(text=article)
+        if "heiseplus" not in article:
+            teasers.append((article_html.xpath('//a/@href').get(),
+                            article_html.xpath('//p[@class="a-article-teaser__synopsis "]/text()').get()))
+    return teasers
+
+
+# current implementations, as used by the spiders
+
+def heise_after(response):
+    return utils.extract_text(response.css(".article-content").xpath('*'), heise_spider.text_tags)
+
+
+def taz_after(response):
+    def is_text_block(element):
+        return element.tag == 'h6' or \
+               (element.get('xmlns') == '' and element.get('class', '').startswith('article'))
+    return utils.extract_text(response.xpath('//article/*'), ('p', 'h6'), is_text_block)
+
+
+def postillon_after(response):
+    return utils.extract_text(response.xpath('//div[@class="post hentry"]//p|a|b'))
+
+
+def heise_teasers_after(response):
+    articles = response.css(".stage--top article") + response.xpath('//div[@class="article-index"]/article')
+    teasers = []
+    for article in articles:
+        if not article.xpath(heise_spider.paywall_xpath):
+            teasers.append((article.xpath('.//a/@href').get(),
+                            article.xpath('.//p[@class="a-article-teaser__synopsis "]/text()').get()))
+    return teasers
+
+
+CASES = [
+    ('heise article', 'heise_article.html', 'https://www.heise.de/news/x-4999999.html', heise_before, heise_after),
+    ('taz article', 'taz_article.html', 'https://taz.de/!5999999/', taz_before, taz_after),
+    ('postillon article', 'postillon_article.html', 'https://www.der-postillon.com/2021/01/x.html',
+     postillon_before, postillon_after),
+    ('heise teasers', 'heise_category.html', 'https://www.heise.de/security/', heise_teasers_before,
+     heise_teasers_after),
+]
+
+
+def measure(function, response, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function(response)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=200, help='extractions per page and variant')
+    args = parser.parse_args()
+
+    print("{:18s} {:>10s} {:>10s} {:>8s}".format('page', 'before', 'after', 'speedup'))
+    for name, fixture, url, before, after in CASES:
+        response = load_fixture(fixture, url)
+        if before(response) != after(response):
+            print("{:18s} output differs".format(name))
+            continue
+        time_before = measure(before, response, args.repeat)
+        time_after = measure(after, response, args.repeat)
+        print("{:18s} {:8.3f}ms {:8.3f}ms {:7.1f}x".format(name, time_before * 1000, time_after * 1000,
+                                                          time_before / time_after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+'''
+Benchmark: per-link is_url_in_db queries vs. the in-memory UrlIndex
+
+Seeds a collection of a local mongod with fake short_urls and compares
+- one find_one per candidate link (old behaviour of parse_category)
+- loading the UrlIndex once + filter_unseen per category page
+
+Run from the repository root:
+
+    python -m benchmarks.url_index_benchmark --urls 1000000 --mongo-uri mongodb://localhost:27017
+'''
+import argparse
+import random
+import time
+
+import pymongo
+
+from inews_crawler.url_index import UrlIndex
+
+NEWS_SITE = 'heise'
+PAGE_SIZE = 50
+
+
+def make_url(i):
+    return 'https://www.heise.de/-{}'.format(4000000 + i)
+
+
+def seed(collection, number_of_urls, batch_size=10000):
+    collection.drop()
+    for start in range(0, number_of_urls, batch_size):
+        collection.insert_many([{"short_url": make_url(i), "news_site": NEWS_SITE}
+                                for i in range(start, min(start + batch_size, number_of_urls))], ordered=False)
+    collection.create_index("short_url", unique=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mongo-uri', default='mongodb://localhost:27017')
+    parser.add_argument('--database', default='inews_benchmark')
+    parser.add_argument('--urls', type=int, default=1000000, help='number of urls to seed')
+    parser.add_argument('--pages', type=int, default=400, help='number of category pages to check')
+    parser.add_argument('--no-seed', action='store_true', help='reuse an already seeded collection')
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(args.mongo_uri)
+    collection = client[args.database]['url_index_benchmark']
+
+    if not args.no_seed:
+        start = time.perf_counter()
+        seed(collection, args.urls)
+        print("seeded {} urls in {:.1f}s".format(args.urls, time.perf_counter() - start))
+
+    # category pages: mostly known articles, a few new ones
+    random.seed(0)
+    pages = [[make_url(random.randrange(args.urls + args.urls // 10)) for _ in range(PAGE_SIZE)]
+             for _ in range(args.pages)]
+    number_of_links = args.pages * PAGE_SIZE
+
+    start = time.perf_counter()
+    unseen_per_link = 0
+    for page in pages:
+        for url in page:
+            if collection.find_one({"short_url": url}, {"short_url": 1}) is None:
+                unseen_per_link += 1
+    per_link = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = UrlIndex.load(collection, NEWS_SITE)
+    load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    unseen_index = sum(len(index.filter_unseen(page)) for page in pages)
+    lookup = time.perf_counter() - start
+
+    assert unseen_per_link == unseen_index
+
+    print("links checked:          {}".format(number_of_links))
+    print("per-link find_one:      {:.3f}s ({:.1f} us/link)".format(per_link, per_link / number_of_links * 1e6))
+    print("index load ({} urls): {:.3f}s".format(len(index), load))
+    print("index filter_unseen:    {:.3f}s ({:.2f} us/link)".format(lookup, lookup / number_of_links * 1e6))
+    print("speedup incl. load:     {:.1f}x".format(per_link / (load + lookup)))
+
+    client.close()
+
+
+if __name__ == '__main__':
+    main()
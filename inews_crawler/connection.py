@@ -0,0 +1,98 @@
+# Lazily opened MongoDB connections, shared by the pipelines, the dedup checks and the event log
+import threading
+
+import pymongo
+
+
+class MongoConnection(object):
+    '''
+    MongoClient of one database that is only created when it is used for the first time,
+    so importing the spiders (scrapy list, scrapyd egg introspection, benchmarks) needs no database.
+    '''
+
+    def __init__(self, uri, database):
+        self.uri = uri
+        self.database = database
+        self.users = 0      # acquire/release count, see acquire()
+        self._client = None
+        self._lock = threading.Lock()   # first use may happen in several db_pool threads at once
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = pymongo.MongoClient(self.uri)
+        return self._client
+
+    @property
+    def db(self):
+        return self.client[self.database]
+
+    def __getitem__(self, collection_name):
+        return self.db[collection_name]
+
+    def close(self):
+        # a closed connection is opened again on the next use
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+
+class LazyCollection(object):
+    '''
+    Stand-in for a collection of the current connection, resolved on every use.
+    Lets long-living objects (the event logger) be created before any connection is opened.
+    '''
+
+    def __init__(self, get_db, name):
+        self.get_db = get_db
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(self.get_db()[self.name], attribute)
+
+
+connections = {}    # (uri, database) -> MongoConnection
+connections_lock = threading.Lock()
+
+
+def acquire(uri, database):
+    '''
+    Shared connection of a database, all crawlers of a process (run_all) use the same connection pool
+
+    Parameters
+    ----------
+    uri:
+        MONGO_URI
+    database:
+        MONGO_DATABASE
+
+    Returns
+    -------
+    MongoConnection, to be given back with release()
+    '''
+    with connections_lock:
+        connection = connections.get((uri, database))
+        if connection is None:
+            connection = connections[(uri, database)] = MongoConnection(uri, database)
+        connection.users += 1
+        return connection
+
+
+def release(connection):
+    '''
+    Give back a connection of acquire(), the client is closed when the last user released the connection
+
+    Returns
+    -------
+    True if the connection was closed
+    '''
+    with connections_lock:
+        connection.users -= 1
+        if connection.users > 0:
+            return False
+        connections.pop((connection.uri, connection.database), None)
+    connection.close()
+    return True
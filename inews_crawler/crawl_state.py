@@ -0,0 +1,134 @@
+# Crawl progress per news site: last finished crawl and per-department watermarks
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import fcntl
+import json
+import os
+
+
+def _as_utc(value):
+    # naive datetimes of the spiders are local times
+    return value.astimezone(timezone.utc)
+
+
+class CrawlState(object):
+    '''
+    JSON file with the crawl progress of every news site:
+
+    - the start time of the last finished crawl (not the end, so articles published during a run are found
+      by the next one), used by the feed discovery mode
+    - per department: the newest article (short_url and published time) and the last category page
+      of an unfinished archive build, used by the pagination of the category pages
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            state = json.load(f)
+        # files of the first version kept the last crawl of every news site at the top level
+        for key in [key for key, value in state.items() if isinstance(value, str)]:
+            state.setdefault('last_crawl', {}).setdefault(key, state.pop(key))
+        return state
+
+    def _save(self, state):
+        # write and rename, so an interrupted run never leaves a broken state file
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    @contextmanager
+    def _update(self):
+        # read, change and save the state under a file lock, the spiders of other processes share the file
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._load()
+            yield state
+            self._save(state)
+
+    def last_crawl(self, news_site):
+        '''
+        Parameters
+        ----------
+        news_site:
+            news site as saved in the database (taz, sz, heise, postillon, golem)
+
+        Returns
+        -------
+        timezone-aware datetime of the last finished crawl, or None
+        '''
+        value = self._load().get('last_crawl', {}).get(news_site)
+        if value is None:
+            return None
+        return datetime.fromisoformat(value)
+
+    def set_last_crawl(self, news_site, crawl_time):
+        with self._update() as state:
+            state.setdefault('last_crawl', {})[news_site] = _as_utc(crawl_time).isoformat()
+
+    def departments(self, news_site):
+        '''
+        Parameters
+        ----------
+        news_site:
+            news site as saved in the database
+
+        Returns
+        -------
+        dict department -> {'newest_url': short_url, 'newest_published': timezone-aware datetime,
+        'archive_page': int}, keys are missing if unknown
+        '''
+        departments = self._load().get('departments', {}).get(news_site, {})
+        for values in departments.values():
+            if values.get('newest_published'):
+                values['newest_published'] = datetime.fromisoformat(values['newest_published'])
+        return departments
+
+    def update_department(self, news_site, department, **values):
+        '''
+        Save the progress of a department
+
+        Parameters
+        ----------
+        news_site:
+            news site as saved in the database
+        department:
+            key of the department, e.g. its url
+        values:
+            newest_url, newest_published (only saved if newer than the saved time)
+            and archive_page (None removes it)
+        '''
+        self.update_departments(news_site, {department: values})
+
+    def update_departments(self, news_site, departments):
+        '''
+        Save the progress of several departments with one write, see update_department
+
+        Parameters
+        ----------
+        news_site:
+            news site as saved in the database
+        departments:
+            dict department -> values
+        '''
+        if not departments:
+            return
+        with self._update() as state:
+            for department, values in departments.items():
+                saved = state.setdefault('departments', {}).setdefault(news_site, {}).setdefault(department, {})
+                for key, value in values.items():
+                    if key == 'newest_published':
+                        if value is None:
+                            continue
+                        value = _as_utc(value)
+                        if saved.get(key) and datetime.fromisoformat(saved[key]) >= value:
+                            continue
+                        value = value.isoformat()
+                    if value is None:
+                        saved.pop(key, None)
+                    else:
+                        saved[key] = value
@@ -0,0 +1,64 @@
+# Bounded thread pool for blocking database calls
+import logging
+
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+class DbThreadPool(object):
+    '''
+    Runs blocking pymongo calls in worker threads, so a slow database does not stall
+    the downloads on the reactor thread. The pool is started on first use and
+    stopped when the reactor shuts down.
+    '''
+
+    def __init__(self, max_threads=4, name='inews-db'):
+        self.max_threads = max_threads
+        self.name = name
+        self._pool = None
+
+    def resize(self, max_threads):
+        self.max_threads = max_threads
+        if self._pool is not None:
+            self._pool.adjustPoolsize(maxthreads=max_threads)
+
+    def _get_pool(self):
+        # the reactor is imported late, so scrapy can install the configured reactor first
+        from twisted.internet import reactor
+        if self._pool is None:
+            self._pool = ThreadPool(minthreads=1, maxthreads=self.max_threads, name=self.name)
+            self._pool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+        return self._pool
+
+    def run(self, function, *args, **kwargs):
+        '''
+        Call function in a worker thread
+
+        Parameters
+        ----------
+        function:
+            blocking callable, e.g. a pymongo collection method
+        args, kwargs:
+            arguments of function
+
+        Returns
+        -------
+        Deferred firing with the result of function on the reactor thread
+        '''
+        from twisted.internet import reactor
+        return deferToThreadPool(reactor, self._get_pool(), function, *args, **kwargs)
+
+    def call(self, function, *args, **kwargs):
+        '''
+        Fire-and-forget version of run, errors are only logged
+        '''
+        d = self.run(function, *args, **kwargs)
+        d.addErrback(lambda failure: logging.error("Database call failed: %s", failure.value))
+        return d
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.stop()
+            self._pool = None
+
@@ -0,0 +1,119 @@
+# Buffered writing of crawl events (LogItems) to the log collection
+from datetime import datetime
+import json
+import logging
+import threading
+
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from twisted.internet import defer, task
+
+
+class EventLogger(object):
+    '''
+    Collects LogItems in memory and writes them in bulk to the log collection
+    when the buffer is full, every flush_interval seconds and when the spider is closed.
+
+    In aggregate mode only the number of events per news_site/property/level of the current run is saved,
+    instead of one document per url. If MongoDB is unavailable the documents are appended to a local JSONL file.
+    '''
+
+    def __init__(self, collection, pool=None, buffer_size=500, flush_interval=30, aggregate=False,
+                 fallback_path=None):
+        self.collection = collection
+        self.pool = pool
+        self.buffer_size = max(buffer_size, 1)
+        self.flush_interval = flush_interval
+        self.aggregate = aggregate
+        self.fallback_path = fallback_path
+        self.run_id = datetime.now()
+        self.buffer = []
+        self.counts = {}   # aggregate mode: (news_site, property, level) -> number of events
+        self.flush_task = None
+        self.fallback_lock = threading.Lock()
+
+    def log(self, log_item):
+        '''
+        Add an event to the buffer
+
+        Parameters
+        ----------
+        log_item:
+            LogItem of the event
+        '''
+        self._start_flush_task()
+        if self.aggregate:
+            key = (log_item['news_site'], log_item['property'], log_item['level'])
+            self.counts[key] = self.counts.get(key, 0) + 1
+            size = len(self.counts)
+        else:
+            self.buffer.append(dict(log_item))
+            size = len(self.buffer)
+        if size >= self.buffer_size:
+            self.flush()
+
+    def _start_flush_task(self):
+        if self.flush_task is None and self.flush_interval > 0:
+            self.flush_task = task.LoopingCall(self.flush)
+            self.flush_task.start(self.flush_interval, now=False)
+
+    def flush(self):
+        '''
+        Write all buffered events, in a thread of the db pool if one is set
+
+        Returns
+        -------
+        Deferred firing when the events are written
+        '''
+        if self.aggregate:
+            events, self.counts = self.counts, {}
+            write = self._write_counts
+        else:
+            events, self.buffer = self.buffer, []
+            write = self._write_documents
+        if not events:
+            return defer.succeed(None)
+        if self.pool is None:
+            return defer.maybeDeferred(write, events)
+        return self.pool.run(write, events)
+
+    def close(self):
+        '''
+        Stop the flush timer and write the remaining events
+
+        Returns
+        -------
+        Deferred firing when the events are written
+        '''
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush_task = None
+        return self.flush()
+
+    def _write_documents(self, documents):
+        try:
+            self.collection.insert_many(documents, ordered=False)
+        except PyMongoError as e:
+            self._write_fallback(documents, e)
+
+    def _write_counts(self, counts):
+        now = datetime.now()
+        requests = [UpdateOne({'run_id': self.run_id, 'news_site': news_site, 'property': property_name, 'level': level},
+                              {'$inc': {'count': count}, '$set': {'log_time': now}}, upsert=True)
+                    for (news_site, property_name, level), count in counts.items()]
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except PyMongoError as e:
+            self._write_fallback([dict(run_id=self.run_id, news_site=news_site, property=property_name, level=level,
+                                       count=count, log_time=now)
+                                  for (news_site, property_name, level), count in counts.items()], e)
+
+    def _write_fallback(self, documents, error):
+        if not self.fallback_path:
+            logging.error("Cannot save %d log events: %s", len(documents), error)
+            return
+        logging.warning("Cannot save log events in MongoDB, writing them to %s: %s", self.fallback_path, error)
+        with self.fallback_lock, open(self.fallback_path, 'a', encoding='utf-8') as f:
+            for document in documents:
+                document.pop('_id', None)   # set by insert_many before it failed
+                f.write(json.dumps(document, default=str, ensure_ascii=False) + '\n')
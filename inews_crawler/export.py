@@ -0,0 +1,446 @@
+# Article export to rolling, compressed files, partitioned by news site and published date
+#
+#   exports/news_site=heise/published=2021-01-05/part-20210106T010203-4711-0001.jsonl.gz
+#
+# Files are written under a hidden name (.part-...) and renamed when they are complete,
+# so readers only see finished files. Articles without published time are in published=unknown.
+#
+#   python -m inews_crawler.export exports                                  # articles per news site
+#   python -m inews_crawler.export exports --sites taz --since 2021-01-01 --cat > taz.jsonl
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import mmap
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+
+try:
+    from compression import zstd            # python >= 3.14
+except ImportError:
+    try:
+        from backports import zstd          # backports.zstd package
+    except ImportError:
+        zstd = None     # optional, only needed for zstd compressed JSONL files
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None      # optional, only needed for parquet files
+
+# columns of the exported articles, the fields of ArticleItem
+columns = ('short_url', 'long_url', 'news_site', 'crawl_time', 'published_time', 'title', 'authors', 'description',
+           'intro', 'text', 'keywords', 'image_links', 'links', 'content_hash', 'cluster_id', 'near_duplicate')
+list_columns = ('authors', 'keywords', 'image_links', 'links')
+time_columns = ('crawl_time', 'published_time')
+unknown_date = 'unknown'
+
+formats = ('jsonl', 'parquet')
+compressions = ('gzip', 'zstd', 'none')
+suffixes = {'jsonl': '.jsonl', 'parquet': '.parquet'}
+compression_suffixes = {'gzip': '.gz', 'zstd': '.zst', 'none': ''}
+
+file_numbers = itertools.count(1)    # part numbers, unique within the process (run_all runs several exporters)
+
+
+def check_format(file_format, compression):
+    '''
+    Check that format and compression are known and their packages are installed
+
+    Raises
+    ------
+    ValueError with the reason otherwise
+    '''
+    if file_format not in formats:
+        raise ValueError("Unknown export format %r, expected one of %s" % (file_format, ', '.join(formats)))
+    if compression not in compressions:
+        raise ValueError("Unknown export compression %r, expected one of %s"
+                         % (compression, ', '.join(compressions)))
+    if file_format == 'parquet' and pyarrow is None:
+        raise ValueError("Parquet export requires the pyarrow package")
+    if file_format == 'jsonl' and compression == 'zstd' and zstd is None:
+        raise ValueError("zstd compressed JSONL requires python 3.14 or the backports.zstd package")
+
+
+def to_naive_utc(value):
+    # like pymongo: aware times are saved as UTC, naive times (crawl_time) as they are
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def article_record(item):
+    '''
+    Exported columns of an article
+
+    Parameters
+    ----------
+    item:
+        ArticleItem
+
+    Returns
+    -------
+    dict column -> value, lists are never None and times are naive (UTC if they had a timezone)
+    '''
+    record = dict((column, item.get(column)) for column in columns)
+    for column in list_columns:
+        if record[column] is None:
+            record[column] = []
+    for column in time_columns:
+        record[column] = to_naive_utc(record[column])
+    return record
+
+
+def partition_of(item):
+    # (news site, published date) of an article, the date as published (local time of the news site)
+    published_time = item.get('published_time')
+    return item.get('news_site') or 'unknown', published_time.date().isoformat() if published_time else unknown_date
+
+
+def partition_dir(directory, news_site, published):
+    return os.path.join(directory, 'news_site=' + news_site, 'published=' + published)
+
+
+def default_json(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def parquet_schema():
+    return pyarrow.schema([(column, pyarrow.list_(pyarrow.string()) if column in list_columns
+                            else pyarrow.timestamp('us') if column in time_columns
+                            else pyarrow.float64() if column == 'near_duplicate' else pyarrow.string())
+                           for column in columns])
+
+
+class JsonlPart(object):
+    '''
+    Newline-delimited JSON file, one article per line, compressed as one gzip or zstd stream
+    '''
+
+    def __init__(self, path, compression):
+        self.path = path
+        self.file = open(path, 'wb')
+        if compression == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=self.file, mode='wb', compresslevel=6)
+        elif compression == 'zstd':
+            self.stream = zstd.ZstdFile(self.file, mode='wb')
+        else:
+            self.stream = self.file
+
+    def write(self, records):
+        lines = [json.dumps(record, default=default_json, ensure_ascii=False) for record in records]
+        self.stream.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def size(self):
+        # compressed bytes on disk, without the data still buffered by the compressor
+        return self.file.tell()
+
+    def close(self):
+        if self.stream is not self.file:
+            self.stream.close()
+        self.file.close()
+
+
+class ParquetPart(object):
+    '''
+    Parquet file, the articles are written in row groups of row_group_size articles
+    '''
+
+    def __init__(self, path, compression, row_group_size=2000):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.schema = parquet_schema()
+        self.writer = parquet.ParquetWriter(path, self.schema,
+                                            compression=None if compression == 'none' else compression)
+        self.pending = []
+
+    def write(self, records):
+        self.pending.extend(records)
+        if len(self.pending) >= self.row_group_size:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if self.pending:
+            self.writer.write_table(pyarrow.Table.from_pylist(self.pending, schema=self.schema))
+            self.pending = []
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def close(self):
+        self.write_row_group()
+        self.writer.close()
+
+
+class ArticleExporter(object):
+    '''
+    Writes articles to rolling files, one open file per partition (news site, published date).
+
+    A file is completed (renamed from its hidden name) when it reaches max_bytes, when it is open
+    longer than max_seconds, when more than max_open_files partitions are written at the same time
+    (the least recently used one is completed) and on close(). Thread-safe, the pipeline writes in db_pool threads.
+    '''
+
+    def __init__(self, directory, file_format='jsonl', compression='gzip', max_bytes=64 * 1024 * 1024,
+                 max_seconds=3600, max_open_files=32, row_group_size=2000):
+        check_format(file_format, compression)
+        self.directory = directory
+        self.file_format = file_format
+        self.compression = compression
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.max_open_files = max(max_open_files, 1)
+        self.row_group_size = row_group_size
+        self.parts = OrderedDict()     # partition -> (part, opened), least recently written first
+        self.lock = threading.Lock()
+        self.articles = 0
+        self.files = 0
+
+    def suffix(self):
+        if self.file_format == 'parquet':
+            return suffixes['parquet']    # compressed inside the file
+        return suffixes['jsonl'] + compression_suffixes[self.compression]
+
+    def open_part(self, partition):
+        directory = partition_dir(self.directory, *partition)
+        os.makedirs(directory, exist_ok=True)
+        name = 'part-%s-%d-%04d%s' % (datetime.now().strftime('%Y%m%dT%H%M%S'), os.getpid(), next(file_numbers),
+                                      self.suffix())
+        path = os.path.join(directory, '.' + name)
+        if self.file_format == 'parquet':
+            return ParquetPart(path, self.compression, self.row_group_size)
+        return JsonlPart(path, self.compression)
+
+    def complete(self, partition):
+        part, opened = self.parts.pop(partition)
+        part.close()
+        directory, hidden_name = os.path.split(part.path)
+        path = os.path.join(directory, hidden_name[1:])
+        os.replace(part.path, path)
+        self.files += 1
+        logging.info("Export file completed: %s", path)
+
+    def write(self, records):
+        '''
+        Append articles to the files of their partitions
+
+        Parameters
+        ----------
+        records:
+            list of (partition, record) as returned by partition_of and article_record
+        '''
+        partitions = OrderedDict()
+        for partition, record in records:
+            partitions.setdefault(partition, []).append(record)
+        with self.lock:
+            for partition, partition_records in partitions.items():
+                if partition in self.parts:
+                    self.parts.move_to_end(partition)
+                else:
+                    if len(self.parts) >= self.max_open_files:
+                        self.complete(next(iter(self.parts)))
+                    self.parts[partition] = (self.open_part(partition), time.time())
+                part = self.parts[partition][0]
+                part.write(partition_records)
+                self.articles += len(partition_records)
+                if self.max_bytes and part.size() >= self.max_bytes:
+                    self.complete(partition)
+
+    def rotate(self):
+        # complete the files that are open longer than max_seconds
+        if not self.max_seconds:
+            return
+        with self.lock:
+            expired = [partition for partition, (part, opened) in self.parts.items()
+                       if time.time() - opened >= self.max_seconds]
+            for partition in expired:
+                self.complete(partition)
+
+    def close(self):
+        with self.lock:
+            for partition in list(self.parts):
+                self.complete(partition)
+
+
+# reading
+
+def is_export_file(name):
+    # completed files only, hidden files are being written (or left over by a killed crawler)
+    return name.startswith('part-') and (name.endswith(suffixes['parquet'])
+                                         or any(name.endswith(suffixes['jsonl'] + suffix)
+                                                for suffix in compression_suffixes.values()))
+
+
+def partition_value(name, key):
+    return name[len(key) + 1:] if name.startswith(key + '=') else None
+
+
+def export_files(directory, news_sites=None, since=None, until=None):
+    '''
+    Completed export files, only the partition directories matching the filters are listed
+
+    Parameters
+    ----------
+    directory:
+        EXPORT_DIR
+    news_sites:
+        list of news sites, None: all
+    since, until:
+        date or 'YYYY-MM-DD', first and last published date (inclusive).
+        Articles without published time are only included without these filters.
+
+    Returns
+    -------
+    list of paths, ordered by news site, published date and file name (= creation time)
+    '''
+    since = since.isoformat() if isinstance(since, date) else since
+    until = until.isoformat() if isinstance(until, date) else until
+    paths = []
+    if not os.path.isdir(directory):
+        return paths
+    for site_name in sorted(os.listdir(directory)):
+        news_site = partition_value(site_name, 'news_site')
+        if news_site is None or (news_sites and news_site not in news_sites):
+            continue
+        site_dir = os.path.join(directory, site_name)
+        for date_name in sorted(os.listdir(site_dir)):
+            published = partition_value(date_name, 'published')
+            if published is None:
+                continue
+            if published == unknown_date:
+                if since or until:
+                    continue
+            elif (since and published < since) or (until and published > until):
+                continue
+            date_dir = os.path.join(site_dir, date_name)
+            paths += [os.path.join(date_dir, name) for name in sorted(os.listdir(date_dir)) if is_export_file(name)]
+    return paths
+
+
+def jsonl_lines(path):
+    # uncompressed files are memory-mapped, compressed ones streamed
+    if path.endswith(compression_suffixes['gzip']):
+        with gzip.open(path, 'rb') as f:
+            yield from f
+    elif path.endswith(compression_suffixes['zstd']):
+        if zstd is None:
+            raise ValueError("Reading %s requires python 3.14 or the backports.zstd package" % path)
+        with zstd.open(path, 'rb') as f:
+            yield from f
+    else:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                yield from iter(m.readline, b'')
+
+
+def read_file(path, batch_size=1000, columns=None):
+    '''
+    Articles of an export file in batches
+
+    Parameters
+    ----------
+    path:
+        JSONL or parquet export file
+    batch_size:
+        articles per batch
+    columns:
+        list of columns to read, None: all
+
+    Returns
+    -------
+    generator of lists of dicts, crawl_time and published_time are datetimes
+    '''
+    if path.endswith(suffixes['parquet']):
+        if pyarrow is None:
+            raise ValueError("Reading %s requires the pyarrow package" % path)
+        for batch in parquet.ParquetFile(path, memory_map=True).iter_batches(batch_size=batch_size, columns=columns):
+            yield batch.to_pylist()
+        return
+
+    batch = []
+    for line in jsonl_lines(path):
+        record = json.loads(line)
+        if columns:
+            record = dict((column, record.get(column)) for column in columns)
+        for column in time_columns:
+            if record.get(column):
+                record[column] = datetime.fromisoformat(record[column])
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_batches(directory, batch_size=1000, columns=None, news_sites=None, since=None, until=None):
+    '''
+    Exported articles in batches, for bulk consumers (NLP jobs) instead of a MongoDB cursor
+
+    Parameters
+    ----------
+    directory:
+        EXPORT_DIR
+    batch_size, columns:
+        see read_file, batches do not span files
+    news_sites, since, until:
+        see export_files
+
+    Returns
+    -------
+    generator of lists of dicts
+    '''
+    for path in export_files(directory, news_sites, since, until):
+        yield from read_file(path, batch_size, columns)
+
+
+def read_articles(directory, columns=None, news_sites=None, since=None, until=None):
+    '''
+    Exported articles one by one, see read_batches
+
+    Returns
+    -------
+    generator of dicts
+    '''
+    for batch in read_batches(directory, columns=columns, news_sites=news_sites, since=since, until=until):
+        yield from batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count or print the exported articles')
+    parser.add_argument('directory', help='EXPORT_DIR of the crawl')
+    parser.add_argument('--sites', help='comma separated news sites, e.g. heise,taz')
+    parser.add_argument('--since', help='first published date, YYYY-MM-DD')
+    parser.add_argument('--until', help='last published date, YYYY-MM-DD')
+    parser.add_argument('--cat', action='store_true', help='print the articles as JSONL instead of counting them')
+    args = parser.parse_args()
+
+    news_sites = args.sites.split(',') if args.sites else None
+    if args.cat:
+        for batch in read_batches(args.directory, news_sites=news_sites, since=args.since, until=args.until):
+            for article in batch:
+                sys.stdout.write(json.dumps(article, default=default_json, ensure_ascii=False) + '\n')
+        return
+
+    counts = {}
+    for batch in read_batches(args.directory, columns=['news_site'], news_sites=news_sites, since=args.since,
+                              until=args.until):
+        for article in batch:
+            counts[article['news_site']] = counts.get(article['news_site'], 0) + 1
+    for news_site, count in sorted(counts.items()):
+        print("%-12s %10d" % (news_site, count))
+    print("%-12s %10d" % ('total', sum(counts.values())))
+
+
+if __name__ == '__main__':
+    main()
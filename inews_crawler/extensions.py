@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# Scrapy extensions of the crawler
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+
+import logging
+import time
+from datetime import datetime, timezone
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from .crawl_state import CrawlState
+from .utils import utils
+
+
+class CrawlStateExtension(object):
+    '''
+    Saves the start time of every finished crawl per news site in CRAWL_STATE_PATH.
+    The feed discovery mode of the spiders only requests articles updated since then.
+    '''
+
+    def __init__(self, path):
+        self.state = CrawlState(path)
+        self.started = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        ext = cls(crawler.settings.get('CRAWL_STATE_PATH', 'crawl_state.json'))
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_opened(self, spider):
+        self.started = datetime.now(timezone.utc)
+
+    def spider_closed(self, spider, reason):
+        # cancelled or failed runs may have missed articles, the next run starts from the last finished one
+        if reason == 'finished' and self.started is not None:
+            self.state.set_last_crawl(utils.get_news_site(spider), self.started)
+
+
+class AdaptiveThrottleExtension(object):
+    '''
+    Adjusts the concurrency and download delay of every download slot (domain) to the measured
+    response latency and error rate, within the bounds of the throttle profile of the spider.
+
+    The responses of a slot are evaluated in windows of THROTTLE_WINDOW responses:
+    - more than max_error_rate 429/5xx responses: concurrency halved, delay doubled (at least Retry-After)
+    - median latency above target_latency: concurrency decreased by one
+    - otherwise: concurrency increased by one, delay reduced by a quarter
+
+    THROTTLE_PROFILES maps spider names to profiles, missing values are taken from the 'default' profile.
+    The chosen concurrency and delay of every slot are recorded in the crawl stats
+    (throttle/<slot>/history: [seconds since start, concurrency, delay] at every change).
+    '''
+
+    def __init__(self, crawler, profiles, window):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.profiles = profiles
+        self.window = max(window, 1)
+        self.profile = None
+        self.started = None
+        self.slots = {}     # slot key -> measurements of the current window
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('THROTTLE_ENABLED'):
+            raise NotConfigured
+        if crawler.settings.getbool('AUTOTHROTTLE_ENABLED'):
+            raise NotConfigured("AdaptiveThrottleExtension is disabled while AUTOTHROTTLE_ENABLED is set")
+        ext = cls(crawler, crawler.settings.getdict('THROTTLE_PROFILES'), crawler.settings.getint('THROTTLE_WINDOW', 20))
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.response_downloaded, signal=signals.response_downloaded)
+        return ext
+
+    def spider_opened(self, spider):
+        self.profile = dict(self.profiles.get('default', {}), **self.profiles.get(spider.name, {}))
+        self.started = time.monotonic()
+
+    def get_slot(self, key):
+        ## measurements of a slot, the slot starts with the start values of the profile
+        state = self.slots.get(key)
+        if state is None:
+            slot = self.crawler.engine.downloader.slots.get(key)
+            if slot is None:
+                return None, None
+            state = self.slots[key] = {'latencies': [], 'errors': 0, 'bytes': 0, 'responses': 0}
+            slot.concurrency = self.profile.get('start_concurrency', slot.concurrency)
+            slot.delay = self.profile.get('start_delay', slot.delay)
+            self.record(key, slot)
+        return state, self.crawler.engine.downloader.slots.get(key)
+
+    def response_downloaded(self, response, request, spider):
+        key = request.meta.get('download_slot')
+        latency = request.meta.get('download_latency')
+        if key is None or latency is None:
+            return
+        state, slot = self.get_slot(key)
+        if slot is None:
+            return
+
+        state['latencies'].append(latency)
+        state['bytes'] += len(response.body)
+        state['responses'] += 1
+        if response.status == 429 or response.status >= 500:
+            state['errors'] += 1
+            self.stats.inc_value('throttle/%s/errors' % key, spider=spider)
+            retry_after = response.headers.get('Retry-After', b'').decode('latin-1')
+            if retry_after.isdigit():
+                state['retry_after'] = max(state.get('retry_after', 0), int(retry_after))
+        self.stats.inc_value('throttle/%s/bytes' % key, len(response.body), spider=spider)
+
+        if len(state['latencies']) >= self.window:
+            self.adjust(key, slot, state)
+
+    def adjust(self, key, slot, state):
+        '''
+        Set the concurrency and delay of a slot from the measurements of a full window
+
+        Parameters
+        ----------
+        key:
+            download slot key, usually the domain
+        slot:
+            scrapy downloader slot
+        state:
+            measurements of the window, reset afterwards
+        '''
+        profile = self.profile
+        min_concurrency = profile.get('min_concurrency', 1)
+        max_concurrency = profile.get('max_concurrency', 8)
+        min_delay = profile.get('min_delay', 0.0)
+        max_delay = profile.get('max_delay', 10.0)
+
+        latencies = sorted(state['latencies'])
+        latency = latencies[len(latencies) // 2]
+        error_rate = state['errors'] / len(latencies)
+        concurrency, delay = slot.concurrency, slot.delay
+
+        if error_rate > profile.get('max_error_rate', 0.05):
+            concurrency = concurrency // 2
+            delay = float(max(delay * 2, min_delay, 0.5, state.get('retry_after', 0)))
+        elif latency > profile.get('target_latency', 1.0):
+            concurrency -= 1
+        else:
+            concurrency += 1
+            delay = delay * 0.75
+
+        slot.concurrency = min(max(concurrency, min_concurrency), max_concurrency)
+        slot.delay = min(max(delay, min_delay), max_delay)
+        if profile.get('debug'):
+            logging.info("Throttle %s: concurrency %d, delay %.2fs (median latency %.2fs, errors %.0f%%, %d KiB)",
+                         key, slot.concurrency, slot.delay, latency, error_rate * 100, state['bytes'] // 1024)
+        self.slots[key] = {'latencies': [], 'errors': 0, 'bytes': 0, 'responses': 0}
+        self.record(key, slot)
+
+    def record(self, key, slot):
+        ## crawl stats: current and maximum concurrency, history of all changes
+        spider = self.crawler.spider
+        history = self.stats.get_value('throttle/%s/history' % key, [], spider=spider)
+        point = [round(time.monotonic() - self.started, 1), slot.concurrency, round(slot.delay, 2)]
+        if not history or history[-1][1:] != point[1:]:
+            history.append(point)
+            self.stats.set_value('throttle/%s/history' % key, history, spider=spider)
+        self.stats.set_value('throttle/%s/concurrency' % key, slot.concurrency, spider=spider)
+        self.stats.max_value('throttle/%s/concurrency_max' % key, slot.concurrency, spider=spider)
+        self.stats.set_value('throttle/%s/delay' % key, round(slot.delay, 2), spider=spider)
+
+
+class MongoConnectionExtension(object):
+    '''
+    Opens the MongoDB connection of the crawler from its settings (MONGO_URI, MONGO_DATABASE)
+    and closes it when the spider is closed, after the pipelines wrote their last items.
+    The client itself is only created by the first database query.
+    '''
+
+    def __init__(self, settings):
+        self.connection = utils.open_connection(settings)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        ext = cls(crawler.settings)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_closed(self, spider, reason):
+        utils.close_connection(self.connection)
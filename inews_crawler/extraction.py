@@ -0,0 +1,138 @@
+# Declarative extraction of article fields, compiled once into lxml XPath objects
+from collections import namedtuple
+from functools import lru_cache
+
+from lxml import etree
+from parsel.csstranslator import css2xpath
+
+# namespaces parsel registers for its selectors, so expressions behave the same as with response.xpath()
+XPATH_NAMESPACES = {'re': 'http://exslt.org/regular-expressions', 'set': 'http://exslt.org/sets'}
+
+# name: item field, kind: 'string', 'list' or 'split', expressions: ordered fallbacks [(sel, expression)],
+# split: separator of kind 'split', post: optional function applied to the extracted value
+Field = namedtuple('Field', 'name kind expressions split post')
+
+
+def field(name, kind='string', xpath=(), css=(), split=None, post=None):
+    '''
+    Declare a field of an extraction spec
+
+    Parameters
+    ----------
+    name:
+        name of the field, used for the warnings of missing fields
+    kind:
+        'string': first value of the first expression whose first value is not empty, stripped ('' if missing)
+        'list': all values of the first expression, also if there are none (never missing)
+        'split': first value of the first matching expression, split at split ([] if missing)
+    xpath, css:
+        fallback expressions, the xpath expressions are tried before the css expressions
+    split:
+        separator for kind 'split'
+    post:
+        function(value) -> value, applied to the extracted (or missing) value
+
+    Returns
+    -------
+    Field
+    '''
+    expressions = [('xpath', expression) for expression in xpath] + [('css', expression) for expression in css]
+    return Field(name, kind, tuple(expressions), split, post)
+
+
+@lru_cache(maxsize=None)
+def compile_expression(sel, expression):
+    '''
+    Compile a css or xpath expression once, css expressions are translated to XPath (with ::text and ::attr())
+
+    Parameters
+    ----------
+    sel:
+        'css' or 'xpath'
+    expression:
+        the expression
+
+    Returns
+    -------
+    lxml.etree.XPath
+    '''
+    if sel == 'css':
+        expression = css2xpath(expression)
+    return etree.XPath(expression, namespaces=XPATH_NAMESPACES, smart_strings=False)
+
+
+def to_string(value):
+    # like Selector.get(): attributes and text as they are, elements as their html
+    if isinstance(value, str):
+        return value
+    if isinstance(value, etree._Element):
+        return etree.tostring(value, method='html', encoding='unicode', with_tail=False)
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return str(value)
+
+
+def select(selector, compiled):
+    '''
+    Evaluate a compiled expression on a response or selector
+
+    Parameters
+    ----------
+    selector:
+        scrapy response or parsel selector, its already parsed tree is used
+    compiled:
+        lxml.etree.XPath, see compile_expression
+
+    Returns
+    -------
+    list of strings
+    '''
+    root = selector.selector.root if hasattr(selector, 'selector') else selector.root
+    result = compiled(root)
+    if not isinstance(result, list):
+        return [to_string(result)]
+    return [to_string(value) for value in result]
+
+
+class Spec(object):
+    '''
+    Extraction spec of a news site: the fields of an article page with their fallback expressions,
+    compiled when the spec is created (at spider import) and evaluated together by extract().
+    '''
+
+    def __init__(self, fields):
+        self.fields = [(f, [compile_expression(sel, expression) for sel, expression in f.expressions])
+                       for f in fields]
+
+    def extract(self, selector):
+        '''
+        Extract all fields
+
+        Parameters
+        ----------
+        selector:
+            scrapy response or parsel selector
+
+        Returns
+        -------
+        (dict name -> value, list of the names of missing fields)
+        '''
+        values = {}
+        missing = []
+        for f, compiled_expressions in self.fields:
+            value = None
+            for compiled in compiled_expressions:
+                results = select(selector, compiled)
+                if f.kind == 'string':
+                    value = results[0].strip() if results and results[0].strip() else None
+                elif f.kind == 'split':
+                    value = results[0].split(f.split) if results else None
+                else:
+                    value = list(results)
+                if value is not None:
+                    break
+            if value is None:
+                missing.append(f.name)
+                value = '' if f.kind == 'string' else []
+            values[f.name] = f.post(value) if f.post is not None else value
+        return values, missing
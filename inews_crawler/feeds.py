@@ -0,0 +1,105 @@
+# Article links from RSS 2.0 / Atom feeds and (news) sitemaps, for the feed discovery mode of the spiders
+from collections import namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from lxml import etree
+from w3lib.html import remove_tags
+
+FeedEntry = namedtuple('FeedEntry', ['url', 'updated', 'title', 'description'])
+
+_parser = etree.XMLParser(recover=True, resolve_entities=False, no_network=True, huge_tree=True)
+
+
+def parse_time(value):
+    '''
+    Parse ISO 8601 (Atom, sitemaps) or RFC 822 (RSS) times
+
+    Returns
+    -------
+    timezone-aware datetime (UTC if the value has no offset), or None
+    '''
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        try:
+            parsed = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def _text(element, xpath):
+    values = element.xpath(xpath)
+    if not values:
+        return None
+    value = values[0] if isinstance(values[0], str) else values[0].text
+    return value.strip() if value else None
+
+
+def parse_feed(body):
+    '''
+    Read the article links of a feed or sitemap, the format is detected by the root element
+
+    Parameters
+    ----------
+    body:
+        bytes of an RSS 2.0 feed, an Atom feed or a (Google news) sitemap
+
+    Returns
+    -------
+    list of FeedEntry(url, updated, title, description), updated is a timezone-aware datetime or None.
+    Query strings and fragments are removed from the urls, HTML tags from the descriptions.
+    '''
+    root = etree.fromstring(body, parser=_parser)
+    if root is None:
+        return []
+    kind = etree.QName(root).localname
+    entries = []
+    if kind == 'rss':
+        for item in root.xpath('channel/item'):
+            entries.append(FeedEntry(_text(item, 'link'), parse_time(_text(item, 'pubDate')),
+                                     _text(item, 'title'), _text(item, 'description')))
+    elif kind == 'feed':
+        for item in root.xpath('*[local-name()="entry"]'):
+            url = _text(item, '*[local-name()="link"][not(@rel) or @rel="alternate"]/@href')
+            updated = parse_time(_text(item, '*[local-name()="updated"]')
+                                 or _text(item, '*[local-name()="published"]'))
+            entries.append(FeedEntry(url, updated, _text(item, '*[local-name()="title"]'),
+                                     _text(item, '*[local-name()="summary"]')))
+    elif kind == 'urlset':
+        for item in root.xpath('*[local-name()="url"]'):
+            updated = parse_time(_text(item, '*[local-name()="lastmod"]')
+                                 or _text(item, './/*[local-name()="publication_date"]'))
+            entries.append(FeedEntry(_text(item, '*[local-name()="loc"]'), updated,
+                                     _text(item, './/*[local-name()="title"]'), None))
+    # the article urls of the crawled sites have no query, the feeds add tracking parameters
+    return [entry._replace(url=entry.url.split('?')[0].split('#')[0],
+                           description=remove_tags(entry.description).strip() if entry.description else None)
+            for entry in entries if entry.url]
+
+
+def entries_since(entries, since):
+    '''
+    Keep the entries updated after since
+
+    Parameters
+    ----------
+    entries:
+        list of FeedEntry
+    since:
+        ISO 8601 time, e.g. of the last crawl, or None to keep all entries
+
+    Returns
+    -------
+    list of FeedEntry, entries without time are kept
+    '''
+    since = parse_time(since)
+    if since is None:
+        return list(entries)
+    return [entry for entry in entries if entry.updated is None or entry.updated > since]
@@ -0,0 +1,403 @@
+# Shared request queue (frontier) for crawling one spider with several worker processes or nodes
+import argparse
+import logging
+from contextlib import contextmanager
+import os
+import pickle
+import sqlite3
+import time
+
+from scrapy import signals
+from scrapy.core.scheduler import BaseScheduler
+from scrapy.exceptions import DontCloseSpider, NotConfigured
+from scrapy.utils.request import request_from_dict
+
+try:
+    import redis
+except ImportError:
+    redis = None    # optional, only needed for redis:// frontiers
+
+
+class SqliteFrontier(object):
+    '''
+    Frontier in a SQLite file, for several worker processes on one node (and for tests).
+
+    Every request is leased to the worker that takes it. A worker acknowledges its requests when they were
+    parsed or failed; requests of a worker that died are given to another worker when the lease expired.
+    A request leased max_leases times without acknowledgement is removed.
+    Fingerprints of all enqueued requests are kept until the queue is drained, so each request is crawled
+    once per run by all workers together.
+    '''
+
+    def __init__(self, path, queue, max_leases=3):
+        self.path = path
+        self.queue = queue
+        self.max_leases = max_leases
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS requests (id INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT, '
+                        'priority INTEGER, data BLOB, lease_until REAL, leases INTEGER DEFAULT 0)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS requests_queued ON requests (queue, lease_until, priority DESC, id)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS fingerprints (queue TEXT, fingerprint TEXT, '
+                        'PRIMARY KEY (queue, fingerprint)) WITHOUT ROWID')
+
+    @contextmanager
+    def transaction(self):
+        # the connection is in autocommit mode, IMMEDIATE locks the file against the other workers at once
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def push(self, data, priority, fingerprint=None):
+        '''
+        Add a request
+
+        Parameters
+        ----------
+        data:
+            serialised request
+        priority:
+            scrapy request priority, higher first
+        fingerprint:
+            request fingerprint, None for requests that are not filtered (dont_filter)
+
+        Returns
+        -------
+        False if a request with this fingerprint was already enqueued by any worker, True otherwise
+        '''
+        with self.transaction():
+            if fingerprint is not None:
+                cursor = self.db.execute('INSERT OR IGNORE INTO fingerprints VALUES (?, ?)', (self.queue, fingerprint))
+                if cursor.rowcount == 0:
+                    return False
+            self.db.execute('INSERT INTO requests (queue, priority, data) VALUES (?, ?, ?)',
+                            (self.queue, priority, data))
+        return True
+
+    def pop(self, lease_seconds):
+        '''
+        Lease the next request
+
+        Returns
+        -------
+        (id, data) of the request with the highest priority, None if no request is waiting
+        '''
+        now = time.time()
+        with self.transaction():
+            # requests of dead workers are waiting again, unless they were leased too often
+            self.db.execute('DELETE FROM requests WHERE queue = ? AND lease_until < ? AND leases >= ?',
+                            (self.queue, now, self.max_leases))
+            self.db.execute('UPDATE requests SET lease_until = NULL WHERE queue = ? AND lease_until < ?',
+                            (self.queue, now))
+            row = self.db.execute('SELECT id, data FROM requests WHERE queue = ? AND lease_until IS NULL '
+                                  'ORDER BY priority DESC, id LIMIT 1', (self.queue,)).fetchone()
+            if row is not None:
+                self.db.execute('UPDATE requests SET lease_until = ?, leases = leases + 1 WHERE id = ?',
+                                (now + lease_seconds, row[0]))
+        return row
+
+    def ack(self, request_id):
+        self.db.execute('DELETE FROM requests WHERE id = ?', (request_id,))
+
+    def waiting(self):
+        # requests that can be leased now
+        return self.db.execute('SELECT COUNT(*) FROM requests WHERE queue = ? AND (lease_until IS NULL '
+                               'OR lease_until < ?)', (self.queue, time.time())).fetchone()[0]
+
+    def leased(self):
+        # requests currently crawled by a worker
+        return self.db.execute('SELECT COUNT(*) FROM requests WHERE queue = ? AND lease_until >= ?',
+                               (self.queue, time.time())).fetchone()[0]
+
+    def clear(self):
+        with self.transaction():
+            self.db.execute('DELETE FROM requests WHERE queue = ?', (self.queue,))
+            self.db.execute('DELETE FROM fingerprints WHERE queue = ?', (self.queue,))
+
+    def clear_fingerprints_if_drained(self):
+        '''
+        Remove the fingerprints if no request is waiting or leased, i.e. the run of all workers is finished
+
+        Returns
+        -------
+        True if the fingerprints were removed
+        '''
+        with self.transaction():
+            if self.db.execute('SELECT 1 FROM requests WHERE queue = ? LIMIT 1', (self.queue,)).fetchone():
+                return False
+            self.db.execute('DELETE FROM fingerprints WHERE queue = ?', (self.queue,))
+        return True
+
+    def close(self):
+        self.db.close()
+
+
+class RedisFrontier(object):
+    '''
+    Frontier in Redis (or a Redis-compatible server), for workers on several nodes.
+    Same behaviour as SqliteFrontier; taking the next request and requeueing expired leases is one Lua script.
+    '''
+
+    POP_SCRIPT = '''
+        local now = tonumber(ARGV[1])
+        for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+            redis.call('ZREM', KEYS[2], id)
+            if tonumber(redis.call('HGET', KEYS[5], id) or 0) >= tonumber(ARGV[3]) then
+                redis.call('HDEL', KEYS[3], id)
+                redis.call('HDEL', KEYS[4], id)
+                redis.call('HDEL', KEYS[5], id)
+            else
+                redis.call('ZADD', KEYS[1], redis.call('HGET', KEYS[4], id), id)
+            end
+        end
+        local popped = redis.call('ZPOPMIN', KEYS[1])
+        if #popped == 0 then
+            return nil
+        end
+        redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), popped[1])
+        redis.call('HINCRBY', KEYS[5], popped[1], 1)
+        return {popped[1], redis.call('HGET', KEYS[3], popped[1])}
+    '''
+
+    CLEAR_IF_DRAINED_SCRIPT = '''
+        if redis.call('ZCARD', KEYS[1]) > 0 or redis.call('ZCARD', KEYS[2]) > 0 then
+            return 0
+        end
+        redis.call('DEL', KEYS[3])
+        return 1
+    '''
+
+    def __init__(self, url, queue, max_leases=3):
+        if redis is None:
+            raise NotConfigured("A redis:// frontier requires the redis package")
+        self.server = redis.Redis.from_url(url)
+        self.queue = queue
+        self.max_leases = max_leases
+        # waiting ids by score (-priority, ids are zero-padded so equal priorities are FIFO), leases by expiry time
+        self.keys = dict((name, '%s:%s' % (queue, name))
+                         for name in ('waiting', 'leases', 'data', 'scores', 'lease_counts', 'fingerprints', 'ids'))
+        self.pop_script = self.server.register_script(self.POP_SCRIPT)
+        self.clear_if_drained_script = self.server.register_script(self.CLEAR_IF_DRAINED_SCRIPT)
+
+    def push(self, data, priority, fingerprint=None):
+        if fingerprint is not None and not self.server.sadd(self.keys['fingerprints'], fingerprint):
+            return False
+        request_id = '%012d' % self.server.incr(self.keys['ids'])
+        pipe = self.server.pipeline()
+        pipe.hset(self.keys['data'], request_id, data)
+        pipe.hset(self.keys['scores'], request_id, -priority)
+        pipe.zadd(self.keys['waiting'], {request_id: -priority})
+        pipe.execute()
+        return True
+
+    def pop(self, lease_seconds):
+        keys = [self.keys['waiting'], self.keys['leases'], self.keys['data'], self.keys['scores'],
+                self.keys['lease_counts']]
+        result = self.pop_script(keys=keys, args=[time.time(), lease_seconds, self.max_leases])
+        if not result:
+            return None
+        return result[0].decode(), result[1]
+
+    def ack(self, request_id):
+        pipe = self.server.pipeline()
+        pipe.zrem(self.keys['leases'], request_id)
+        pipe.hdel(self.keys['data'], request_id)
+        pipe.hdel(self.keys['scores'], request_id)
+        pipe.hdel(self.keys['lease_counts'], request_id)
+        pipe.execute()
+
+    def waiting(self):
+        return self.server.zcard(self.keys['waiting']) + self.server.zcount(self.keys['leases'], '-inf', time.time())
+
+    def leased(self):
+        return self.server.zcount(self.keys['leases'], time.time(), '+inf')
+
+    def clear(self):
+        self.server.delete(*self.keys.values())
+
+    def clear_fingerprints_if_drained(self):
+        keys = [self.keys['waiting'], self.keys['leases'], self.keys['fingerprints']]
+        return bool(self.clear_if_drained_script(keys=keys))
+
+    def close(self):
+        self.server.close()
+
+
+def open_frontier(url, queue, max_leases=3):
+    '''
+    Parameters
+    ----------
+    url:
+        FRONTIER_URL, sqlite:///path/to/file or redis://host:port/db
+    queue:
+        name of the shared queue, usually the spider name
+    max_leases:
+        leases of a request without acknowledgement before it is removed
+
+    Returns
+    -------
+    SqliteFrontier or RedisFrontier
+    '''
+    if url.startswith('sqlite:///'):
+        return SqliteFrontier(url[len('sqlite:///'):], queue, max_leases)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisFrontier(url, queue, max_leases)
+    raise NotConfigured("Unsupported FRONTIER_URL: %s" % url)
+
+
+# sent by FrontierAckMiddleware when the callback of a request finished
+request_done = object()
+
+
+class DistributedScheduler(BaseScheduler):
+    '''
+    Scheduler that keeps the pending requests and the fingerprints of a spider in a shared frontier
+    (FRONTIER_URL), so every worker started with the same spider and FRONTIER_URL takes its requests
+    from the same queue. Category pages and articles found by one worker are crawled by any worker.
+
+    A request is acknowledged when its callback finished (FrontierAckMiddleware), when it failed or was dropped
+    by a downloader middleware (errback set by next_request, e.g. download errors, robots.txt, pages unchanged
+    for the ConditionalRequestMiddleware) or when a retried or redirected copy of it was enqueued.
+    Requests of a worker that died while downloading or parsing them are crawled by another worker.
+    An interrupted run is resumed by starting the workers again. When the queue is drained, the fingerprints
+    are removed, so the next run crawls the start and category pages again
+    (python -m inews_crawler.frontier clear SPIDERNAME discards an interrupted run).
+    '''
+
+    def __init__(self, crawler, url, lease_seconds, max_leases):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.url = url
+        self.lease_seconds = lease_seconds
+        self.max_leases = max_leases
+        self.frontier = None
+        self.spider = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = cls(crawler, crawler.settings.get('FRONTIER_URL', 'sqlite:///frontier.sqlite'),
+                        crawler.settings.getfloat('FRONTIER_LEASE_SECONDS', 300),
+                        crawler.settings.getint('FRONTIER_MAX_LEASES', 3))
+        crawler.signals.connect(scheduler.request_done, signal=request_done)
+        crawler.signals.connect(scheduler.spider_idle, signal=signals.spider_idle)
+        return scheduler
+
+    def open(self, spider):
+        self.spider = spider
+        self.frontier = open_frontier(self.url, spider.name, self.max_leases)
+        logging.info("Distributed frontier %s for %s: %d requests waiting", self.url, spider.name,
+                     self.frontier.waiting())
+
+    def close(self, reason):
+        self.frontier.close()
+
+    def has_pending_requests(self):
+        return self.frontier.waiting() > 0
+
+    def enqueue_request(self, request):
+        fingerprint = None
+        if not request.dont_filter:
+            fingerprint = self.crawler.request_fingerprinter.fingerprint(request).hex()
+        # retried and redirected copies of a leased request replace it in the frontier
+        replaced_id = request.meta.pop('frontier_id', None)
+        if request.errback == self.request_failed:
+            errback = request.meta.pop('frontier_errback', None)
+            request.errback = getattr(self.spider, errback) if errback else None
+        data = pickle.dumps(request.to_dict(spider=self.spider), protocol=pickle.HIGHEST_PROTOCOL)
+        pushed = self.frontier.push(data, request.priority, fingerprint)
+        if replaced_id is not None:
+            self.frontier.ack(replaced_id)
+        if not pushed:
+            self.stats.inc_value('frontier/filtered', spider=self.spider)
+            return False
+        self.stats.inc_value('frontier/enqueued', spider=self.spider)
+        return True
+
+    def next_request(self):
+        popped = self.frontier.pop(self.lease_seconds)
+        if popped is None:
+            return None
+        request_id, data = popped
+        request = request_from_dict(pickle.loads(data), spider=self.spider)
+        request.meta['frontier_id'] = request_id
+        # failures do not reach the spider middlewares: acknowledged by the errback, the one of the spider is kept
+        if request.errback is not None:
+            request.meta['frontier_errback'] = request.errback.__name__
+        request.errback = self.request_failed
+        self.stats.inc_value('frontier/dequeued', spider=self.spider)
+        return request
+
+    def request_failed(self, failure):
+        ## download error or dropped by a downloader middleware (IgnoreRequest)
+        request = failure.request
+        self.request_done(request, self.spider)
+        self.stats.inc_value('frontier/failed', spider=self.spider)
+        errback = request.meta.get('frontier_errback')
+        if errback:
+            return getattr(self.spider, errback)(failure)
+        return failure
+
+    def request_done(self, request, spider):
+        ## parsed (all new requests of the callback are enqueued, see FrontierAckMiddleware) or failed
+        request_id = request.meta.get('frontier_id')
+        if request_id is not None:
+            self.frontier.ack(request_id)
+
+    def spider_idle(self, spider):
+        ## other workers may still add requests or die with leased ones: wait for them
+        if self.frontier.leased() > 0:
+            raise DontCloseSpider
+        if self.frontier.clear_fingerprints_if_drained():
+            logging.info("Frontier of %s drained, fingerprints removed for the next run", spider.name)
+
+
+class FrontierAckMiddleware(object):
+    '''
+    Spider middleware acknowledging the requests of the DistributedScheduler when all output
+    of their callback (new requests and items) is consumed, or when the callback failed.
+    Does nothing for requests of other schedulers.
+    '''
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def done(self, response, spider):
+        if 'frontier_id' in response.meta:
+            self.crawler.signals.send_catch_log(signal=request_done, request=response.request, spider=spider)
+
+    def process_spider_output(self, response, result, spider):
+        for output in result:
+            yield output
+        self.done(response, spider)
+
+    async def process_spider_output_async(self, response, result, spider):
+        async for output in result:
+            yield output
+        self.done(response, spider)
+
+    def process_spider_exception(self, response, exception, spider):
+        self.done(response, spider)
+
+
+if __name__ == '__main__':
+    from .settings import FRONTIER_URL
+
+    parser = argparse.ArgumentParser(description='Show or clear the distributed frontier of a spider')
+    parser.add_argument('command', choices=('status', 'clear'))
+    parser.add_argument('spider', help='spider name, e.g. heise')
+    parser.add_argument('--url', default=os.environ.get('FRONTIER_URL', FRONTIER_URL))
+    args = parser.parse_args()
+
+    frontier = open_frontier(args.url, args.spider)
+    if args.command == 'clear':
+        frontier.clear()
+    print("%s: %d requests waiting, %d leased" % (args.spider, frontier.waiting(), frontier.leased()))
+    frontier.close()
@@ -5,9 +5,28 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
 
+import sys
+
 import scrapy
 
+# fields whose values repeat in many articles (news site, author names, departments in the keywords):
+# their strings are interned, all items in flight share one string object per value
+interned_fields = ('news_site', 'authors', 'keywords')
+
+
+def intern_value(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, list):
+        return [sys.intern(v) if isinstance(v, str) else v for v in value]
+    return value
+
+
 class ArticleItem(scrapy.Item):
+    '''
+    Scraped article. Values set with item[...] are compacted: the strings of interned_fields are interned and an
+    intro equal to the description (or the other way round) is stored as the same string object.
+    '''
     crawl_time = scrapy.Field()     # datetime.now()
     short_url = scrapy.Field()      # String 'https://taz.de/!5642421/'
     long_url = scrapy.Field()       # String 'https://taz.de/Machtkampf-in-Bolivien/!5642421/'
@@ -16,19 +35,32 @@ class ArticleItem(scrapy.Item):
     title = scrapy.Field()          # String
     authors = scrapy.Field()        # List(String)
     description = scrapy.Field()    # String: Teaser for article, sometimes same as lead/intro
-    intro = scrapy.Field ()         # String: Lead/intro, sometimes same as description/teaser
+    intro = scrapy.Field()          # String: Lead/intro, sometimes same as description/teaser
     text = scrapy.Field()           # String
 
     keywords = scrapy.Field()       # List(String)  - should not contain newssite
     published_time = scrapy.Field() # datetime or None
     image_links = scrapy.Field()    # List(String)
     links = scrapy.Field()          # List(String)
+    content_hash = scrapy.Field()   # String: utils.content_hash of title and text, set by MongoPipeline
+    cluster_id = scrapy.Field()     # String: cluster of near-duplicate texts, set by NearDuplicatePipeline
+    near_duplicate = scrapy.Field() # float: estimated similarity to the first article of the cluster, if not the first
+
+    def __setitem__(self, key, value):
+        if key in interned_fields:
+            value = intern_value(value)
+        elif key == 'intro' or key == 'description':
+            other = self.get('description' if key == 'intro' else 'intro')
+            if other is not None and other is not value and other == value:
+                value = other
+        super(ArticleItem, self).__setitem__(key, value)
 
     def __repr__(self):
         """only print out title after exiting the pipeline"""
         # return repr({"title": self["title"]})
         return ""
 
+
 class LogItem(scrapy.Item):
     log_time = scrapy.Field()   # datetime.now()
     url = scrapy.Field()        # String 'https://taz.de/!5642421/'
@@ -36,6 +68,12 @@ class LogItem(scrapy.Item):
     property = scrapy.Field()   # String: text, title, keywords, ...
     level = scrapy.Field()      # String: warning, info
 
+class RevisionItem(scrapy.Item):
+    short_url = scrapy.Field()  # String 'https://taz.de/!5642421/'
+    news_site = scrapy.Field()  # String: taz, sz, heise, postillon, golem
+    changes = scrapy.Field()    # dict: re-crawled fields of the article, content_hash and updated_time
+    revision = scrapy.Field()   # dict: content_hash, title and crawl_time of the replaced version
+
 
 
 
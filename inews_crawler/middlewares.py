@@ -5,7 +5,19 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.http import HtmlResponse, Request
+
+from .db_pool import DbThreadPool
 
 
 class LetsSpiderMiddleware(object):
@@ -101,3 +113,318 @@ class LetsDownloaderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class BrowserPool(object):
+    '''
+    Warm headless browser sessions, shared by the worker threads of BrowserPoolDownloaderMiddleware.
+    A browser is quit and replaced after max_pages pages, so long sessions do not pile up memory.
+    '''
+
+    def __init__(self, size=2, max_pages=50, driver='Chromium', page_timeout=20):
+        self.size = size
+        self.max_pages = max_pages
+        self.driver = driver
+        self.page_timeout = page_timeout
+        self.idle = queue.LifoQueue()   # most recently used browser first
+        self.pages = {}                 # browser -> number of rendered pages
+        self.lock = threading.Lock()
+        self.opening = 0
+        self.started = 0
+        self.recycled = 0
+
+    def start_browser(self):
+        '''
+        Start a headless Chrome/Chromium or Firefox, depending on driver
+
+        Returns
+        -------
+        selenium webdriver
+        '''
+        # selenium is only needed if a spider requests browser rendering
+        from selenium import webdriver
+        if self.driver == 'Firefox':
+            options = webdriver.FirefoxOptions()
+            options.add_argument('--headless')
+            browser = webdriver.Firefox(options=options)
+        else:  # Chrome driver
+            options = webdriver.ChromeOptions()
+            options.add_argument('--headless')
+            browser = webdriver.Chrome(options=options)
+        browser.set_page_load_timeout(self.page_timeout)
+        return browser
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            start = len(self.pages) + self.opening < self.size
+            if start:
+                self.opening += 1
+        if not start:
+            return self.idle.get()
+        try:
+            browser = self.start_browser()
+        finally:
+            with self.lock:
+                self.opening -= 1
+        with self.lock:
+            self.pages[browser] = 0
+            self.started += 1
+        return browser
+
+    def release(self, browser, failed=False):
+        with self.lock:
+            self.pages[browser] += 1
+            recycle = failed or self.pages[browser] >= self.max_pages
+        if recycle:
+            self.quit(browser)
+            self.recycled += 1
+        else:
+            self.idle.put(browser)
+
+    def quit(self, browser):
+        with self.lock:
+            self.pages.pop(browser, None)
+        try:
+            browser.quit()
+        except Exception as e:
+            logging.warning("Cannot quit browser: %s", e)
+
+    def render(self, url, actions=None):
+        '''
+        Load url in a browser of the pool, blocking: called in a worker thread
+
+        Parameters
+        ----------
+        url:
+            url of the page
+        actions:
+            optional function(driver) called after the page is loaded, e.g. to click or wait for elements
+
+        Returns
+        -------
+        (current url, page source) of the rendered page
+        '''
+        browser = self.acquire()
+        try:
+            browser.get(url)
+            if actions is not None:
+                actions(browser)
+            result = (browser.current_url, browser.page_source)
+        except Exception:
+            self.release(browser, failed=True)   # the session may be broken, start a new one next time
+            raise
+        self.release(browser)
+        return result
+
+    def close(self):
+        while True:
+            try:
+                browser = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            self.quit(browser)
+
+
+class BrowserPoolDownloaderMiddleware(object):
+    '''
+    Renders requests with request.meta['browser'] set in a headless browser instead of downloading them.
+
+    The browsers are kept warm in a BrowserPool and used in worker threads, so the reactor keeps downloading
+    while pages are rendered, and up to BROWSER_POOL_SIZE pages are rendered concurrently.
+    request.meta['browser_actions'] can hold a function(driver), which is called in the worker thread
+    after the page is loaded. The callback gets an HtmlResponse of the page source.
+    '''
+
+    def __init__(self, stats, pool_size=2, max_pages=50, driver='Chromium', page_timeout=20):
+        self.stats = stats
+        self.browsers = BrowserPool(pool_size, max_pages, driver, page_timeout)
+        # one worker thread per browser
+        self.threads = DbThreadPool(pool_size, name='inews-browser')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        s = cls(crawler.stats,
+                pool_size=settings.getint('BROWSER_POOL_SIZE', 2),
+                max_pages=settings.getint('BROWSER_MAX_PAGES', 50),
+                driver=settings.get('BROWSER_DRIVER', 'Chromium'),
+                page_timeout=settings.getint('BROWSER_PAGE_TIMEOUT', 20))
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        if not request.meta.get('browser'):
+            return None
+        d = self.threads.run(self.browsers.render, request.url, request.meta.get('browser_actions'))
+        d.addCallback(self.build_response, request, spider)
+        return d
+
+    def build_response(self, result, request, spider):
+        url, page_source = result
+        self.stats.inc_value('browser/pages', spider=spider)
+        return HtmlResponse(url=url, body=page_source, encoding='utf-8', request=request)
+
+    def spider_closed(self, spider):
+        self.stats.set_value('browser/started', self.browsers.started, spider=spider)
+        self.stats.set_value('browser/recycled', self.browsers.recycled, spider=spider)
+        if not self.browsers.started:
+            return None
+        d = self.threads.run(self.browsers.close)
+        d.addBoth(lambda _: self.threads.stop())
+        return d
+
+
+class ConditionalRequestMiddleware(object):
+    '''
+    Skips category and archive pages (requests with request.meta['conditional'] set) that did not change
+    since the last finished crawl.
+
+    ETag, Last-Modified and a hash of the body of every such page are kept in CONDITIONAL_CACHE_PATH.
+    The requests are sent with If-None-Match/If-Modified-Since; a 304 response or a body with the saved hash
+    is dropped (IgnoreRequest), so its teasers are neither parsed nor checked against the database.
+    The cache is only saved when the spider finished, an aborted crawl does not mark pages as done.
+    A page is not saved either if its callback, one of the requests found on it (ConditionalPageMiddleware)
+    or one of their items failed: the next crawl parses it again.
+    '''
+
+    def __init__(self, stats, path):
+        self.stats = stats
+        self.path = path
+        self.pages = {}     # url -> {'etag', 'last_modified', 'hash', 'size'}
+        self.updates = {}
+        self.failed = set() # urls of the pages that are not saved
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('CONDITIONAL_CACHE_ENABLED'):
+            raise NotConfigured
+        s = cls(crawler.stats, crawler.settings.get('CONDITIONAL_CACHE_PATH', 'conditional_cache.json'))
+        crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(s.spider_error, signal=signals.spider_error)
+        crawler.signals.connect(s.item_error, signal=signals.item_error)
+        return s
+
+    def spider_opened(self, spider):
+        self.pages = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def page_failed(self, request):
+        # the page of the request (if it is conditional) and the pages it was found on
+        if request.meta.get('conditional'):
+            self.failed.add(request.url)
+        self.failed.update(request.meta.get('conditional_pages', ()))
+
+    def spider_error(self, failure, response, spider):
+        self.page_failed(response)
+
+    def item_error(self, item, response, spider, failure):
+        self.page_failed(response)
+
+    def process_request(self, request, spider):
+        if not request.meta.get('conditional'):
+            return None
+        self.stats.inc_value('conditional/requests', spider=spider)
+        cached = self.pages.get(request.url)
+        if cached:
+            if cached.get('etag'):
+                request.headers.setdefault('If-None-Match', cached['etag'])
+            if cached.get('last_modified'):
+                request.headers.setdefault('If-Modified-Since', cached['last_modified'])
+        return None
+
+    def process_response(self, request, response, spider):
+        if not request.meta.get('conditional'):
+            if response.status == 429 or response.status >= 500:
+                self.page_failed(request)
+            return response
+        cached = self.pages.get(request.url)
+        if response.status == 304 and cached:
+            self.stats.inc_value('conditional/not_modified', spider=spider)
+            self.stats.inc_value('conditional/bytes_saved', cached.get('size', 0), spider=spider)
+            raise IgnoreRequest('Not modified: %s' % request.url)
+        if response.status != 200:
+            return response
+
+        body_hash = hashlib.blake2b(response.body, digest_size=16).hexdigest()
+        self.updates[request.url] = {
+            'etag': response.headers.get('ETag', b'').decode('latin-1') or None,
+            'last_modified': response.headers.get('Last-Modified', b'').decode('latin-1') or None,
+            'hash': body_hash,
+            'size': len(response.body),
+        }
+        if cached and cached.get('hash') == body_hash:
+            self.stats.inc_value('conditional/unchanged', spider=spider)
+            raise IgnoreRequest('Unchanged: %s' % request.url)
+        self.stats.inc_value('conditional/changed', spider=spider)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        # download errors, also those that are retried; requests dropped on purpose (robots.txt) do not count
+        if not isinstance(exception, IgnoreRequest):
+            self.page_failed(request)
+        return None
+
+    def spider_closed(self, spider, reason):
+        requests = self.stats.get_value('conditional/requests', 0, spider=spider)
+        if requests:
+            hits = self.stats.get_value('conditional/not_modified', 0, spider=spider) \
+                   + self.stats.get_value('conditional/unchanged', 0, spider=spider)
+            self.stats.set_value('conditional/hit_rate', round(hits / requests, 3), spider=spider)
+        updates = dict((url, page) for url, page in self.updates.items() if url not in self.failed)
+        self.stats.set_value('conditional/not_saved', len(self.updates) - len(updates), spider=spider)
+        if reason != 'finished' or not updates:
+            return
+        # other spiders (run_all, other processes) may have saved their pages since spider_opened:
+        # read, merge and write under a lock file
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.pages = self.load()
+            self.pages.update(updates)
+            # write and rename, so an interrupted run never leaves a broken cache
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self.pages, f)
+            os.replace(tmp_path, self.path)
+
+
+class ConditionalPageMiddleware(object):
+    '''
+    Spider middleware of the ConditionalRequestMiddleware: marks the requests found on a conditional page,
+    and on the pages they lead to, with the urls of these pages in request.meta['conditional_pages'].
+    '''
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('CONDITIONAL_CACHE_ENABLED'):
+            raise NotConfigured
+        return cls()
+
+    def conditional_pages(self, response):
+        pages = response.meta.get('conditional_pages', [])
+        if response.meta.get('conditional'):
+            pages = pages + [response.url]
+        return pages
+
+    def process_spider_output(self, response, result, spider):
+        pages = self.conditional_pages(response)
+        for output in result:
+            if pages and isinstance(output, Request):
+                output.meta['conditional_pages'] = pages
+            yield output
+
+    async def process_spider_output_async(self, response, result, spider):
+        pages = self.conditional_pages(response)
+        async for output in result:
+            if pages and isinstance(output, Request):
+                output.meta['conditional_pages'] = pages
+            yield output
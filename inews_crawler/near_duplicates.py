@@ -0,0 +1,499 @@
+# Near-duplicate detection of article texts with MinHash signatures and an LSH index
+import argparse
+import bisect
+import fcntl
+import hashlib
+import itertools
+import logging
+import mmap
+import operator
+import os
+import struct
+import sys
+import tempfile
+import zlib
+from array import array
+
+MAGIC = b'INND'
+VERSION = 1
+# magic, version, signature size, number of bands, number of articles
+HEADER = struct.Struct('<4sIIIQ')
+# url hash and cluster of an article appended to the log of the index file, followed by its signature
+LOG_RECORD = struct.Struct('<qq')
+min_log_size = 10000        # the log is merged into the index file when it has more articles than this
+
+shingle_size = 5            # words per shingle
+max_word_ids = 500000       # cached word hashes, the cache is cleared when it is full
+lowest = -(1 << 63)         # range of the shingle hashes (hash of a tuple of ints)
+hash_range = 1 << 64
+
+
+class WordIds(dict):
+    # crc32 of the words, computed once per word (a dict lookup is cheaper than hashing the word again)
+    def __missing__(self, word):
+        word_id = self[word] = zlib.crc32(word.encode('utf-8'))
+        return word_id
+
+
+word_ids = WordIds()
+
+
+def shingle_hashes(text):
+    '''
+    Hashes of the word shingles of a text, lowercased and split at whitespace
+
+    Returns
+    -------
+    iterator of ints, empty for an empty text. Texts shorter than a shingle are one shingle.
+    '''
+    if len(word_ids) > max_word_ids:
+        word_ids.clear()
+    ids = list(map(word_ids.__getitem__, text.lower().split()))
+    if len(ids) < shingle_size:
+        return iter([hash(tuple(ids))] if ids else [])
+    # the hash of a tuple of ints does not depend on PYTHONHASHSEED, the signatures can be saved
+    return map(hash, zip(*[ids[i:] for i in range(shingle_size)]))
+
+
+def signature(text, size=64):
+    '''
+    One permutation MinHash signature of a text: the shingle hashes are distributed to size bins
+    by their lowest bits, every bin keeps 8 bits of its minimum (b-bit MinHash).
+
+    The bins are filled from the smallest hashes, so only the hashes below a cutoff are sorted
+    (all hashes if that does not fill all bins). Empty bins of short texts are filled from the next bin.
+
+    Parameters
+    ----------
+    text:
+        article text
+    size:
+        number of bins
+
+    Returns
+    -------
+    bytes of length size, None for an empty text
+    '''
+    hashes = list(shingle_hashes(text))
+    if not hashes:
+        return None
+    # about size * ln(size) of the smallest hashes fill all bins, the others are only sorted if they do not
+    cutoff = lowest + hash_range * min(len(hashes), 8 * size) // len(hashes)
+    minimums = bin_minimums(sorted(filter(cutoff.__gt__, hashes)), size)
+    if len(minimums) < size:
+        minimums = {**bin_minimums(sorted(filter(cutoff.__le__, hashes)), size), **minimums}
+    bins = [(minimums[b] // size) & 0xFF if b in minimums else None for b in range(size)]
+    if len(minimums) < size:
+        # densification: an empty bin takes the value of the next filled bin, shifted by the distance
+        for i in range(size):
+            if bins[i] is None:
+                distance = 1
+                while bins[(i + distance) % size] is None:
+                    distance += 1
+                bins[i] = (bins[(i + distance) % size] + 31 * distance) & 0xFF
+    return bytes(bins)
+
+
+def bin_minimums(ordered_hashes, size):
+    # bin -> smallest hash of the bin, the dict keeps the last value of each bin of the reversed hashes
+    ordered_hashes.reverse()
+    return dict(zip(map(operator.mod, ordered_hashes, itertools.repeat(size)), ordered_hashes))
+
+
+def similarity(signature_a, signature_b):
+    '''
+    Estimated Jaccard similarity of the shingles of two texts
+
+    Returns
+    -------
+    float from 0 to 1, corrected for the 1/256 chance of equal 8 bit values
+    '''
+    equal = sum(map(operator.eq, signature_a, signature_b)) / len(signature_a)
+    return max(0.0, (equal - 1 / 256) / (1 - 1 / 256))
+
+
+def url_hash(url):
+    # 64 bit id of an article url, also the cluster id of the first article of a cluster
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+def cluster_name(cluster):
+    # cluster id as saved in the articles
+    return '%016x' % (cluster & 0xFFFFFFFFFFFFFFFF)
+
+
+def aligned(offset):
+    return (offset + 7) // 8 * 8
+
+
+class NearDuplicateIndex(object):
+    '''
+    LSH index of the MinHash signatures of the crawled articles.
+
+    The signature is split into bands, an article is a candidate if any band is equal;
+    the candidates are compared by their full signature. The articles of the index file are
+    memory-mapped (sorted band keys, searched with bisect), so opening needs no parsing and the pages
+    are shared by the spider processes. Articles added while crawling are kept in dicts and appended
+    to a log file by save(), the log is merged into the index file when it gets too long.
+    '''
+
+    def __init__(self, path, size=64, bands=16):
+        if size % bands or size // bands not in (4, 8):
+            raise ValueError("The signature size must be 4 or 8 times the number of bands")
+        self.path = path
+        self.size = size
+        self.bands = bands
+        self.rows = size // bands
+        self.key_type = 'I' if self.rows == 4 else 'Q'
+        self.saved = 0       # articles in the file
+        self.logged = 0      # articles of the log of the file, the following articles were added by this process
+        self._file = None
+        self._mmap = None
+        self._views = []
+        self.url_hashes = self.clusters = self.signatures = None
+        self.band_keys = self.band_ids = []
+        self.new_url_hashes = array('q')
+        self.new_clusters = array('q')
+        self.new_signatures = bytearray()
+        self.new_bands = [dict() for _ in range(bands)]     # band key -> list of article numbers
+
+    @classmethod
+    def open(cls, path, size=64, bands=16):
+        '''
+        Open an index file, or an empty index if it does not exist
+
+        Returns
+        -------
+        NearDuplicateIndex
+        '''
+        index = cls(path, size, bands)
+        if os.path.exists(path):
+            index.map_file()
+        index.read_log()
+        return index
+
+    def map_file(self):
+        self._file = open(self.path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size, bands, count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("Not a near-duplicate index file: %s" % self.path)
+        if (size, bands) != (self.size, self.bands):
+            self.close()
+            raise ValueError("Near-duplicate index %s has %d bands of a signature of %d, expected %d of %d"
+                             % (self.path, bands, size, self.bands, self.size))
+        self.saved = count
+        view = memoryview(self._mmap)
+        offset = HEADER.size
+        self.url_hashes = view[offset:offset + 8 * count].cast('q')
+        offset += 8 * count
+        self.clusters = view[offset:offset + 8 * count].cast('q')
+        offset += 8 * count
+        self.signatures = view[offset:offset + size * count]
+        offset = aligned(offset + size * count)
+        key_size = array(self.key_type).itemsize
+        self.band_keys, self.band_ids = [], []
+        for _ in range(bands):
+            self.band_keys.append(view[offset:offset + key_size * count].cast(self.key_type))
+            offset = aligned(offset + key_size * count)
+            self.band_ids.append(view[offset:offset + 4 * count].cast('I'))
+            offset = aligned(offset + 4 * count)
+        self._views = [view, self.url_hashes, self.clusters, self.signatures] + self.band_keys + self.band_ids
+
+    def __len__(self):
+        return self.saved + len(self.new_url_hashes)
+
+    def get_signature(self, number):
+        if number < self.saved:
+            return self.signatures[number * self.size:(number + 1) * self.size]
+        start = (number - self.saved) * self.size
+        return self.new_signatures[start:start + self.size]
+
+    def get_url_hash(self, number):
+        return self.url_hashes[number] if number < self.saved else self.new_url_hashes[number - self.saved]
+
+    def get_cluster(self, number):
+        return self.clusters[number] if number < self.saved else self.new_clusters[number - self.saved]
+
+    def band_key(self, signature, band):
+        return int.from_bytes(signature[band * self.rows:(band + 1) * self.rows], sys.byteorder)
+
+    def candidates(self, signature):
+        # numbers of the articles with at least one equal band
+        found = set()
+        for band in range(self.bands):
+            key = self.band_key(signature, band)
+            if self.saved:
+                keys = self.band_keys[band]
+                position = bisect.bisect_left(keys, key)
+                while position < self.saved and keys[position] == key:
+                    found.add(self.band_ids[band][position])
+                    position += 1
+            found.update(self.new_bands[band].get(key, ()))
+        return found
+
+    def query(self, signature, own_url_hash=None):
+        '''
+        Most similar article of the index
+
+        Parameters
+        ----------
+        signature:
+            see signature()
+        own_url_hash:
+            url_hash of the queried article, its own entry is not compared
+
+        Returns
+        -------
+        (article number, estimated similarity, number of the own entry), the first two are (None, 0.0)
+        if there is no other candidate, the last is None if the article is not in the index
+        '''
+        best, best_similarity, own = None, 0.0, None
+        for number in self.candidates(signature):
+            if self.get_url_hash(number) == own_url_hash:
+                own = number
+                continue
+            candidate_similarity = similarity(signature, self.get_signature(number))
+            if candidate_similarity > best_similarity:
+                best, best_similarity = number, candidate_similarity
+        return best, best_similarity, own
+
+    def add(self, signature, article_url_hash, cluster):
+        number = len(self)
+        self.new_url_hashes.append(article_url_hash)
+        self.new_clusters.append(cluster)
+        self.new_signatures += signature
+        for band in range(self.bands):
+            self.new_bands[band].setdefault(self.band_key(signature, band), []).append(number)
+        return number
+
+    def check(self, text, url, threshold=0.8):
+        '''
+        Check an article against the index and add it
+
+        Parameters
+        ----------
+        text:
+            article text
+        url:
+            short_url of the article
+        threshold:
+            minimum estimated Jaccard similarity of the shingles of a near-duplicate
+
+        Returns
+        -------
+        (cluster id, similarity): the cluster of the most similar article and the similarity if it is
+        a near-duplicate, otherwise a new cluster (named after the article) and None.
+        (None, None) for an empty text. An article that is already in the index (re-crawled url)
+        is not added again and keeps its cluster.
+        '''
+        article_signature = signature(text, self.size)
+        if article_signature is None:
+            return None, None
+        article_url_hash = url_hash(url)
+        number, article_similarity, own = self.query(article_signature, article_url_hash)
+        if own is not None:
+            cluster = self.get_cluster(own)
+            if cluster != article_url_hash and number is not None and article_similarity >= threshold:
+                return cluster_name(cluster), article_similarity
+            return cluster_name(cluster), None
+        if number is not None and article_similarity >= threshold:
+            cluster = self.get_cluster(number)
+            self.add(article_signature, article_url_hash, cluster)
+            return cluster_name(cluster), article_similarity
+        self.add(article_signature, article_url_hash, article_url_hash)
+        return cluster_name(article_url_hash), None
+
+    def near_duplicate_url_hashes(self):
+        '''
+        Url hashes of the articles that are near-duplicates of an article of another cluster
+
+        Returns
+        -------
+        set of the url hashes (see url_hash)
+        '''
+        return set(self.get_url_hash(number) for number in range(len(self))
+                   if self.get_cluster(number) != self.get_url_hash(number))
+
+    def new_articles(self, start=0):
+        # (url hash, cluster, signature) of the articles added to the dicts, from the start-th one
+        return [(self.new_url_hashes[i], self.new_clusters[i], bytes(self.get_signature(self.saved + i)))
+                for i in range(start, len(self.new_url_hashes))]
+
+    def read_log(self):
+        # articles appended to the log of the index file since its last compaction
+        record_size = LOG_RECORD.size + self.size
+        if not os.path.exists(self.path + '.log'):
+            return
+        with open(self.path + '.log', 'rb') as f:
+            data = f.read()
+        for offset in range(0, len(data) // record_size * record_size, record_size):
+            article_url_hash, cluster = LOG_RECORD.unpack_from(data, offset)
+            self.add(data[offset + LOG_RECORD.size:offset + record_size], article_url_hash, cluster)
+        self.logged = len(self.new_url_hashes)
+
+    def save(self, compact_ratio=0.25):
+        '''
+        Append the articles added by this process to the log of the index file,
+        the log is merged into the file when it has more than compact_ratio * articles of the file.
+
+        Runs under a file lock, the articles saved by other spider processes in the meantime are kept.
+        '''
+        # check may add articles in the reactor thread meanwhile, they are saved the next time
+        start = self.logged
+        new_articles = self.new_articles(start)
+        if not new_articles:
+            return
+        record_size = LOG_RECORD.size + self.size
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.path + '.log', 'ab') as log:
+                # a record cut off by a killed process would shift all following records
+                log.truncate(log.tell() // record_size * record_size)
+                log.write(b''.join(LOG_RECORD.pack(a, c) + s for a, c, s in new_articles))
+                logged = log.tell() // record_size
+            self.logged = start + len(new_articles)
+            saved = 0
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    saved = HEADER.unpack(f.read(HEADER.size))[4]
+            logging.info("Saved %d new articles to the near-duplicate index %s", len(new_articles), self.path)
+            if logged > compact_ratio * saved + min_log_size:
+                self.compact()
+
+    def compact(self):
+        # merge the log into the index file (call with the lock held), processes that still
+        # have the old file mapped keep reading the old version
+        current = NearDuplicateIndex.open(self.path, self.size, self.bands)
+        try:
+            url_hashes, clusters = array('q'), array('q')
+            signatures = bytearray()
+            if current.saved:
+                url_hashes.frombytes(current.url_hashes)
+                clusters.frombytes(current.clusters)
+                signatures += current.signatures
+            for article_url_hash, cluster, article_signature in current.new_articles():
+                url_hashes.append(article_url_hash)
+                clusters.append(cluster)
+                signatures += article_signature
+            write_index(self.path, self.size, self.bands, url_hashes, clusters, bytes(signatures))
+            with open(self.path + '.log', 'wb'):
+                pass
+            logging.info("Compacted the near-duplicate index %s: %d articles", self.path, len(url_hashes))
+        finally:
+            current.close()
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self.url_hashes = self.clusters = self.signatures = None
+        self.band_keys = self.band_ids = []
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+    @classmethod
+    def rebuild(cls, collection, path, size=64, bands=16, threshold=0.8, batch_size=1000):
+        '''
+        Build the index from the texts of the article collection, in the order the articles were saved,
+        so the first article of a cluster is the one crawled first.
+
+        Parameters
+        ----------
+        collection:
+            pymongo collection containing the articles
+        path:
+            index file, an existing file is replaced
+        size, bands, threshold:
+            see NearDuplicateIndex and check()
+        batch_size:
+            number of documents fetched per cursor round-trip
+
+        Returns
+        -------
+        the rebuilt NearDuplicateIndex
+        '''
+        with open(path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for stale in (path, path + '.log'):
+                if os.path.exists(stale):
+                    os.remove(stale)
+        index = cls(path, size, bands)
+        near_duplicates = 0
+        documents = collection.find({}, {"short_url": 1, "text": 1, "_id": 0}, batch_size=batch_size).sort('_id', 1)
+        for i, doc in enumerate(documents, 1):
+            if doc.get('short_url') and doc.get('text'):
+                near_duplicates += index.check(doc['text'], doc['short_url'], threshold)[1] is not None
+            if len(index.new_url_hashes) >= max(100000, index.saved // 2):
+                index = index.merged()
+            if i % 100000 == 0:
+                logging.info("Near-duplicate index: %d articles read", i)
+        index = index.merged()
+        logging.info("Rebuilt near-duplicate index %s with %d articles, %d near-duplicates",
+                     path, len(index), near_duplicates)
+        return index
+
+    def merged(self):
+        # save and reopen, the saved articles are memory-mapped instead of kept in dicts
+        self.save(compact_ratio=0)
+        self.close()
+        return NearDuplicateIndex.open(self.path, self.size, self.bands)
+
+
+def write_index(path, size, bands, url_hashes, clusters, signatures):
+    '''
+    Write an index file with the band keys of all articles sorted, atomically replacing path
+
+    Parameters
+    ----------
+    url_hashes, clusters:
+        array('q') of the articles
+    signatures:
+        bytes, the signatures of the articles one after the other
+    '''
+    count = len(url_hashes)
+    index = NearDuplicateIndex(path, size, bands)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.near_duplicates', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, size, bands, count))
+        f.write(url_hashes.tobytes())
+        f.write(clusters.tobytes())
+        f.write(signatures)
+        # the band keys are the native ints of the rows of a band (see band_key)
+        all_keys = memoryview(signatures).cast(index.key_type)
+        for band in range(bands):
+            keys = all_keys[band::bands].tolist()
+            order = sorted(range(count), key=keys.__getitem__)
+            for values in (array(index.key_type, map(keys.__getitem__, order)), array('I', order)):
+                f.write(b'\0' * (aligned(f.tell()) - f.tell()))
+                f.write(values.tobytes())
+        f.write(b'\0' * (aligned(f.tell()) - f.tell()))
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    from . import connection as mongo_connection
+    from .settings import ARTICLE_COLLECTION_NAME, MONGO_DATABASE, MONGO_URI, NEAR_DUPLICATE_PATH, \
+        NEAR_DUPLICATE_THRESHOLD
+
+    parser = argparse.ArgumentParser(description='Show or rebuild the near-duplicate index')
+    parser.add_argument('--path', default=NEAR_DUPLICATE_PATH)
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the index from the article collection')
+    args = parser.parse_args()
+
+    if args.rebuild:
+        logging.basicConfig(level=logging.INFO)
+        connection = mongo_connection.acquire(MONGO_URI, MONGO_DATABASE)
+        index = NearDuplicateIndex.rebuild(connection[ARTICLE_COLLECTION_NAME], args.path,
+                                           threshold=NEAR_DUPLICATE_THRESHOLD)
+        mongo_connection.release(connection)
+    else:
+        index = NearDuplicateIndex.open(args.path)
+    clusters = set(index.get_cluster(number) for number in range(len(index)))
+    print("%s: %d articles in %d clusters, %d near-duplicates"
+          % (args.path, len(index), len(clusters), len(index) - len(clusters)))
+    index.close()
@@ -0,0 +1,100 @@
+# Normalisation of extracted article texts: Unicode NFC, invisible characters, whitespace, punctuation spacing
+# and German quotes in a fixed number of passes over the text, independent of the number of rules
+#
+# usage:
+#     normalise('Die  Straße ,  sagte er .')             -> 'Die Straße, sagte er.'
+#     normalise_batch(['Absatz  eins .', ' zwei ! '])   -> ['Absatz eins.', 'zwei!']
+import re
+import unicodedata
+
+# removed: soft hyphen, zero width space, non-joiner and joiner, word joiner, byte order mark
+invisible_characters = '\u00ad\u200b\u200c\u200d\u2060\ufeff'
+
+# replaced: quotes, that are not used in German texts, by their German counterparts
+# (English quotes “…” are replaced by german_quotes, the English opening quote is the German closing quote)
+quote_replacements = (
+    ('‟', '„'),  # double high-reversed-9 -> „
+    ('‛', '‚'),  # single high-reversed-9 -> ‚
+    ('\uff02', '"'),  # fullwidth quotation mark
+    ('´', '’'),  # acute accent used as apostrophe (gibt´s) -> ’
+)
+
+# no whitespace before these punctuation marks
+punctuation_spacing = re.compile(' (?=[,.:;!?%])')
+
+# English opening quote: at the start of the text or a paragraph, after whitespace or an opening bracket,
+# followed by a non-space character
+english_opening_quote = re.compile('(?<![^\\s(\\[\x00])[“”](?=\\S)')
+
+# separator of the texts in normalise_batch: neither whitespace (str.split) nor changed by the normalisation
+batch_separator = '\x00'
+
+
+def german_quotes(text):
+    '''
+    English double quotes “…” (and ”…”) to German quotes „…“.
+    The quotes are only changed if the text contains ”, which is not used in German texts:
+    texts with German quotes „…“ are kept as they are.
+    '''
+    if '”' not in text:
+        return text
+    return english_opening_quote.sub('„', text).replace('”', '“')
+
+
+def normalise(text):
+    '''
+    Normalise an extracted text:
+
+    - Unicode NFC (combining characters composed, e.g. u + ¨ -> ü)
+    - soft hyphens and zero width characters removed
+    - whitespace (including non-breaking and other Unicode spaces, line breaks) collapsed to single spaces, stripped
+    - no space before , . : ; ! ? %
+    - German quotes „…“ instead of English quotes “…”, see german_quotes
+
+    Every step is a single pass over the text (str.split/join, one compiled regex for all punctuation marks),
+    the rare replacements only run if the text contains the characters.
+
+    Parameters
+    ----------
+    text:
+        A string
+
+    Returns
+    -------
+    the normalised string
+    '''
+    if not text:
+        return ''
+    if not text.isascii():
+        if not unicodedata.is_normalized('NFC', text):
+            text = unicodedata.normalize('NFC', text)
+        for character in invisible_characters:
+            if character in text:
+                text = text.replace(character, '')
+        for character, replacement in quote_replacements:
+            if character in text:
+                text = text.replace(character, replacement)
+    text = punctuation_spacing.sub('', ' '.join(text.split()))
+    return german_quotes(text)
+
+
+def normalise_batch(texts):
+    '''
+    Normalise a list of texts (e.g. the paragraphs of an article) at once:
+    the texts are joined and normalised in one call of normalise, the result is split again.
+
+    Parameters
+    ----------
+    texts:
+        list of strings (None counts as '')
+
+    Returns
+    -------
+    list of the normalised strings, in the same order
+    '''
+    texts = [text or '' for text in texts]
+    joined = batch_separator.join(texts)
+    if joined.count(batch_separator) != len(texts) - 1:
+        # the separator is part of a text
+        return [normalise(text) for text in texts]
+    return [text.strip(' ') for text in normalise(joined).split(batch_separator)]
@@ -6,53 +6,526 @@
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
 
+import json
 import logging
+import os
+import threading
 from datetime import datetime
 
-import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from scrapy.exceptions import DropItem, NotConfigured
+from twisted.internet import defer, task
 
-from .utils import utils
-from inews_crawler.items import ArticleItem, LogItem
+try:
+    import elasticsearch
+    from elasticsearch import helpers as elasticsearch_helpers
+    from elasticsearch.serializer import JSONSerializer
+except ImportError:
+    elasticsearch = None   # optional, only needed for ElasticsearchPipeline
+
+from .utils import utils, db_pool
+from . import connection as mongo_connection
+from . import export
+from inews_crawler.items import ArticleItem
 from .settings import ARTICLE_COLLECTION_NAME, LOG_COLLECTION_NAME
 
+DUPLICATE_KEY_ERROR = 11000
+
+
+class NearDuplicatePipeline(object):
+    '''
+    Finds articles whose text is a near-duplicate of an already crawled article, also of another news site
+    (agency texts, republished articles). The articles get the cluster_id of the first article with
+    that text and the estimated similarity in near_duplicate, or are dropped with NEAR_DUPLICATE_DROP.
+    Ordered before MongoPipeline, so both fields are saved.
+    '''
+
+    def __init__(self, path, threshold=0.8, drop=False, save_interval=300, stats=None):
+        self.path = path
+        self.threshold = threshold
+        self.drop = drop
+        self.save_interval = save_interval
+        self.save_task = None
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('NEAR_DUPLICATE_ENABLED'):
+            raise NotConfigured
+        return cls(
+            path=crawler.settings.get('NEAR_DUPLICATE_PATH'),
+            threshold=crawler.settings.getfloat('NEAR_DUPLICATE_THRESHOLD', 0.8),
+            drop=crawler.settings.getbool('NEAR_DUPLICATE_DROP'),
+            save_interval=crawler.settings.getfloat('NEAR_DUPLICATE_SAVE_INTERVAL', 300),
+            stats=crawler.stats
+        )
+
+    def open_spider(self, spider):
+        ## the index may have to be rebuilt from the database
+        d = db_pool.run(utils.open_near_duplicate_index, self.path, self.threshold, self.drop)
+        d.addCallback(self.set_index)
+        return d
+
+    def set_index(self, index):
+        self.index = index
+        ## saving the new articles regularly, not only when the spider is closed
+        if self.save_interval > 0:
+            self.save_task = task.LoopingCall(self.save_index)
+            self.save_task.start(self.save_interval, now=False)
+
+    def save_index(self):
+        d = db_pool.run(utils.save_near_duplicate_index)
+        d.addErrback(lambda failure: logging.error("Saving the near-duplicate index failed: %s", failure.value))
+        return d
+
+    def close_spider(self, spider):
+        if self.save_task is not None and self.save_task.running:
+            self.save_task.stop()
+        return db_pool.run(utils.close_near_duplicate_index)
+
+    def process_item(self, item, spider):
+        ## signature and index lookup are cheap enough for the reactor thread (benchmarks/near_duplicate_benchmark.py)
+        if not isinstance(item, ArticleItem) or not item.get('text'):
+            return item
+        cluster_id, similarity = self.index.check(item['text'], item['short_url'], self.threshold)
+        item['cluster_id'] = cluster_id
+        if similarity is None:
+            return item
+        item['near_duplicate'] = round(similarity, 3)
+        self.stats.inc_value('near_duplicate/count', spider=spider)
+        logging.info("Near-duplicate (similarity %.2f) of cluster %s: %s", similarity, cluster_id, item['short_url'])
+        if self.drop:
+            utils.mark_near_duplicate_dropped(item['short_url'])
+            raise DropItem("Near-duplicate of cluster %s" % cluster_id)
+        return item
+
+
 class MongoPipeline(object):
 
     article_collection_name = ARTICLE_COLLECTION_NAME
     log_collection_name = LOG_COLLECTION_NAME
 
-    def __init__(self, mongo_uri, mongo_db):
+    def __init__(self, mongo_uri, mongo_db, url_index_enabled=True, seen_filter_path=None,
+                 seen_filter_fp_rate=0.001, seen_filter_readonly=False, buffer_size=100, flush_interval=10):
         self.mongo_uri = mongo_uri
         self.mongo_db = mongo_db
+        self.buffer_size = max(buffer_size, 1)
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.flush_task = None
+        self.url_index_enabled = url_index_enabled
+        self.seen_filter_path = seen_filter_path
+        self.seen_filter_fp_rate = seen_filter_fp_rate
+        self.seen_filter_readonly = seen_filter_readonly
 
     @classmethod
     def from_crawler(cls, crawler):
         ## pull in information from settings.py
+        seen_filter_path = None
+        if crawler.settings.getbool('SEEN_FILTER_ENABLED'):
+            seen_filter_path = crawler.settings.get('SEEN_FILTER_PATH') \
+                               or os.path.join(crawler.settings.get('JOBDIR') or '.', 'seen_urls.bloom')
         return cls(
             mongo_uri=crawler.settings.get('MONGO_URI'),
-            mongo_db=crawler.settings.get('MONGO_DATABASE')
+            mongo_db=crawler.settings.get('MONGO_DATABASE'),
+            url_index_enabled=crawler.settings.getbool('URL_INDEX_ENABLED', True),
+            seen_filter_path=seen_filter_path,
+            seen_filter_fp_rate=crawler.settings.getfloat('SEEN_FILTER_FP_RATE', 0.001),
+            seen_filter_readonly=crawler.settings.getbool('SEEN_FILTER_READONLY'),
+            buffer_size=crawler.settings.getint('MONGO_BUFFER_SIZE', 100),
+            flush_interval=crawler.settings.getfloat('MONGO_FLUSH_INTERVAL', 10)
         )
 
     def open_spider(self, spider):
         ## initializing spider
-        ## opening db connection
-        self.client = pymongo.MongoClient(self.mongo_uri)
-        self.db = self.client[self.mongo_db]
+        self.pending = set()
+        ## flushing buffered items regularly, even if the buffer is not full
+        if self.buffer_size > 1 and self.flush_interval > 0:
+            self.flush_task = task.LoopingCall(self.flush)
+            self.flush_task.start(self.flush_interval, now=False)
+        ## scrapy waits for the returned deferred before the crawl starts
+        return db_pool.run(self.open_db, spider)
+
+    def open_db(self, spider):
+        ## opening db connection (runs in a db_pool thread)
+        self.connect()
+        self.db[self.article_collection_name].create_index("short_url", unique=True)
+        ## loading known urls of the news site for the spiders' dedup checks
+        if self.url_index_enabled:
+            utils.load_url_index(utils.get_news_site(spider))
+        if self.seen_filter_path:
+            utils.open_seen_filter(self.seen_filter_path, self.seen_filter_fp_rate, self.seen_filter_readonly)
+
+    def close_spider(self, spider):
+        ## clean up when spider is closed, after all pending writes are done
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+        d = defer.DeferredList(list(self.pending))
+        d.addBoth(lambda _: utils.flush_event_log())
+        d.addBoth(lambda _: self.close_db())
+        return d
+
+    def close_db(self):
+        utils.close_seen_filter()
+        self.disconnect()
+
+    def connect(self):
+        ## connection pool shared with the dedup checks, the event log and the other spiders of the process
+        self.connection = mongo_connection.acquire(self.mongo_uri, self.mongo_db)
+        self.db = self.connection.db
+
+    def disconnect(self):
+        mongo_connection.release(self.connection)
+
+    def process_item(self, item, spider):
+        ## how to handle each post: buffer it and write the buffer in bulk
+        if isinstance(item, ArticleItem):
+            ## compared by the recrawl spider to detect updated articles
+            item['content_hash'] = utils.content_hash(item.get('title'), item.get('text'))
+        self.buffer.append(item)
+        if len(self.buffer) >= self.buffer_size:
+            ## the item is passed on when its bulk write is done (backpressure on a slow database)
+            d = self.flush()
+            d.addCallback(lambda _: item)
+            return d
+        return item
+
+    def flush(self):
+        '''
+        Write all buffered items with one unordered insert_many in a db_pool thread.
+
+        Returns
+        -------
+        Deferred firing when the items are written and logged
+        '''
+        if not self.buffer:
+            return defer.succeed(None)
+        items, self.buffer = self.buffer, []
+
+        d = db_pool.run(self.insert_items, items)
+        d.addCallback(self.log_results, items)
+        d.addErrback(lambda failure: logging.error("Bulk insert of %d posts failed: %s", len(items), failure.value))
+        self.pending.add(d)
+        d.addBoth(self.remove_pending, d)
+        return d
+
+    def remove_pending(self, result, d):
+        self.pending.discard(d)
+        return result
+
+    def insert_items(self, items):
+        '''
+        Blocking bulk insert, items rejected by the unique index on short_url are reported as duplicates.
+
+        Returns
+        -------
+        dict: position in items -> error code of all items that were not inserted
+        '''
+        failed = {}
+        try:
+            self.db[self.article_collection_name].insert_many([dict(item) for item in items], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failed[error['index']] = error['code']
+        except PyMongoError as e:
+            logging.error("Bulk insert of %d posts failed: %s", len(items), e)
+            failed = dict((i, None) for i in range(len(items)))
+        return failed
+
+    def log_results(self, failed, items):
+        ## runs on the reactor thread again, so the url index is only changed there
+        for i, item in enumerate(items):
+            if i not in failed:
+                logging.info("Post added to MongoDB: %s", item['short_url'])
+                utils.mark_url_saved(item['news_site'], item['short_url'])
+                utils.log_event(utils(), item['news_site'], item['short_url'], 'added', 'info')
+            elif failed[i] == DUPLICATE_KEY_ERROR:
+                logging.info("Duplicate not added to MongoDB: %s", item['short_url'])
+                utils.log_event(utils(), item['news_site'], item['short_url'], 'duplicate', 'info')
+            else:
+                logging.error("Post not added to MongoDB (error %s): %s", failed[i], item['short_url'])
+
+
+class RevisionPipeline(MongoPipeline):
+    '''
+    Saves the updated articles found by the recrawl spider (RevisionItems) with bulk updates.
+    The replaced version is pushed to the revisions list of the article, which keeps
+    the RECRAWL_MAX_REVISIONS newest entries.
+    '''
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = super(RevisionPipeline, cls).from_crawler(crawler)
+        pipeline.max_revisions = crawler.settings.getint('RECRAWL_MAX_REVISIONS', 10)
+        return pipeline
+
+    def open_db(self, spider):
+        ## no url index or seen filter, only known articles are updated
+        self.connect()
+
+    def close_db(self):
+        self.disconnect()
+
+    def insert_items(self, items):
+        '''
+        Blocking bulk update of the buffered RevisionItems
+
+        Returns
+        -------
+        dict: position in items -> error code of all items that were not updated
+        '''
+        requests = [UpdateOne({'short_url': item['short_url']},
+                              {'$set': item['changes'],
+                               '$push': {'revisions': {'$each': [item['revision']], '$slice': -self.max_revisions}}})
+                    for item in items]
+        failed = {}
+        try:
+            self.db[self.article_collection_name].bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failed[error['index']] = error['code']
+        except PyMongoError as e:
+            logging.error("Bulk update of %d posts failed: %s", len(items), e)
+            failed = dict((i, None) for i in range(len(items)))
+        return failed
+
+    def log_results(self, failed, items):
+        for i, item in enumerate(items):
+            if i not in failed:
+                logging.info("Post updated in MongoDB: %s", item['short_url'])
+                utils.log_event(utils(), item['news_site'], item['short_url'], 'updated', 'info')
+            else:
+                logging.error("Post not updated in MongoDB (error %s): %s", failed[i], item['short_url'])
+
+
+class ElasticsearchPipeline(object):
+    '''
+    Bulk-indexes articles directly into Elasticsearch, ordered after MongoPipeline.
+    short_url is the document id, so retried or re-crawled articles overwrite their document.
+    If Elasticsearch is unavailable the actions are appended to a local spool file,
+    which is sent first at the next successful flush.
+    '''
+
+    def __init__(self, host, index, buffer_size=200, flush_interval=10, spool_path=None):
+        self.host = host
+        self.index = index
+        self.buffer_size = max(buffer_size, 1)
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.buffer = []
+        self.flush_task = None
+        self.spool_lock = threading.Lock()   # flushes run in pool threads
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ELASTICSEARCH_ENABLED'):
+            raise NotConfigured
+        if elasticsearch is None:
+            raise NotConfigured("ElasticsearchPipeline requires the elasticsearch package")
+        return cls(
+            host=crawler.settings.get('ELASTICSEARCH_HOST'),
+            index=crawler.settings.get('ELASTICSEARCH_INDEX'),
+            buffer_size=crawler.settings.getint('ELASTICSEARCH_BUFFER_SIZE', 200),
+            flush_interval=crawler.settings.getfloat('ELASTICSEARCH_FLUSH_INTERVAL', 10),
+            spool_path=crawler.settings.get('ELASTICSEARCH_SPOOL_PATH')
+        )
+
+    def open_spider(self, spider):
+        self.es = elasticsearch.Elasticsearch(self.host)
+        if self.flush_interval > 0:
+            self.flush_task = task.LoopingCall(self.flush)
+            self.flush_task.start(self.flush_interval, now=False)
 
     def close_spider(self, spider):
-        ## clean up when spider is closed
-        self.client.close()
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        return self.flush()
 
     def process_item(self, item, spider):
-        log_item = LogItem()
-        collection_name = self.article_collection_name
-        ## how to handle each post
-        self.db[collection_name].ensure_index("short_url", unique=True)
+        self.buffer.append({'_op_type': 'index', '_index': self.index, '_id': item['short_url'],
+                            '_source': dict(item)})
+        if len(self.buffer) >= self.buffer_size:
+            d = self.flush()
+            d.addCallback(lambda _: item)
+            return d
+        return item
+
+    def flush(self):
+        '''
+        Send the buffered actions (and the spooled ones of earlier failures) in a db_pool thread
+
+        Returns
+        -------
+        Deferred firing when the actions are indexed or spooled
+        '''
+        if not self.buffer and not (self.spool_path and os.path.exists(self.spool_path)):
+            return defer.succeed(None)
+        actions, self.buffer = self.buffer, []
+        return db_pool.run(self.index_actions, actions)
+
+    def index_actions(self, actions):
+        with self.spool_lock:
+            self.index_with_spool(actions)
+
+    def index_with_spool(self, actions):
+        spooled = self.read_spool()
+        try:
+            indexed, errors = elasticsearch_helpers.bulk(self.es, spooled + actions, raise_on_error=False)
+        except elasticsearch.ElasticsearchException as e:
+            ## Elasticsearch unavailable: the spooled actions stay in the spool, the new ones are added
+            if not self.spool_path:
+                logging.error("Cannot index %d articles in Elasticsearch: %s", len(actions), e)
+                return
+            logging.warning("Cannot index articles in Elasticsearch, spooling them to %s: %s", self.spool_path, e)
+            self.write_spool(actions)
+            return
+
+        ## documents rejected by Elasticsearch (mapping conflicts, ...) are logged and dropped,
+        ## only the ones rejected because of load (429, 5xx) are spooled again
+        actions_by_id = dict((action['_id'], action) for action in spooled + actions)
+        retry = []
+        for error in errors:
+            info = next(iter(error.values()))
+            if info.get('status') == 429 or info.get('status', 0) >= 500:
+                retry.append(actions_by_id[info['_id']])
+            else:
+                logging.error("Elasticsearch rejected article %s: %s", info.get('_id'), info.get('error'))
+        logging.info("Indexed %d articles in Elasticsearch", indexed)
+        if retry and not self.spool_path:
+            logging.error("Cannot index %d articles in Elasticsearch: overloaded", len(retry))
+        elif retry or spooled:
+            self.replace_spool(retry)
+
+    def read_spool(self):
+        if not self.spool_path or not os.path.exists(self.spool_path):
+            return []
+        with open(self.spool_path, encoding='utf-8') as f:
+            actions = [json.loads(line) for line in f if line.strip()]
+        for action in actions:
+            ## spools of earlier versions contain the times as 'YYYY-MM-DD HH:MM:SS'
+            source = action.get('_source', {})
+            for name in ('crawl_time', 'published_time', 'updated_time'):
+                if isinstance(source.get(name), str) and ' ' in source[name]:
+                    source[name] = datetime.fromisoformat(source[name]).isoformat()
+        return actions
+
+    def write_spool(self, actions, path=None):
+        ## JSONSerializer of the client: times as ISO 8601 like in direct indexing
+        serializer = JSONSerializer()
+        with open(path or self.spool_path, 'a', encoding='utf-8') as f:
+            for action in actions:
+                f.write(serializer.dumps(action) + '\n')
+
+    def replace_spool(self, actions):
+        if not actions:
+            os.remove(self.spool_path)
+            return
+        tmp_path = '{}.{}.tmp'.format(self.spool_path, os.getpid())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        self.write_spool(actions, tmp_path)
+        os.replace(tmp_path, self.spool_path)
+
+
+class ExportPipeline(object):
+    '''
+    Writes the articles to rolling, compressed JSONL or parquet files (see export.ArticleExporter),
+    for bulk consumers that would otherwise read them back from MongoDB.
+    Runs alongside MongoPipeline or, without MongoPipeline in ITEM_PIPELINES, instead of it.
+    '''
+
+    def __init__(self, exporter, buffer_size=200, flush_interval=10):
+        self.exporter = exporter
+        self.buffer_size = max(buffer_size, 1)
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.flush_task = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('EXPORT_ENABLED'):
+            raise NotConfigured
         try:
-            self.db[collection_name].insert(dict(item))
-        except:
-            logging.info("Duplicate not added to MongoDB: %s", item['short_url'])
-            utils.log_event(utils(), item['news_site'], item['short_url'], 'duplicate', 'info')
-        else:
-            logging.info("Post added to MongoDB: %s", item['short_url'])
-            utils.log_event(utils(), item['news_site'], item['short_url'], 'added', 'info')
+            exporter = export.ArticleExporter(
+                settings.get('EXPORT_DIR', 'exports'),
+                file_format=settings.get('EXPORT_FORMAT', 'jsonl'),
+                compression=settings.get('EXPORT_COMPRESSION', 'gzip'),
+                max_bytes=settings.getint('EXPORT_MAX_BYTES', 64 * 1024 * 1024),
+                max_seconds=settings.getfloat('EXPORT_MAX_SECONDS', 3600),
+                max_open_files=settings.getint('EXPORT_MAX_OPEN_FILES', 32),
+                row_group_size=settings.getint('EXPORT_PARQUET_ROW_GROUP_SIZE', 2000)
+            )
+        except ValueError as e:
+            raise NotConfigured(str(e))
+        return cls(
+            exporter,
+            buffer_size=settings.getint('EXPORT_BUFFER_SIZE', 200),
+            flush_interval=settings.getfloat('EXPORT_FLUSH_INTERVAL', 10)
+        )
+
+    def open_spider(self, spider):
+        self.pending = set()
+        if self.flush_interval > 0:
+            self.flush_task = task.LoopingCall(self.flush, rotate=True)
+            self.flush_task.start(self.flush_interval, now=False)
+
+    def close_spider(self, spider):
+        if self.flush_task is not None and self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+        ## the files are completed after all pending writes
+        d = defer.DeferredList(list(self.pending))
+        d.addBoth(lambda _: db_pool.run(self.exporter.close))
+        d.addCallback(lambda _: logging.info("Exported %d articles to %d files in %s", self.exporter.articles,
+                                             self.exporter.files, self.exporter.directory))
+        d.addErrback(lambda failure: logging.error("Cannot complete the export files: %s", failure.value))
+        return d
+
+    def process_item(self, item, spider):
+        if not isinstance(item, ArticleItem):
+            return item
+        if not item.get('content_hash'):
+            ## set by MongoPipeline, if it runs before this pipeline
+            item['content_hash'] = utils.content_hash(item.get('title'), item.get('text'))
+        self.buffer.append((export.partition_of(item), export.article_record(item)))
+        if len(self.buffer) >= self.buffer_size:
+            d = self.flush()
+            d.addCallback(lambda _: item)
+            return d
         return item
+
+    def flush(self, rotate=False):
+        '''
+        Append the buffered articles to the export files in a db_pool thread
+
+        Parameters
+        ----------
+        rotate:
+            also complete the files that are open longer than EXPORT_MAX_SECONDS
+
+        Returns
+        -------
+        Deferred firing when the articles are written
+        '''
+        records, self.buffer = self.buffer, []
+        if not records and not rotate:
+            return defer.succeed(None)
+
+        d = db_pool.run(self.write, records, rotate)
+        d.addErrback(lambda failure: logging.error("Export of %d articles failed: %s", len(records), failure.value))
+        self.pending.add(d)
+        d.addBoth(self.remove_pending, d)
+        return d
+
+    def write(self, records, rotate):
+        if records:
+            self.exporter.write(records)
+        if rotate:
+            self.exporter.rotate()
+
+    def remove_pending(self, result, d):
+        self.pending.discard(d)
+        return result
@@ -0,0 +1,116 @@
+# Runs all spiders concurrently in one process
+#
+#   python -m inews_crawler.run_all
+#   python -m inews_crawler.run_all --spiders taz,heise -a discovery=feed -s LOG_LEVEL=INFO
+#
+# All spiders share the reactor, the db_pool threads, the MongoDB connection pool of the pipelines,
+# the url indexes and the seen filter. The custom_settings of every spider are applied to its own crawler.
+import argparse
+import json
+import logging
+import os
+import sys
+
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+
+spider_names = ('sueddeutsche', 'taz', 'heise', 'golem', 'postillon')   # the spiders of scrape.sh
+report_stats = ('item_scraped_count', 'downloader/response_count', 'downloader/response_bytes', 'log_count/ERROR',
+                'elapsed_time_seconds')
+
+
+def parse_pairs(pairs, option):
+    '''
+    Parse NAME=VALUE command line arguments
+
+    Returns
+    -------
+    dict NAME -> VALUE
+    '''
+    values = {}
+    for pair in pairs:
+        if '=' not in pair:
+            raise SystemExit("%s expects NAME=VALUE, got %r" % (option, pair))
+        name, value = pair.split('=', 1)
+        values[name] = value
+    return values
+
+
+def combined_report(crawlers):
+    '''
+    Stats of all crawlers and their totals
+
+    Parameters
+    ----------
+    crawlers:
+        dict spider name -> finished Crawler
+
+    Returns
+    -------
+    dict spider name (and 'total') -> {stat: value}, with finish_reason per spider
+    '''
+    report = {}
+    total = dict((stat, 0) for stat in report_stats)
+    for name, crawler in crawlers.items():
+        stats = crawler.stats.get_stats()
+        report[name] = dict((stat, stats.get(stat, 0)) for stat in report_stats)
+        report[name]['finish_reason'] = stats.get('finish_reason')
+        for stat in report_stats:
+            if stat == 'elapsed_time_seconds':
+                total[stat] = max(total[stat], report[name][stat])   # the spiders run concurrently
+            else:
+                total[stat] += report[name][stat]
+    report['total'] = total
+    return report
+
+
+def print_report(report):
+    columns = ('items', 'responses', 'MiB', 'errors', 'seconds', 'finish_reason')
+    print('%-14s' % 'spider' + ''.join('%14s' % column for column in columns))
+    for name, values in report.items():
+        print('%-14s' % name
+              + '%14d' % values['item_scraped_count']
+              + '%14d' % values['downloader/response_count']
+              + '%14.1f' % (values['downloader/response_bytes'] / 1024 / 1024)
+              + '%14d' % values['log_count/ERROR']
+              + '%14.0f' % values['elapsed_time_seconds']
+              + '%14s' % values.get('finish_reason', ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run all spiders concurrently in one process')
+    parser.add_argument('--spiders', default=','.join(spider_names),
+                        help='comma separated spider names (default: %(default)s)')
+    parser.add_argument('-a', dest='spider_args', action='append', default=[], metavar='NAME=VALUE',
+                        help='spider argument for all spiders, e.g. -a discovery=feed')
+    parser.add_argument('-s', dest='settings', action='append', default=[], metavar='NAME=VALUE',
+                        help='setting for all spiders, like scrapy crawl -s')
+    parser.add_argument('--stats-file', help='write the combined stats report as JSON to this file')
+    args = parser.parse_args()
+
+    os.environ.setdefault('SCRAPY_SETTINGS_MODULE', 'inews_crawler.settings')
+    settings = get_project_settings()
+    settings.setdict(parse_pairs(args.settings, '-s'), priority='cmdline')
+    spider_args = parse_pairs(args.spider_args, '-a')
+
+    process = CrawlerProcess(settings)
+    crawlers = {}
+    for name in args.spiders.split(','):
+        crawler = process.create_crawler(name)
+        crawlers[name] = crawler
+        process.crawl(crawler, **spider_args)
+    process.start()
+
+    report = combined_report(crawlers)
+    logging.info("Finished %d spiders: %s", len(crawlers), json.dumps(report))
+    print_report(report)
+    if args.stats_file:
+        with open(args.stats_file, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+    # non-zero exit code for cron/monitoring if a spider did not finish
+    return 0 if all(values['finish_reason'] == 'finished' for name, values in report.items() if name != 'total') \
+        else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
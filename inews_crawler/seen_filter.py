@@ -0,0 +1,235 @@
+# Persistent bloom filter of seen article urls
+import argparse
+import fcntl
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+
+MAGIC = b'INBF'
+VERSION = 1
+# magic, version, number of bits, number of hashes, number of added urls
+HEADER = struct.Struct('<4sIQIQ')
+
+
+class SeenUrlFilter(object):
+    '''
+    Bloom filter of article urls, backed by a memory-mapped file.
+
+    Answers "definitely not seen" or "maybe seen" with a configurable false-positive rate,
+    so the exact database check is only needed for the "maybe" answers.
+    Several spider processes can map the same file, the pages are shared by the OS.
+
+    Writers change the file under a lock file (path + '.lock'). The lock is not waited for in add:
+    while another process holds it (e.g. a rebuild), the urls are kept in memory and written with the
+    next add or on close. A writer continues in the new file after a rebuild, readers keep reading
+    the version they opened.
+    '''
+
+    def __init__(self, path, readonly=True):
+        self.path = path
+        self.readonly = readonly
+        self._lock = None       # lock file of the writers, opened on the first add
+        self._pending = set()   # added urls not written to the file yet
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'rb' if self.readonly else 'r+b')
+        self._mmap = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE)
+        magic, version, self.num_bits, self.num_hashes, _ = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("Not a seen url filter file: %s" % self.path)
+
+    @staticmethod
+    def optimal_size(capacity, fp_rate):
+        '''
+        Compute number of bits and hash functions for the expected number of urls
+
+        Parameters
+        ----------
+        capacity:
+            expected number of urls
+        fp_rate:
+            accepted false-positive rate, e.g. 0.001
+
+        Returns
+        -------
+        tuple (number of bits, number of hash functions)
+        '''
+        capacity = max(capacity, 1)
+        num_bits = int(math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        num_bits = (num_bits + 7) // 8 * 8
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        return num_bits, num_hashes
+
+    @classmethod
+    def create(cls, path, capacity, fp_rate=0.001):
+        '''
+        Create an empty filter file and open it writable
+
+        Parameters
+        ----------
+        path:
+            file to create, an existing file is overwritten
+        capacity:
+            expected number of urls
+        fp_rate:
+            accepted false-positive rate at full capacity
+
+        Returns
+        -------
+        the opened SeenUrlFilter
+        '''
+        num_bits, num_hashes = cls.optimal_size(capacity, fp_rate)
+        with open(path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, num_bits, num_hashes, 0))
+            f.truncate(HEADER.size + num_bits // 8)
+        return cls(path, readonly=False)
+
+    @classmethod
+    def rebuild(cls, collection, path, fp_rate=0.001, headroom=2.0, batch_size=10000):
+        '''
+        Rebuild the filter from all short_urls of the article collection.
+
+        The new filter is written to a temporary file and atomically moved to path, under the lock of the writers:
+        the urls they add in the meantime are written to the new file.
+
+        Parameters
+        ----------
+        collection:
+            pymongo collection containing the articles
+        path:
+            filter file
+        fp_rate:
+            accepted false-positive rate
+        headroom:
+            capacity factor for urls added after the rebuild
+        batch_size:
+            number of documents fetched per cursor round-trip
+
+        Returns
+        -------
+        the rebuilt SeenUrlFilter, opened writable
+        '''
+        capacity = int(collection.estimated_document_count() * headroom) + 100000
+        directory = os.path.dirname(os.path.abspath(path))
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            fd, tmp_path = tempfile.mkstemp(prefix='.seen_urls', dir=directory)
+            os.close(fd)
+            seen_filter = cls.create(tmp_path, capacity, fp_rate)
+            count = 0
+            for doc in collection.find({}, {"short_url": 1, "_id": 0}, batch_size=batch_size):
+                if doc.get('short_url') and seen_filter._set_bits(doc['short_url']):
+                    count += 1
+            seen_filter._set_count(count)
+            seen_filter.close()
+            os.replace(tmp_path, path)
+        logging.info("Rebuilt seen url filter %s with %d urls", path, count)
+        return cls(path, readonly=False)
+
+    def __len__(self):
+        return HEADER.unpack_from(self._mmap, 0)[4] + len(self._pending)
+
+    def _bit_positions(self, url):
+        digest = hashlib.blake2b(url.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, url):
+        if url in self._pending:
+            return True
+        data = self._mmap
+        for bit in self._bit_positions(url):
+            if not data[HEADER.size + (bit >> 3)] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def add(self, url):
+        '''
+        Add an url to the filter
+
+        Parameters
+        ----------
+        url:
+            short_url of a saved article
+        '''
+        if self.readonly:
+            raise ValueError("Seen url filter is opened read-only: %s" % self.path)
+        self._pending.add(url)
+        if self._lock is None:
+            self._lock = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return  # written with the next url
+        try:
+            self._write_pending()
+        finally:
+            fcntl.flock(self._lock, fcntl.LOCK_UN)
+
+    def _set_bits(self, url):
+        # True if the url changed a bit, i.e. it was not in the filter
+        data = self._mmap
+        new = False
+        for bit in self._bit_positions(url):
+            pos = HEADER.size + (bit >> 3)
+            if not data[pos] & (1 << (bit & 7)):
+                data[pos] |= 1 << (bit & 7)
+                new = True
+        return new
+
+    def _set_count(self, count):
+        HEADER.pack_into(self._mmap, 0, MAGIC, VERSION, self.num_bits, self.num_hashes, count)
+
+    def _write_pending(self):
+        # call with the lock held: the count in the header is shared by all writers
+        if os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino:
+            logging.info("Seen url filter %s was rebuilt, reopening it", self.path)
+            self._mmap.close()
+            self._file.close()
+            self._open()
+        added = sum(1 for url in self._pending if self._set_bits(url))
+        self._set_count(HEADER.unpack_from(self._mmap, 0)[4] + added)
+        self._pending.clear()
+
+    def flush(self):
+        if self.readonly:
+            return
+        if self._pending:
+            fcntl.flock(self._lock, fcntl.LOCK_EX)
+            try:
+                self._write_pending()
+            finally:
+                fcntl.flock(self._lock, fcntl.LOCK_UN)
+        self._mmap.flush()
+
+    def close(self):
+        if not self._mmap.closed:
+            self.flush()
+            self._mmap.close()
+        self._file.close()
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+
+if __name__ == '__main__':
+    import pymongo
+    from .settings import MONGO_URI, MONGO_DATABASE, ARTICLE_COLLECTION_NAME, SEEN_FILTER_FP_RATE
+
+    parser = argparse.ArgumentParser(description='Rebuild the seen url filter from the article collection')
+    parser.add_argument('path', help='filter file, e.g. the SEEN_FILTER_PATH setting')
+    parser.add_argument('--fp-rate', type=float, default=SEEN_FILTER_FP_RATE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    client = pymongo.MongoClient(MONGO_URI)
+    SeenUrlFilter.rebuild(client[MONGO_DATABASE][ARTICLE_COLLECTION_NAME], args.path, args.fp_rate).close()
+    client.close()
@@ -40,6 +40,69 @@ MONGO_URI = 'mongodb://' + MONGO_HOST + '/?authSource=' + MONGO_DATABASE
 ARTICLE_COLLECTION_NAME = 'scraped_articles_new'
 LOG_COLLECTION_NAME = 'log_crawler'
 
+# Dedup of article links
+# in-memory index of the known urls of the crawled news site, loaded when the spider is opened
+URL_INDEX_ENABLED = True
+# for archive builds: bloom filter file of all saved urls, shared by all spider processes (several writers are
+# synchronised with a lock file). Only urls the filter reports as "maybe saved" are checked in the database.
+# The link checks of the spiders only use it with URL_INDEX_ENABLED = False: the url index already knows all saved
+# urls of the news site, the filter saves its memory and loading time for archive builds of very large collections.
+# Rebuild with: python -m inews_crawler.seen_filter PATH
+SEEN_FILTER_ENABLED = False
+SEEN_FILTER_PATH = None         # default: seen_urls.bloom in JOBDIR or the working directory
+SEEN_FILTER_FP_RATE = 0.001
+SEEN_FILTER_READONLY = False    # True: don't add saved urls (e.g. filter is rebuilt by a cron job)
+
+# Articles are written in bulk: the buffer is flushed when it contains MONGO_BUFFER_SIZE items,
+# every MONGO_FLUSH_INTERVAL seconds and when the spider is closed. 1 writes every item immediately.
+MONGO_BUFFER_SIZE = 100
+MONGO_FLUSH_INTERVAL = 10
+# number of worker threads for database calls (the reactor thread never waits for MongoDB)
+MONGO_THREADPOOL_SIZE = 4
+
+# Log events (collection LOG_COLLECTION_NAME) are buffered and written in bulk:
+# when LOG_EVENT_BUFFER_SIZE events are collected, every LOG_EVENT_FLUSH_INTERVAL seconds and when the spider is closed.
+LOG_EVENT_BUFFER_SIZE = 500
+LOG_EVENT_FLUSH_INTERVAL = 30
+# True: save only the number of events per news_site/property/level and run instead of one document per url
+LOG_EVENT_AGGREGATE = False
+# events are appended to this JSONL file if MongoDB is unavailable. None: only log an error
+LOG_EVENT_FALLBACK_PATH = 'log_events.jsonl'
+
+# Index articles directly into Elasticsearch while crawling (ElasticsearchPipeline, requires the elasticsearch package).
+# short_url is the document id. If Elasticsearch is unavailable, the articles are spooled to ELASTICSEARCH_SPOOL_PATH
+# and indexed at the next successful flush.
+ELASTICSEARCH_ENABLED = False
+ELASTICSEARCH_HOST = 'localhost:9200'
+ELASTICSEARCH_INDEX = 'scraped_articles'
+ELASTICSEARCH_BUFFER_SIZE = 200
+ELASTICSEARCH_FLUSH_INTERVAL = 10
+ELASTICSEARCH_SPOOL_PATH = 'elasticsearch_spool.jsonl'
+
+# Near-duplicate detection (NearDuplicatePipeline): MinHash signatures of the article texts in an LSH index
+# shared by all news sites, rebuilt from the article collection if NEAR_DUPLICATE_PATH does not exist.
+# Every article gets a cluster_id, a near-duplicate of an earlier article gets its cluster_id and the
+# estimated similarity in near_duplicate. With NEAR_DUPLICATE_DROP near-duplicates are not saved (nor crawled again).
+NEAR_DUPLICATE_ENABLED = False
+NEAR_DUPLICATE_PATH = 'near_duplicates.index'
+NEAR_DUPLICATE_THRESHOLD = 0.8      # estimated Jaccard similarity of the 5-word shingles of the texts
+NEAR_DUPLICATE_DROP = False
+NEAR_DUPLICATE_SAVE_INTERVAL = 300  # seconds between saves of the new articles, for the other spider processes
+
+# Export articles to rolling, compressed files (ExportPipeline), alongside MongoDB or instead of it
+# (remove MongoPipeline from ITEM_PIPELINES). Files are partitioned by news site and published date:
+# EXPORT_DIR/news_site=heise/published=2021-01-05/part-....jsonl.gz, read them with inews_crawler.export.read_batches.
+EXPORT_ENABLED = False
+EXPORT_DIR = 'exports'
+EXPORT_FORMAT = 'jsonl'                 # 'jsonl' or 'parquet' (requires pyarrow)
+EXPORT_COMPRESSION = 'gzip'             # 'gzip', 'zstd' (python 3.14 or backports.zstd) or 'none'
+EXPORT_MAX_BYTES = 64 * 1024 * 1024     # a file is completed when it reaches this size (compressed)
+EXPORT_MAX_SECONDS = 3600               # ... or when it is open for this time
+EXPORT_MAX_OPEN_FILES = 32              # ... or when more partitions are written at the same time (archive builds)
+EXPORT_PARQUET_ROW_GROUP_SIZE = 2000    # articles per parquet row group
+EXPORT_BUFFER_SIZE = 200
+EXPORT_FLUSH_INTERVAL = 10
+
 #############################################################################################################
 
 # Minimum Level to log. Scrapy stats are INFO.
@@ -78,26 +141,92 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
-#SPIDER_MIDDLEWARES = {
+SPIDER_MIDDLEWARES = {
 #    'inews_crawler.middlewares.LetsSpiderMiddleware': 543,
-#}
+    # acknowledges parsed requests of the DistributedScheduler (see FRONTIER_URL), no-op for the default scheduler
+    'inews_crawler.frontier.FrontierAckMiddleware': 950,
+    # marks the requests found on conditional pages, see ConditionalRequestMiddleware
+    'inews_crawler.middlewares.ConditionalPageMiddleware': 560,
+}
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
+DOWNLOADER_MIDDLEWARES = {
 #    'inews_crawler.middlewares.LetsDownloaderMiddleware': 543,
-#}
+    # renders requests with meta['browser'] in a pool of headless browsers (postillon selenium mode)
+    'inews_crawler.middlewares.BrowserPoolDownloaderMiddleware': 950,
+    # after HttpCompressionMiddleware (590) in process_response, so the hash is computed over the decompressed body
+    'inews_crawler.middlewares.ConditionalRequestMiddleware': 560,
+}
+BROWSER_POOL_SIZE = 2           # browsers rendering pages concurrently, started on first use
+BROWSER_MAX_PAGES = 50          # pages per browser before it is replaced
+BROWSER_DRIVER = 'Chromium'     # 'Chromium' (chromedriver) or 'Firefox' (geckodriver)
+BROWSER_PAGE_TIMEOUT = 20       # seconds
+# category and archive pages (meta['conditional']) unchanged since the last finished crawl are not parsed again.
+# Conditional requests (ETag/Last-Modified) and body hashes are kept in CONDITIONAL_CACHE_PATH
+CONDITIONAL_CACHE_ENABLED = True
+CONDITIONAL_CACHE_PATH = 'conditional_cache.json'
+
+# Distributed crawling (optional): all workers started with the same spider and FRONTIER_URL take their requests
+# from one shared queue, e.g. scrapy crawl heise -s SCHEDULER=inews_crawler.frontier.DistributedScheduler
+# sqlite:///file for several processes on one node, redis://host:6379/0 for several nodes (requires redis).
+# Requests of dead workers are crawled again when their lease expired; start a new run with
+# python -m inews_crawler.frontier clear SPIDERNAME
+#SCHEDULER = 'inews_crawler.frontier.DistributedScheduler'
+FRONTIER_URL = 'sqlite:///frontier.sqlite'
+FRONTIER_LEASE_SECONDS = 300
+FRONTIER_MAX_LEASES = 3     # requests leased this often without being downloaded are removed
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
+EXTENSIONS = {
 #    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+    # MongoDB connection of the crawler, shared by MongoPipeline, the dedup checks and the event log
+    'inews_crawler.extensions.MongoConnectionExtension': 100,
+    # saves the start time of every finished crawl for the feed discovery mode
+    'inews_crawler.extensions.CrawlStateExtension': 500,
+    # adjusts concurrency and delay per domain to the measured latency and error rate
+    'inews_crawler.extensions.AdaptiveThrottleExtension': 510,
+}
+CRAWL_STATE_PATH = 'crawl_state.json'      # last finished crawl per news site, watermarks per department
+# feed discovery mode of the spiders (scrapy crawl taz -a discovery=feed): feed entries updated up to
+# this many minutes before the last finished crawl are requested again (late lastmod/pubDate of the feeds)
+DISCOVERY_OVERLAP_MINUTES = 60
+# recrawl spider (scrapy crawl recrawl): articles published in the last RECRAWL_DAYS days are requested again,
+# changed articles are updated and keep the RECRAWL_MAX_REVISIONS newest replaced versions in 'revisions'
+RECRAWL_DAYS = 3
+RECRAWL_MAX_REVISIONS = 10
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
+    'inews_crawler.pipelines.NearDuplicatePipeline': 200,
     'inews_crawler.pipelines.MongoPipeline': 300,
+    'inews_crawler.pipelines.ElasticsearchPipeline': 400,
+    'inews_crawler.pipelines.ExportPipeline': 500,
+}
+
+# Adaptive throttle per download slot (domain), replaces AutoThrottle (not used together).
+# Every THROTTLE_WINDOW responses of a domain the concurrency is increased by one while the median latency is
+# below target_latency, decreased by one above it and halved (delay doubled) if more than max_error_rate of the
+# responses were 429/5xx. Profiles per spider name, missing values are taken from 'default'.
+# The concurrency over time is in the crawl stats: throttle/<domain>/history, throttle/<domain>/concurrency_max
+THROTTLE_ENABLED = True
+THROTTLE_WINDOW = 20
+THROTTLE_PROFILES = {
+    'default': {
+        'start_concurrency': 4,
+        'min_concurrency': 1,
+        'max_concurrency': 8,
+        'start_delay': 0.25,    # seconds
+        'min_delay': 0.0,
+        'max_delay': 10.0,
+        'target_latency': 1.0,  # seconds, median of a window
+        'max_error_rate': 0.05,
+        'debug': False,         # log every adjustment
+    },
+    # one archive page per month and many articles, the cookie wall site is crawled carefully
+    'golem': {'start_concurrency': 2, 'max_concurrency': 4, 'start_delay': 0.5},
 }
 
 # Enable and configure the AutoThrottle extension to slow down crawling speed (disabled by default)
@@ -4,15 +4,23 @@ from ..items import ArticleItem
 from datetime import datetime, time
 import locale
 from ..utils import utils
+from .. import feeds
+from scrapy.utils.defer import maybe_deferred_to_future
 import logging
 import re
 
 max_articles_per_month = 20
 number_of_months = 1
 
+feed_url = 'https://rss.golem.de/rss.php?feed=ATOM1.0'   # Atom feed of all new articles
+discovery_mode = 'archive'  # 'archive': article links of the monthly archive pages
+                            # 'feed': only articles of the feed updated since the last finished crawl (daily use)
+                            # can be set per run: scrapy crawl golem -a discovery=feed
+
 
 class PostsSpider(Spider):
     name = 'golem'
+    discovery = discovery_mode
 
     @staticmethod
     def generate_archive_urls(number_of_months):
@@ -72,8 +80,44 @@ class PostsSpider(Spider):
         '''
         Called by scrapy when the spider is opened
         '''
-        for url in self.generate_archive_urls(number_of_months):
-            yield self.request(url, self.parse)
+        if self.discovery == 'feed':
+            request = self.request(feed_url, self.parse_feed)
+            request.cb_kwargs['since'] = utils.get_discovery_since(self)
+            yield request
+        else:
+            for url in self.generate_archive_urls(number_of_months):
+                request = self.request(url, self.parse)
+                # archive pages of past months rarely change: skipped by the ConditionalRequestMiddleware
+                request.meta['conditional'] = True
+                yield request
+
+    async def parse_feed(self, response, since):
+        '''
+        Parse new article links of the feed
+
+        Parameters
+        ----------
+        response:
+            Response of scrapy-Request
+        since:
+            ISO time of the last finished crawl, older entries are skipped. None: all entries
+        '''
+        # the feed links to the article with an '-rss' suffix: .../meldung-2101-153000-rss.html
+        urls = [entry.url.replace('-rss.html', '.html') for entry in feeds.entries_since(
+            feeds.parse_feed(response.body), since)]
+        # only articles, e.g. no video or special pages
+        urls = [url for url in urls if re.search(r'-\d+\.html$', url)]
+
+        short_urls = [self.generate_short_url(url) for url in urls]
+        # one lookup for the whole feed, the db-query runs in a worker thread if no url index is loaded
+        unseen_urls = utils.filter_unseen_async(short_urls, self.name)
+        unseen_urls = set(await maybe_deferred_to_future(unseen_urls))
+        for url, short_url in zip(urls, short_urls):
+            if short_url in unseen_urls:
+                yield self.request(url=url, callback=self.parse_article)
+            else:
+                utils.log_event(utils(), self.name, short_url, 'exists', 'info')
+                logging.info('%s already in db', short_url)
 
     def request(self, url, callback):
         '''
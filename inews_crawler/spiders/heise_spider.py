@@ -1,29 +1,97 @@
 import scrapy
-from scrapy import Selector
 import logging
 from datetime import datetime
 from ..items import ArticleItem
 from ..utils import utils
+from .. import feeds
+from .. import extraction
+from ..feeds import parse_time
+from scrapy.utils.defer import maybe_deferred_to_future
 
 root = 'https://www.heise.de'
 short_url_regex="\-[0-9]\d{6,}"       # helps converting long to short url: https://www.heise.de/-4642199
 full_article_addition = '?seite=all'  # if article extends over multiple pages this url addition will get the full article
+text_tags = ('p', 'a', 'h3')          # blocks of the article text
+paywall_xpath = 'descendant-or-self::*[contains(local-name(), "heiseplus")] | .//@*[contains(., "heiseplus")] ' \
+                '| .//text()[contains(., "heiseplus")]'
+feed_url = 'https://www.heise.de/rss/heise-atom.xml'   # Atom feed of all new articles
+
+discovery_mode = 'category'     # 'category': crawl main page and category pages for article links
+                                # 'feed': only articles of the feed updated since the last finished crawl (daily use)
+                                # can be set per run: scrapy crawl heise -a discovery=feed
 
 testrun_cats = 10    # limits the categories to crawl to this number. if zero, no limit.
 testrun_arts = 10    # limits the article links to crawl per category page to this number. if zero, no limit.
 
-limit_pages = 0     # => 1. building the archive: 0
-                    # => 2. daily use: 3 or 4
+limit_pages = 0     # maximum category pages per department. if zero, up to the last page.
                     # don't forget to set the testrun variables to zero
 
+pagination_mode = 'adaptive'    # 'adaptive' (daily use): follow the category pages of a department until a page has no
+                                #       new articles or reaches the articles of the last crawl (department watermark)
+                                # 'archive' (building the archive): follow all pages, an interrupted archive build
+                                #       continues at its last category page
+
+
+def filter_links(links):
+    # no forum, mail and price comparison links
+    links = [link for link in links
+             if not link == "/" and not link[:6] == "/forum" and not link[:6] == "mailto" and not "geizhals" in link]
+    return utils.add_host_to_url_list(utils(), links, root)
+
+# metadata of the article pages, text and published time are parsed in parse_article
+article_spec = extraction.Spec([
+    extraction.field('title', xpath=['//meta[@property="og:title"]/@content', '//meta[@name="title"]/@content']),
+    extraction.field('authors', 'list', xpath=['//meta[@name="author"]/@content']),
+    extraction.field('intro', css=['p.a-article-header__lead::text', 'p.article_page_intro strong::text']),
+    extraction.field('keywords', 'split', xpath=['//meta[@name="keywords"]/@content'], split=", "),
+    extraction.field('image_links', 'list', xpath=['//meta[@property="og:image"]/@content']),
+    extraction.field('links', 'list', css=['.article_page_text a::attr(href)', '.article-content a::attr(href)'],
+                     post=filter_links),
+])
+
 class HeiseSpider(scrapy.Spider):
     name = "heise"
     start_url = root
     utils_obj = utils()
+    discovery = discovery_mode
+    pagination = pagination_mode
+    watermarks = None   # department watermarks of the last crawl, loaded on first use
+    progress = None     # department progress of this crawl, saved when the spider is closed
 
 
     def start_requests(self):
-        yield scrapy.Request(self.start_url, callback=self.parse)
+        if self.discovery == 'feed':
+            yield scrapy.Request(feed_url, callback=self.parse_feed,
+                                 cb_kwargs=dict(since=utils.get_discovery_since(self)))
+        else:
+            yield scrapy.Request(self.start_url, callback=self.parse)
+
+    # read the feed for new articles
+    async def parse_feed(self, response, since):
+        utils_obj = utils()
+
+        entries = feeds.entries_since(feeds.parse_feed(response.body), since)
+        entries = utils.limit_crawl(entries, testrun_arts)
+
+        short_urls = [utils.not_none_string(utils.get_short_url(entry.url, root, short_url_regex)) for entry in entries]
+        # one lookup for the whole feed, the db-query runs in a worker thread if no url index is loaded
+        unseen_urls = utils.filter_unseen_async([url for url in short_urls if url], self.name)
+        unseen_urls = set(await maybe_deferred_to_future(unseen_urls))
+
+        for entry, short_url in zip(entries, short_urls):
+            # no techstage and no paywalled articles
+            if "techstage.de" in entry.url:
+                continue
+            if "heiseplus" in entry.url or (entry.title or "").startswith("heise+"):
+                utils.log_event(utils_obj, self.name, short_url, 'paywall', 'info')
+                logging.info("%s is paywalled", short_url)
+            elif short_url and short_url in unseen_urls:
+                yield scrapy.Request(entry.url+full_article_addition, callback=self.parse_article,
+                                     cb_kwargs=dict(description=entry.description or "", long_url=entry.url,
+                                                    short_url=short_url, department_name=""))
+            else:
+                utils.log_event(utils_obj, self.name, short_url, 'exists', 'info')
+                logging.info("%s already in db", short_url)
 
     # scrape main page for categories
     def parse(self, response):
@@ -32,56 +100,121 @@ class HeiseSpider(scrapy.Spider):
 
         for department_url in departments:
             department_url = root + department_url
+            # in adaptive mode an unchanged category page has no new articles: skipped by the ConditionalRequestMiddleware.
+            # not in archive mode, the first page continues an interrupted archive build
             yield scrapy.Request(department_url,
                                  callback=self.parse_category,
-                                 cb_kwargs=dict(department_url=department_url, page=1, limit_pages=limit_pages))
+                                 cb_kwargs=dict(department_url=department_url, page=1, limit_pages=limit_pages),
+                                 meta=dict(conditional=self.pagination == 'adaptive'))
+
+    # department watermarks as saved by the last crawl, not updated while this crawl runs
+    def get_watermark(self, department_url):
+        if self.watermarks is None:
+            self.watermarks = utils.get_crawl_state(self).departments(self.name)
+        return self.watermarks.get(department_url, {})
+
+    def update_progress(self, department_url, **values):
+        if self.progress is None:
+            self.progress = {}
+        progress = self.progress.setdefault(department_url, {})
+        newest_published = values.pop('newest_published', None)
+        if newest_published and newest_published >= progress.get('newest_published', newest_published):
+            progress['newest_published'] = newest_published
+        progress.update(values)
+
+    # the progress is saved once: the watermarks only if the crawl finished (an interrupted crawl may have missed
+    # older articles), the archive pages always, so an interrupted archive build is continued
+    def closed(self, reason):
+        if not self.progress:
+            return
+        departments = {}
+        for department_url, progress in self.progress.items():
+            values = dict((key, value) for key, value in progress.items()
+                          if reason == 'finished' or key == 'archive_page')
+            if values:
+                departments[department_url] = values
+        utils.get_crawl_state(self).update_departments(self.name, departments)
 
     # scrape category pages for articles
-    def parse_category(self, response, department_url, page, limit_pages):
+    async def parse_category(self, response, department_url, page, limit_pages):
         utils_obj = utils()
+        watermark = self.get_watermark(department_url)
 
         def find_last_page():
             links = response.xpath('//li/a/@href').extract()
-            pagination = []
+            pagination = [1]
             for link in links:
                 if "/seite-" in link:
                     pagination.append((int)(link.split("-")[-1][:-1]))
             return max(pagination)
 
+        # the page shows only known articles or articles older than the newest one of the last crawl
+        def is_caught_up(short_urls, unseen_count):
+            if unseen_count == 0:
+                return True
+            if watermark.get('newest_url') in short_urls:
+                return True
+            newest_published = watermark.get('newest_published')
+            teaser_times = [parse_time(time_str) for time_str in response.xpath('//article//time/@datetime').extract()]
+            teaser_times = [teaser_time for teaser_time in teaser_times if teaser_time is not None]
+            return bool(newest_published and teaser_times and min(teaser_times) < newest_published)
+
         if not limit_pages:
             limit_pages = find_last_page()
 
-        if page<limit_pages:
-            dep_page = department_url + "seite-" + str(page + 1) + "/"
-            yield scrapy.Request(dep_page,
-                                 callback=self.parse_category,
-                                 cb_kwargs=dict(department_url=department_url, page=page + 1,
-                                                limit_pages=limit_pages))
-
-
         department_name = utils.get_item_string(utils_obj, response, 'department', department_url, 'xpath',
                                                 ['//meta[@name="title"]/@content'], self.name)
-        articles = response.css(".stage--top article").extract() \
-                   + response.xpath('//div[@class="article-index"]/article').extract()
+        articles = response.css(".stage--top article") \
+                   + response.xpath('//div[@class="article-index"]/article')
 
         limited_articles = utils.limit_crawl(articles,testrun_arts)
 
-
+        teasers = []
         for article in limited_articles:
-            article_html = Selector(text=article)
-            long_url = article_html.xpath('//a/@href').get()
+            long_url = article.xpath('.//a/@href').get()
             long_url = utils.add_host_to_url(utils_obj, long_url, root)
             short_url = utils.not_none_string(utils.get_short_url(long_url, root, short_url_regex))
+            teasers.append((article, long_url, short_url))
+
+        # one lookup for the whole page, the db-query runs in a worker thread if no url index is loaded
+        unseen_urls = utils.filter_unseen_async([teaser[2] for teaser in teasers if teaser[2]], self.name)
+        unseen_urls = set(await maybe_deferred_to_future(unseen_urls))
+
+        # pagination
+        next_page = page + 1
+        if self.pagination == 'archive':
+            # continue an interrupted archive build at its last page (again, its articles may not all be saved)
+            if page == 1 and watermark.get('archive_page', 0) > next_page:
+                next_page = watermark['archive_page']
+                logging.info("Continuing archive of %s at page %d", department_url, next_page)
+            else:
+                self.update_progress(department_url, archive_page=page if page < limit_pages else None)
+        elif is_caught_up([teaser[2] for teaser in teasers], len(unseen_urls)):
+            logging.info("%s is caught up at page %d", department_url, page)
+            next_page = limit_pages + 1
+        if page == 1 and teasers:
+            self.update_progress(department_url, newest_url=teasers[0][2])
+
+        if next_page <= limit_pages:
+            dep_page = department_url + "seite-" + str(next_page) + "/"
+            yield scrapy.Request(dep_page,
+                                 callback=self.parse_category,
+                                 cb_kwargs=dict(department_url=department_url, page=next_page,
+                                                limit_pages=limit_pages),
+                                 meta=dict(conditional=self.pagination == 'adaptive'))
+
+        for article, long_url, short_url in teasers:
             # no techstage articles
             if not "techstage.de" in long_url:
-                # no paywalled articles
-                if not "heiseplus" in article:
-                    if short_url and not utils.is_url_in_db(short_url):  # db-query
-                        description = utils.get_item_string(utils_obj, article_html, 'description', department_url, 'xpath',
-                                                            ['//p[@class="a-article-teaser__synopsis "]/text()'], self.name)
+                # no paywalled articles: 'heiseplus' in any tag name, attribute or text of the teaser
+                if not article.xpath(paywall_xpath):
+                    if short_url and short_url in unseen_urls:
+                        description = utils.get_item_string(utils_obj, article, 'description', department_url, 'xpath',
+                                                            ['.//p[@class="a-article-teaser__synopsis "]/text()'], self.name)
                         yield scrapy.Request(long_url+full_article_addition, callback=self.parse_article,
                                              cb_kwargs=dict(description=description, long_url=long_url,
-                                                            short_url=short_url, department_name=department_name))
+                                                            short_url=short_url, department_name=department_name,
+                                                            department_url=department_url))
                     else:
                         utils.log_event(utils_obj, self.name, short_url, 'exists', 'info')
                         logging.info("%s already in db", short_url)
@@ -90,49 +223,22 @@ class HeiseSpider(scrapy.Spider):
                     logging.info("%s is paywalled", short_url)
 
 
-    def parse_article(self, response, description, long_url, short_url, department_name):
+    def parse_article(self, response, description, long_url, short_url, department_name, department_url=None):
         utils_obj = utils()
 
         # Article text: paragraphs and subheadings
         def get_article_text():
-            art_parags=[]
             html_article = response.css(".article-content")
             if not html_article:
                 html_article = response.css(".article_page_text")
 
-            tags = html_article.xpath('p|a|h3').extract()
-            for tag in tags:
-                lines=""
-                sel = Selector(text=tag)
-                html_lines =sel.xpath('//*/text()').extract()
-                for line in html_lines:
-                    lines+=line
-                art_parags.append(lines)
-            article_text = ""
-            for paragraph in art_parags:
-                if paragraph:
-                    article_text += paragraph + "\n\n"
-            text = article_text.strip()
+            text = utils.extract_text(html_article.xpath('*'), text_tags)
             if not text:
                 utils.log_event(utils_obj, self.name, short_url, 'text', 'warning')
                 logging.warning("Cannot parse article text: %s", short_url)
             return text
 
 
-        # Filter links
-        def get_links():
-            links = utils.get_item_list(utils_obj,response,'links',short_url,'css',
-                                        ['.article_page_text a::attr(href)',
-                                         '.article-content a::attr(href)'], self.name)
-            if links:
-                filtered_links = set()
-                for link in links:
-                    if not link=="/" and not link[:6] == "/forum" and not link[:6] == "mailto" and not "geizhals" in link:
-                        filtered_links.add(link)
-                return utils.add_host_to_url_list(utils_obj, list(filtered_links), root)
-            else:
-                return []
-
         # try different formats
         def get_pub_time():
             time_str = response.xpath('//time/@datetime').get()
@@ -161,6 +267,7 @@ class HeiseSpider(scrapy.Spider):
             return paywall_heise & paywall_ct
 
 
+        fields = utils.extract_fields(article_spec, response, short_url, self.name)
         item = ArticleItem()
 
         item['crawl_time'] = datetime.now()
@@ -168,33 +275,29 @@ class HeiseSpider(scrapy.Spider):
         item['short_url'] = short_url
 
         item['news_site'] = "heise"
-        item['title'] = utils.get_item_string(utils_obj,response,'title',short_url,'xpath',
-                                              ['//meta[@property="og:title"]/@content',
-                                               '//meta[@name="title"]/@content'], self.name)
-        item['authors'] = utils.get_item_list(utils_obj,response,'authors',short_url,'xpath',
-                                              ['//meta[@name="author"]/@content'], self.name)
+        item['title'] = fields['title']
+        item['authors'] = fields['authors']
         item['description'] = description
-        item['intro'] = utils.get_item_string(utils_obj,response,'intro',short_url,'css',
-                                              ['p.a-article-header__lead::text',
-                                               'p.article_page_intro strong::text'], self.name)
+        item['intro'] = fields['intro']
 
         item['text'] = get_article_text()
 
-        keywords = utils.get_item_list_from_str(utils_obj, response,'keywords',short_url,'xpath',
-                                                        ['//meta[@name="keywords"]/@content'],", ", self.name)
+        keywords = fields['keywords']
         # add department name to keywords for UIMA mapping
         if department_name:
             keywords.append(department_name)
         item['keywords'] = keywords
 
         item['published_time'] = get_pub_time()
-        item['image_links'] = utils.get_item_list(utils_obj,response,'image_links',short_url,'xpath',
-                                                  ['//meta[@property="og:image"]/@content'], self.name)
+        item['image_links'] = fields['image_links']
 
-        item['links'] = get_links()
+        item['links'] = fields['links']
 
         # don't save article without title or text
         if item['title'] and item['text']:
+            if department_url and item['published_time']:
+                # watermark of the department for the pagination of the next crawl
+                self.update_progress(department_url, newest_published=item['published_time'])
             yield item
         else:
             logging.info("Cannot parse article: %s", short_url)
@@ -1,19 +1,26 @@
 import scrapy
-from scrapy import Selector
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.chrome.options import Options
+from scrapy.utils.defer import maybe_deferred_to_future
+import json
 import logging
 from datetime import datetime
+from urllib.parse import urlencode
 from ..items import ArticleItem
 from ..utils import utils
+from .. import extraction
 import time
 import re
 
 root = 'https://www.der-postillon.com/p/das-postillon-archiv.html'
+# Blogger feed of all posts, loaded by the archive widget. Paged by start-index/max-results, filtered by published date
+feed_url = 'https://www.der-postillon.com/feeds/posts/summary'
+FEED_PAGE_SIZE = 150      # maximum of max-results accepted by Blogger
+FIRST_ARCHIVE_YEAR = 2008
+
+# 'feed': discover articles with one feed request per month, fetched concurrently by scrapy
+# 'selenium': click through the archive widget in a headless browser of the BrowserPoolDownloaderMiddleware
+#             (fallback if the feed is unavailable, the browser is selected by BROWSER_DRIVER in settings.py)
+# can be set per run: scrapy crawl postillon -a archive_mode=selenium
+ARCHIVE_MODE = 'feed'
 
 # For deployment: don't forget to set the testrun variables to 0
 # limits number of articles. If 0/False, no limit.
@@ -26,8 +33,6 @@ YEAR_TO_CRAWL = datetime.now().year  # If False or 0, crawl all years
 # limits to crawl only articles of the year beginning with the specified month (newer or equal). If False or 0, crawl entire year. Requires YEAR_TO_CRAWL to not be False
 LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL = datetime.now().month  # False
 
-# Option to select eitcher Chrome or Firefox webdriver (because of compatibility-issues with Firefox during deployment on Debian)
-SELENIUM_DRIVER = 'Chromium' # 'Firefox'  
 
 AUTHOR_DIC = {
     "ssi": "Stefan Sichermann",
@@ -51,182 +56,293 @@ AUTHOR_DIC = {
 }
 #  sch, rag, adl, evw, kop, loc/hei, tom
 
+# metadata of the article pages, the other fields are parsed in parse_article
+ARTICLE_SPEC = extraction.Spec([
+    # value of the content attribute from any meta tag with the attribute property="og:title" (the first one is used)
+    extraction.field('title', xpath=['//meta[@property="og:title"]/@content']),
+    # value of the content attribute of any meta tag with attribute name='description' or name="twitter:description"
+    extraction.field('description', xpath=['//meta[@name="description" or @name="twitter:description"]/@content']),
+    # value of the content attribute from any meta tag with the attribute property='og:image'
+    extraction.field('image_links', 'list', xpath=['//meta[@property="og:image"]/@content'],
+                     post=lambda image_links: utils.add_host_to_url_list(utils(), image_links, root)),
+    # link from any a-tag contained in any div with atribute itemprop='articleBody'
+    extraction.field('links', 'list', xpath=['.//div[@itemprop="articleBody"]//a/@href']),
+])
+
+
+def expand_archive(driver):
+    '''
+    Open the closed years/months of the archive widget and wait until their articles are loaded.
+    Called by the BrowserPoolDownloaderMiddleware in a worker thread, after the archive page is loaded.
+
+    Parameters
+    ----------
+    driver:
+        selenium driver showing the archive page
+    '''
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
+
+    def get_closed_elements():
+        '''
+        Returns all or some closed year and month elements, depending on the limit definitions.
 
-class PostillonSpider(scrapy.Spider):
-    name = "postillon"
-    start_url = root
+        Returns
+        -------
+        All or some closed year and month elements, depending on the limit definitions.
+        '''
+        # Get all closed months of year to crawl, that are newer or equal to the limit specified by LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL
+        if LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL:
+            # get year
+            element_of_YEAR_TO_CRAWL = driver.find_element(By.CLASS_NAME, 'year-' + str(YEAR_TO_CRAWL))
 
-    def start_requests(self):
+            # Get closed months
+            xpath = ".//li[contains(@class, 'closed') and (contains(@class, 'month-12')"
+            for month in range(LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL-1, 12):
+                xpath += " or contains(@class, 'month-" + "{:02d}".format(month+1) + "')"
+            xpath = xpath + ")]"
+
+            closed_elements = element_of_YEAR_TO_CRAWL.find_elements(By.XPATH, xpath)
+            closed_elements.append(element_of_YEAR_TO_CRAWL)
+
+        # Get all closed months of year to crawl
+        elif YEAR_TO_CRAWL:
+            element_of_YEAR_TO_CRAWL = driver.find_element(By.CLASS_NAME, 'year-' + str(YEAR_TO_CRAWL))
+
+            closed_elements = element_of_YEAR_TO_CRAWL.find_elements(By.CLASS_NAME, 'closed')
+            closed_elements.append(element_of_YEAR_TO_CRAWL)
+
+        # Get all closed years/months of the entire archive
+        else:
+            # also finds closed months inside closed years
+            closed_elements = driver.find_elements(By.CLASS_NAME, 'closed')
+
+        return closed_elements
+
+    def waitForLoad():
         '''
-        Generates a request for the URL specified in start_url and defines self.parse as callback function, if TESTRUN_ARTICLE_URL is not defined. 
-        Else a request for TESTRUN_ARTICLE_URL is genereated and self.parse_article is defined as callback function.
+        Wait until at 1 article per year has been loaded. 
+        If the current year is being crawled wait until an article of january or LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL 
+        has been loaded (Because the current month of the current year is already loaded on page load).
+
         '''
-        if TESTRUN_ARTICLE_URL:
-            yield scrapy.Request(TESTRUN_ARTICLE_URL, callback=self.parse_article, cb_kwargs=dict(long_url=TESTRUN_ARTICLE_URL, published_time="13.11.2020"))
-        else:
-            yield scrapy.Request(self.start_url, callback=self.parse)
+        CURRENT_YEAR = datetime.now().year
+        TIMEOUT = 20
+        wait = WebDriverWait(driver, TIMEOUT)
+        try:
+            # xpath for tag that with class 'date' and content that includes '2020' or '1.2020' or '<LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL>.2020',
+            # depending on what is to be crawled
+            xpath = "//a/div/div/div[contains(@class, 'date') and contains(string(), '"
+            if YEAR_TO_CRAWL:
+                # If the current year is crawled wait for an article of the first month to be loaded.
+                # This is necessary because the current month is already loaded on page load.
+                if YEAR_TO_CRAWL == CURRENT_YEAR:
+                    if LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL:
+                        xpath += str(LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL) + "."
+                    else:
+                        xpath += "1."
+
+                xpath += str(YEAR_TO_CRAWL) + "')]"
+                wait.until(EC.presence_of_element_located(
+                    (By.XPATH, xpath)))
+
+            # Wait for 1 artile per year
+            else:
+                base_xpath = xpath
+                for i in range(FIRST_ARCHIVE_YEAR, CURRENT_YEAR+1):
+                    # xpath for tag with class 'date' and the content that includes the year i
+                    xpath = base_xpath + str(i) + "')]"
+                    wait.until(EC.presence_of_element_located(
+                        (By.XPATH, xpath)))
+
+        except TimeoutException as e:
+            logging.warning(
+                "TimeoutException has been thrown while waiting for articles to load: %s", e)
+
+    def click_elements(elements):
+        '''"
+        Click all elements in elements
 
-    def parse(self, response):
-        ''' 
-        Scrape archive for articles
         Parameters
         ----------
-        self:
-            the PostillonSpider object
-        response:
-            The response from a scrapy request
+        elements:
+            HTML Elements to be clicked
         '''
-        def init_selenium_driver():
+        for element in elements:
+            try:
+                # element.click() causes Exception: "could not be scrolled into view"
+                driver.execute_script("arguments[0].click();", element)
 
-            '''
-            Initialize and return a firefox or chorme selenium driver depending on the option SELENIUM_DRIVER 
+            except Exception as e:
+                logging.warning(
+                    "An exception has been thrown while clicking closed years/months: %s", e)
 
-            Returns
-            -------
-            A firefox or chrome selenium driver depending on the option SELENIUM_DRIVER
-            '''
-            if SELENIUM_DRIVER == 'Firefox':
-                firefoxOptions = webdriver.FirefoxOptions()
-                firefoxOptions.headless = True
-                desired_capabilities = firefoxOptions.to_capabilities()
-                driver = webdriver.Firefox(desired_capabilities=desired_capabilities)
-            else: # Chrome driver
-                chrome_options = Options()
-                chrome_options.headless = True
-                driver = webdriver.Chrome(options=chrome_options)
-            return driver
-
-        def get_closed_elements():
-            '''
-            Returns all or some closed year and month elements, depending on the limit definitions.
+    # Close all years/months
+    click_elements(driver.find_elements(By.CLASS_NAME, 'open'))
 
-            Returns
-            -------
-            All or some closed year and month elements, depending on the limit definitions.
-            '''
-            # Get all closed months of year to crawl, that are newer or equal to the limit specified by LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL
-            if LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL:
-                # get year
-                element_of_YEAR_TO_CRAWL = driver.find_element_by_class_name(
-                    'year-' + str(YEAR_TO_CRAWL))
-
-                # Get closed months
-                xpath = ".//li[contains(@class, 'closed') and (contains(@class, 'month-12')"
-                for month in range(LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL-1, 12):
-                    month_plus_1 = month + 1
-                    xpath += " or contains(@class, 'month-" + "{:02d}".format(month+1) + "')"
-                xpath = xpath + ")]"
-
-                closed_elements = element_of_YEAR_TO_CRAWL.find_elements_by_xpath(
-                    xpath)
-                closed_elements.append(element_of_YEAR_TO_CRAWL)
-
-            # Get all closed months of year to crawl
-            elif YEAR_TO_CRAWL:
-                element_of_YEAR_TO_CRAWL = driver.find_element_by_class_name(
-                    'year-' + str(YEAR_TO_CRAWL))
-
-                closed_elements = element_of_YEAR_TO_CRAWL.find_elements_by_class_name(
-                    'closed')
-                closed_elements.append(element_of_YEAR_TO_CRAWL)
-
-            # Get all closed years/months of the entire archive
-            else:
-                # also finds closed months inside closed years
-                closed_elements = driver.find_elements_by_class_name('closed')
+    # Open closed years/months to load articles
+    click_elements(get_closed_elements())
 
-            return closed_elements
+    # Wait for articles to be loaded
+    waitForLoad()
 
-        def waitForLoad():
-            '''
-            Wait until at 1 article per year has been loaded. 
-            If the current year is being crawled wait until an article of january or LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL 
-            has been loaded (Because the current month of the current year is already loaded on page load).
 
-            '''
-            CURRENT_YEAR = datetime.now().year
-            TIMEOUT = 20
-            wait = WebDriverWait(driver, TIMEOUT)
-            try:
-                # xpath for tag that with class 'date' and content that includes '2020' or '1.2020' or '<LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL>.2020',
-                # depending on what is to be crawled
-                xpath = "//a/div/div/div[contains(@class, 'date') and contains(string(), '"
-                if YEAR_TO_CRAWL:
-                    # If the current year is crawled wait for an article of the first month to be loaded.
-                    # This is necessary because the current month is already loaded on page load.
-                    if YEAR_TO_CRAWL == CURRENT_YEAR:
-                        if LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL:
-                            xpath += str(LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL) + "."
-                        else:
-                            xpath += "1."
-
-                    xpath += str(YEAR_TO_CRAWL) + "')]"
-                    wait.until(EC.presence_of_element_located(
-                        (By.XPATH, xpath)))
+class PostillonSpider(scrapy.Spider):
+    name = "postillon"
+    start_url = root
+    archive_mode = ARCHIVE_MODE
 
-                # Wait for 1 artile per year
-                else:
-                    base_xpath = xpath
-                    for i in range(2008, CURRENT_YEAR+1):
-                        # xpath for tag with class 'date' and the content that includes the year i
-                        xpath = base_xpath + str(i) + "')]"
-                        wait.until(EC.presence_of_element_located(
-                            (By.XPATH, xpath)))
-
-            except TimeoutException as e:
-                logging.warning(
-                    "TimeoutException has been thrown while waiting for articles to load: %s", e)
+    def start_requests(self):
+        '''
+        Generates a request for TESTRUN_ARTICLE_URL with self.parse_article as callback function, if TESTRUN_ARTICLE_URL is defined.
+        Else one feed request per month to crawl (archive_mode 'feed') or a request for the archive page
+        with self.parse as callback function (archive_mode 'selenium') is generated.
+        '''
+        if TESTRUN_ARTICLE_URL:
+            yield scrapy.Request(TESTRUN_ARTICLE_URL, callback=self.parse_article, cb_kwargs=dict(long_url=TESTRUN_ARTICLE_URL, published_time="13.11.2020"))
+        elif self.archive_mode == 'selenium':
+            # rendered by the BrowserPoolDownloaderMiddleware
+            yield scrapy.Request(self.start_url, callback=self.parse,
+                                 meta=dict(browser=True, browser_actions=expand_archive))
+        else:
+            for published_min, published_max in self.get_months_to_crawl():
+                yield self.feed_request(published_min, published_max, 1)
 
-        def click_elements(elements):
-            '''"
-            Click all elements in elements
+    @staticmethod
+    def get_months_to_crawl(now=None):
+        '''
+        Returns the months to crawl, depending on YEAR_TO_CRAWL and LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL.
 
-            Parameters
-            ----------
-            elements:
-                HTML Elements to be clicked
-            '''
-            for element in elements:
-                try:
-                    # element.click() causes Exception: "could not be scrolled into view"
-                    driver.execute_script("arguments[0].click();", element)
-                    # print("click: " + element.get_attribute('class').split()[1])
+        Parameters
+        ----------
+        now:
+            current datetime, months after it are not crawled
 
-                except Exception as e:
-                    logging.warning(
-                        "An exception has been thrown while clicking closed years/months: %s", e)
+        Returns
+        -------
+        List of (first day of month, first day of next month) tuples, formatted for the feed parameters
+        '''
+        now = now or datetime.now()
+        if YEAR_TO_CRAWL:
+            years = [YEAR_TO_CRAWL]
+        else:
+            years = range(FIRST_ARCHIVE_YEAR, now.year + 1)
+
+        months = []
+        for year in years:
+            first_month = LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL if YEAR_TO_CRAWL and LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL else 1
+            for month in range(first_month, 13):
+                begin = datetime(year, month, 1)
+                if begin > now:
+                    break
+                end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+                months.append((begin.strftime('%Y-%m-%dT%H:%M:%S'), end.strftime('%Y-%m-%dT%H:%M:%S')))
+        return months
+
+    def feed_request(self, published_min, published_max, start_index):
+        '''
+        Request for one page of the Blogger feed
 
-        driver = init_selenium_driver()
-        driver.get(root)
+        Parameters
+        ----------
+        published_min, published_max:
+            published time range of the posts, e.g. '2020-11-01T00:00:00'
+        start_index:
+            1-based index of the first post of the page
+
+        Returns
+        -------
+        scrapy Request with self.parse_feed as callback function
+        '''
+        query = urlencode({
+            'alt': 'json',
+            'max-results': FEED_PAGE_SIZE,
+            'start-index': start_index,
+            'published-min': published_min,
+            'published-max': published_max,
+        })
+        return scrapy.Request(feed_url + '?' + query, callback=self.parse_feed,
+                              cb_kwargs=dict(published_min=published_min, published_max=published_max,
+                                             start_index=start_index))
+
+    async def parse_feed(self, response, published_min, published_max, start_index):
+        '''
+        Scrape one page of the Blogger feed for articles and request the next page of the month
 
-        # Close all years/months
-        click_elements(driver.find_elements_by_class_name('open'))
+        Parameters
+        ----------
+        self:
+            the PostillonSpider object
+        response:
+            The response from a feed request
+        published_min, published_max, start_index:
+            the parameters of the feed request
+        '''
+        feed = json.loads(response.text)['feed']
+        entries = feed.get('entry', [])
 
-        # Open closed years/months to load articles
-        click_elements(get_closed_elements())
+        total = int(feed.get('openSearch$totalResults', {}).get('$t', 0))
+        if entries and start_index + len(entries) <= total:
+            yield self.feed_request(published_min, published_max, start_index + len(entries))
 
-        # Wait for articles to be loaded
-        waitForLoad()
+        articles = []
+        for entry in utils.limit_crawl(entries, TESTRUN_ARTICLES_LIMIT):
+            long_url = next((link['href'] for link in entry.get('link', []) if link.get('rel') == 'alternate'), None)
+            published_time = entry.get('published', {}).get('$t', '')
+            try:
+                # input: "2020-11-13T10:27:00.001+01:00", parse_article expects the format of the archive widget
+                published_time = datetime.strptime(published_time[:10], '%Y-%m-%d').strftime('%d.%m.%Y')
+            except ValueError:
+                published_time = ''
+            if long_url:
+                articles.append((long_url, published_time))
+
+        # one lookup for the whole feed page, the db-query runs in a worker thread if no url index is loaded
+        unseen_urls = utils.filter_unseen_async([long_url for long_url, _ in articles], self.name)
+        unseen_urls = set(await maybe_deferred_to_future(unseen_urls))
+
+        for long_url, published_time in articles:
+            if long_url in unseen_urls:
+                yield scrapy.Request(long_url, callback=self.parse_article,
+                                     cb_kwargs=dict(long_url=long_url, published_time=published_time))
+            else:
+                utils.log_event(utils(), self.name, long_url, 'exists', 'info')
+                logging.info('%s already in db', long_url)
 
-        # Hand-off between Selenium and Scrapy
-        sel = Selector(text=driver.page_source)
+    async def parse(self, response):
+        ''' 
+        Scrape archive for articles (archive_mode 'selenium').
+        The archive page has been rendered and expanded by expand_archive in a browser of the BrowserPoolDownloaderMiddleware.
 
+        Parameters
+        ----------
+        self:
+            the PostillonSpider object
+        response:
+            The response from a scrapy request
+        '''
         # for all ul tags with class 'month-inner' get all contained li tags and get their direct a-tag children
-        articleList = sel.xpath('//ul[@class="month-inner"]//li/a')
+        articleList = response.xpath('//ul[@class="month-inner"]//li/a')
 
         articleList = utils.limit_crawl(articleList, TESTRUN_ARTICLES_LIMIT)
 
         if articleList:
-            for article in articleList:
-                # extract the value of the href attribute from article
-                long_url = article.xpath('./@href').extract()[0]
+            # extract the value of the href attribute from every article
+            long_urls = [article.xpath('./@href').extract()[0] for article in articleList]
+            # one lookup for the whole archive, the db-query runs in a worker thread if no url index is loaded
+            unseen_urls = utils.filter_unseen_async([url for url in long_urls if url], self.name)
+            unseen_urls = set(await maybe_deferred_to_future(unseen_urls))
+
+            for article, long_url in zip(articleList, long_urls):
                 # extract the content of div-tags with class 'date' contained by article
                 published_time = article.xpath(
                     './/div[@class="date"]/text()').extract()
                 published_time = published_time[0] if len(
                     published_time) > 0 else ''
 
-                if long_url and not utils.is_url_in_db(long_url):
+                if long_url and long_url in unseen_urls:
                     yield scrapy.Request(long_url, callback=self.parse_article,  cb_kwargs=dict(long_url=long_url, published_time=published_time))
 
                 else:
@@ -234,9 +350,6 @@ class PostillonSpider(scrapy.Spider):
                                     long_url, 'exists', 'info')
                     logging.info('%s already in db', long_url)
 
-        # Quit the selenium driver and close every associated window
-        driver.quit()
-
     def parse_article(self, response, long_url, published_time):
         '''
         Parse the article contained in response and save the results (and long_url, published_time) in an ArticleItem.
@@ -264,24 +377,10 @@ class PostillonSpider(scrapy.Spider):
             -------
             The text of the article
             '''
-            article_paragraphs = []
-            # extract any p, a or b tag contained in a div with class 'post hentry'
+            # extract the text of any p, a or b tag contained in a div with class 'post hentry'
             tags = response.xpath(
-                '//div[@class="post hentry"]//p|a|b').extract()
-            for tag in tags:
-                line = ""
-                tag_selector = Selector(text=tag)
-                # extract the text from all tags contained in tag_selector
-                text_list = tag_selector.xpath('//text()').extract()
-                for text_part in text_list:
-                    line += text_part
-                article_paragraphs.append(line)
-
-            article_text = ""
-            for paragraph in article_paragraphs:
-                if paragraph:
-                    article_text += paragraph + "\n\n"
-            text = article_text.strip()
+                '//div[@class="post hentry"]//p|a|b')
+            text = utils.extract_text(tags)
 
             if not text:
                 # Alternative article layout. Examples https://www.der-postillon.com/2019/11/deutsche-bahn-hack.html , 'https://www.der-postillon.com/2020/02/fehler-stabhochsprung.html'
@@ -398,31 +497,22 @@ class PostillonSpider(scrapy.Spider):
 
             return authors
 
+        fields = utils.extract_fields(ARTICLE_SPEC, response, long_url, self.name)
         item = ArticleItem()
 
         item['crawl_time'] = datetime.now()
         item['long_url'] = utils.add_host_to_url(utils_obj, long_url, root)
         item['short_url'] = long_url
         item['news_site'] = "postillon"
-        # xpath: value of the content attribute from any meta tag with the attribute property="og:title". (in get_item_string() the first matching meta tag will be used)
-        item['title'] = utils.get_item_string(utils_obj, response, 'title', long_url, 'xpath',
-                                              ['//meta[@property="og:title"]/@content'], self.name)
+        item['title'] = fields['title']
         item['authors'] = get_authors()
-        # xpath: value of the content attribute of any meta tag with attribute name='description' or name="twitter:description"
-        item['description'] = utils.get_item_string(utils_obj, response, 'description', long_url, 'xpath',
-                                                    ['//meta[@name="description" or @name="twitter:description"]/@content'], self.name)
+        item['description'] = fields['description']
         item['intro'] = item['description']
         item['text'] = get_article_text()
         item['keywords'] = get_keywords()
         item['published_time'] = get_pub_time()
-        # xpath: value of the content attribute from any meta tag with the attribute property='og:image'
-        image_links = utils.get_item_list(utils_obj, response, 'image_links', long_url, 'xpath',
-                                          ['//meta[@property="og:image"]/@content'], self.name)
-        item['image_links'] = utils.add_host_to_url_list(
-            utils_obj, image_links, root)  # if image_link starts with '/' prepend host
-        # xpath: link fromm any a-tag contained in any div with atribute itemprop='articleBody'
-        item['links'] = utils.get_item_list(utils_obj, response, 'links', long_url, 'xpath',
-                                            ['.//div[@itemprop="articleBody"]//a/@href'], self.name)
+        item['image_links'] = fields['image_links']  # if image_link starts with '/' prepend host
+        item['links'] = fields['links']
 
         # Print parsed article
         # print(item['crawl_time'], item['long_url'], item['short_url'], item['news_site'], item['title'], item['authors'],
@@ -0,0 +1,127 @@
+import scrapy
+import logging
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from ..items import RevisionItem
+from ..utils import utils
+from . import heise_spider, sueddeutsche_spider
+from .golem_spider import PostsSpider as GolemSpider
+from .heise_spider import HeiseSpider
+from .postillon_spider import PostillonSpider
+from .sueddeutsche_spider import SueddeutscheSpider
+from .taz_spider import TazSpider
+
+news_sites = ('heise', 'taz', 'sz', 'postillon', 'golem')   # can be set per run: scrapy crawl recrawl -a sites=heise,taz
+changed_fields = ('title', 'authors', 'intro', 'text', 'image_links', 'links')  # fields replaced in updated articles
+
+
+class RecrawlSpider(scrapy.Spider):
+    '''
+    Revisits the articles published in the last RECRAWL_DAYS days (scrapy crawl recrawl -a days=3)
+    and saves the articles whose title or text changed since they were crawled.
+
+    Every article is requested once, with If-Modified-Since set to the time it was crawled, and parsed
+    by the parse_article of its news site. Only articles with a changed content hash are passed on
+    to the RevisionPipeline, which saves them with bulk updates and keeps a short revision history.
+    '''
+    name = "recrawl"
+    custom_settings = {
+        'ITEM_PIPELINES': {'inews_crawler.pipelines.RevisionPipeline': 300},
+    }
+
+    def __init__(self, sites=None, days=None, *args, **kwargs):
+        super(RecrawlSpider, self).__init__(*args, **kwargs)
+        self.sites = sites.split(',') if sites else list(news_sites)
+        self.days = days
+        # parse_article of the news site spiders, the spiders are not crawled themselves
+        self.site_spiders = {'heise': HeiseSpider(), 'taz': TazSpider(), 'sz': SueddeutscheSpider(),
+                             'postillon': PostillonSpider(), 'golem': GolemSpider()}
+
+    def start_requests(self):
+        days = float(self.days) if self.days else self.settings.getfloat('RECRAWL_DAYS', 3)
+        documents = utils.get_recrawl_candidates(self.sites, datetime.now() - timedelta(days=days))
+        logging.info("Recrawling %d articles published in the last %s days", len(documents), days)
+        self.crawler.stats.set_value('recrawl/candidates', len(documents), spider=self)
+        for document in documents:
+            yield self.article_request(document)
+
+    def article_request(self, document):
+        '''
+        Conditional request of a saved article, the response is parsed like in the spider of its news site
+
+        Parameters
+        ----------
+        document:
+            article as returned by utils.get_recrawl_candidates
+
+        Returns
+        -------
+        scrapy Request
+        '''
+        news_site = document['news_site']
+        long_url, short_url = document['long_url'], document['short_url']
+        if news_site == 'heise':
+            url = long_url + heise_spider.full_article_addition
+            parse_kwargs = dict(description=document.get('description'), long_url=long_url, short_url=short_url,
+                                department_name=None)
+        elif news_site == 'sz':
+            url = long_url + sueddeutsche_spider.full_article_addition
+            parse_kwargs = dict(description=document.get('description'), short_url=short_url, long_url=long_url,
+                                dep=None)
+        elif news_site == 'taz':
+            url = short_url + "/"
+            parse_kwargs = dict(short_url=short_url, long_url=long_url)
+        elif news_site == 'postillon':
+            url = long_url
+            published_time = document.get('published_time')
+            parse_kwargs = dict(long_url=long_url,
+                                published_time=published_time.strftime('%d.%m.%Y') if published_time else '')
+        else:
+            url = long_url
+            parse_kwargs = dict()
+
+        if news_site == 'golem':
+            # cookies of the golem spider bypass the cookie wall
+            request = self.site_spiders['golem'].request(url, self.parse_article)
+        else:
+            request = scrapy.Request(url, callback=self.parse_article)
+        request.cb_kwargs.update(document=document, parse_kwargs=parse_kwargs)
+        request.meta['handle_httpstatus_list'] = [304]
+        # crawl_time is a naive local time, as saved by the spiders
+        modified = document.get('updated_time') or document.get('crawl_time')
+        if modified:
+            request.headers['If-Modified-Since'] = format_datetime(modified.astimezone(timezone.utc), usegmt=True)
+        return request
+
+    def parse_article(self, response, document, parse_kwargs):
+        stats = self.crawler.stats
+        short_url = document['short_url']
+        if response.status == 304:
+            stats.inc_value('recrawl/not_modified', spider=self)
+            return
+
+        site_spider = self.site_spiders[document['news_site']]
+        items = list(site_spider.parse_article(response, **parse_kwargs))
+        if not items:
+            stats.inc_value('recrawl/unparsed', spider=self)
+            logging.info("Cannot parse recrawled article: %s", short_url)
+            return
+
+        article = items[0]
+        content_hash = utils.content_hash(article.get('title'), article.get('text'))
+        if content_hash == document.get('content_hash'):
+            stats.inc_value('recrawl/unchanged', spider=self)
+            return
+
+        stats.inc_value('recrawl/changed', spider=self)
+        changes = dict((name, article.get(name)) for name in changed_fields)
+        changes['content_hash'] = content_hash
+        changes['updated_time'] = article['crawl_time']
+
+        item = RevisionItem()
+        item['short_url'] = short_url
+        item['news_site'] = document['news_site']
+        item['changes'] = changes
+        item['revision'] = {'content_hash': document.get('content_hash'), 'title': document.get('title'),
+                            'crawl_time': document.get('updated_time') or document.get('crawl_time')}
+        yield item
@@ -4,11 +4,15 @@ from datetime import datetime
 import logging
 from ..items import ArticleItem
 from ..utils import utils
+from .. import feeds
+from .. import extraction
+from scrapy.utils.defer import maybe_deferred_to_future
 import sys
 
 root = 'https://sueddeutsche.de'
 short_url_regex = "\d(\.|\d)+$" # helps converting long to short url: https://sueddeutsche.de/1.3456789
 full_article_addition = '-0'    # if article extends over multiple pages this url addition will get the full article
+feed_url = 'https://rss.sueddeutsche.de/app/service/rss/alles/index.rss?output=rss'   # RSS feed of all new articles
 
 testrun_cats = 5                # limits the categories to crawl to this number. if zero, no limit.
 testrun_arts = 5                # limits the article links to crawl per category page to this number. if zero, no limit.
@@ -18,11 +22,58 @@ limit_pages = 1                 # additional category pages of 50 articles each.
                                 # => 2. daily use: 0 or 1
                                 # don't forget to set the testrun variables to zero
 
+discovery_mode = 'category'     # 'category': crawl main page and category pages for article links
+                                # 'feed': only articles of the feed updated since the last finished crawl (daily use)
+                                # can be set per run: scrapy crawl sueddeutsche -a discovery=feed
+
+# metadata of the article pages, intro, text and published time are parsed in parse_article
+article_spec = extraction.Spec([
+    extraction.field('title', xpath=['//meta[@property="og:title"]/@content']),
+    extraction.field('authors', 'list', xpath=['//meta[@name="author"]/@content']),
+    extraction.field('keywords', 'split', xpath=['//meta[@name="keywords"]/@content'], split=',',
+                     post=lambda keywords: list(set(keywords) - {"Süddeutsche Zeitung"})),
+    extraction.field('image_links', 'list', xpath=['//meta[@property="og:image"]/@content']),
+    extraction.field('links', 'list', xpath=['//div[@class="sz-article__body sz-article-body"]/p/a/@href'],
+                     post=lambda links: utils.add_host_to_url_list(utils(), links, root)),
+])
+
 
 class SueddeutscheSpider(scrapy.Spider):
     name = "sueddeutsche"
     name_short = "sz"
     start_urls = [root]
+    discovery = discovery_mode
+
+    def start_requests(self):
+        if self.discovery == 'feed':
+            yield scrapy.Request(feed_url, callback=self.parse_feed,
+                                 cb_kwargs=dict(since=utils.get_discovery_since(self)))
+        else:
+            for url in self.start_urls:
+                yield scrapy.Request(url, callback=self.parse)
+
+    # read the feed for new articles
+    async def parse_feed(self, response, since):
+        utils_obj = utils()
+
+        entries = feeds.entries_since(feeds.parse_feed(response.body), since)
+        entries = utils.limit_crawl(entries, testrun_arts)
+
+        short_urls = [utils.get_short_url(entry.url, root, short_url_regex) for entry in entries]
+        # one lookup for the whole feed, the db-query runs in a worker thread if no url index is loaded
+        unseen_urls = utils.filter_unseen_async([url for url in short_urls if url], self.name_short)
+        unseen_urls = set(await maybe_deferred_to_future(unseen_urls))
+
+        for entry, short_url in zip(entries, short_urls):
+            if short_url and short_url in unseen_urls:
+                # department: first part of the path, https://www.sueddeutsche.de/politik/...
+                dep = entry.url.split("/")[3] if entry.url.count("/") > 3 else ""
+                yield scrapy.Request(entry.url+full_article_addition, callback=self.parse_article,
+                                     cb_kwargs=dict(description=entry.description or "", long_url=entry.url,
+                                                    short_url=short_url, dep=dep))
+            else:
+                utils.log_event(utils_obj, self.name_short, short_url, 'exists', 'info')
+                logging.info("%s already in db", short_url)
 
     # scrape main page for categories
     def parse(self, response):
@@ -31,12 +82,14 @@ class SueddeutscheSpider(scrapy.Spider):
 
         for department_url in departments:
             dep = department_url.split("/")[-1]
+            # skipped by the ConditionalRequestMiddleware if unchanged since the last crawl
             yield scrapy.Request(department_url,
                                  callback=self.parse_category,
-                                 cb_kwargs=dict(department=dep, department_url=department_url))
+                                 cb_kwargs=dict(department=dep, department_url=department_url),
+                                 meta=dict(conditional=True))
 
     # scrape category pages for articles
-    def parse_category(self, response, department, department_url):
+    async def parse_category(self, response, department, department_url):
 
         departmentIds = {
             "politik": "sz.2.236",
@@ -65,9 +118,14 @@ class SueddeutscheSpider(scrapy.Spider):
         links = utils.limit_crawl(links,testrun_arts)
 
 
+        short_urls = [utils.get_short_url(link, root, short_url_regex) for link in links]
+        # one lookup for the whole page, the db-query runs in a worker thread if no url index is loaded
+        unseen_urls = utils.filter_unseen_async([url for url in short_urls if url], self.name_short)
+        unseen_urls = set(await maybe_deferred_to_future(unseen_urls))
+
         for i in range(len(links)):
-            short_url = utils.get_short_url(links[i],root, short_url_regex)
-            if short_url and not utils.is_url_in_db(short_url):            #db-query
+            short_url = short_urls[i]
+            if short_url and short_url in unseen_urls:
                 description = utils.get_item_string(utils_obj, articles[i], 'description', department_url, 'css',
                                                     [".sz-teaser__summary::text"], self.name_short)
                 yield scrapy.Request(links[i]+full_article_addition, callback=self.parse_article,
@@ -124,6 +182,7 @@ class SueddeutscheSpider(scrapy.Spider):
         paywall = response.xpath('//offer-page').get()
         if not paywall:
 
+            fields = utils.extract_fields(article_spec, response, short_url, self.name_short)
             item = ArticleItem()
 
             item['crawl_time'] = datetime.now()
@@ -131,26 +190,18 @@ class SueddeutscheSpider(scrapy.Spider):
             item['short_url'] = short_url
 
             item['news_site'] = "sz"
-            item['title'] = utils.get_item_string(utils_obj, response, 'title', short_url, 'xpath',
-                                                  ['//meta[@property="og:title"]/@content'], self.name_short)
-            item['authors'] = utils.get_item_list(utils_obj, response, 'authors', short_url, 'xpath',
-                                                    ['//meta[@name="author"]/@content'], self.name_short)
+            item['title'] = fields['title']
+            item['authors'] = fields['authors']
 
             item['description'] = description
             item['intro'] = get_intro()
             item['text'] = get_article_text()
 
-            keywords = utils.get_item_list_from_str(utils_obj, response, 'keywords', short_url, 'xpath',
-                                                            ['//meta[@name="keywords"]/@content'],',', self.name_short)
-            item['keywords'] = list(set(keywords) - {"Süddeutsche Zeitung"})
+            item['keywords'] = fields['keywords']
 
             item['published_time'] = get_pub_time()
-            item['image_links'] = utils.get_item_list(utils_obj, response, 'image_links', short_url, 'xpath',
-                                                               ['//meta[@property="og:image"]/@content'], self.name_short)
-
-            links =  utils.get_item_list(utils_obj, response, 'links', short_url, 'xpath',
-                                         ['//div[@class="sz-article__body sz-article-body"]/p/a/@href'], self.name_short)
-            item['links'] = utils.add_host_to_url_list(utils_obj, links, root)
+            item['image_links'] = fields['image_links']
+            item['links'] = fields['links']
 
             # don't save article without title or text
             if item['title'] and item['text']:
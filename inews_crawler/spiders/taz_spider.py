@@ -1,24 +1,82 @@
 import scrapy
-from scrapy import Selector
 import logging
 from datetime import datetime
 from ..items import ArticleItem
 from ..utils import utils
+from .. import feeds
+from .. import extraction
+from scrapy.utils.defer import maybe_deferred_to_future
 
 root = 'https://taz.de'
 short_url_regex = "!\d{5,}"         # helps converting long to short url: https://taz.de/!2345678/
+feed_url = 'https://taz.de/!p4608;rss/'   # RSS feed of all new articles
+
+discovery_mode = 'category'         # 'category': crawl main page and category pages for article links
+                                    # 'feed': only articles of the feed updated since the last finished crawl (daily use)
+                                    # can be set per run: scrapy crawl taz -a discovery=feed
 
 testrun_cats = 0                    # limits the categories to crawl to this number. if zero, no limit.
 testrun_arts = 0                   # limits the article links to crawl to this number. if zero, no limit.
                                     # For deployment: don't forget to set the testrun variables to zero
 
+# taz.de has different classes of links which direct to an article
+link_classes = ("objlink report article",
+                "objlink report article leaded pictured",
+                "objlink report article leaded pictured noavatar",
+                "objlink longread article leaded pictured noavatar",
+                "objlink brief report article leaded",
+                "objlink brief report article leaded noavatar",
+                "objlink brief report article pictured",
+                "objlink subjective commentary article",
+                "objlink brief subjective column article leaded")
+article_links = extraction.compile_expression(
+    'xpath', '//a[' + ' or '.join('(@class="%s")' % link_class for link_class in link_classes) + ']/@href')
+
+
+def add_host(urls):
+    return utils.add_host_to_url_list(utils(), urls, root)
+
+# metadata of the article pages, text and published time are parsed in parse_article
+article_spec = extraction.Spec([
+    extraction.field('title', xpath=['//meta[@property="og:title"]/@content']),
+    extraction.field('authors', 'list', xpath=['//meta[@name="author"]/@content']),
+    extraction.field('description', xpath=['//meta[@name="description"]/@content']),
+    extraction.field('intro', xpath=['//article/p[@class="intro "]/text()']),
+    extraction.field('keywords', 'split', xpath=['//meta[@name="keywords"]/@content'], split=', ',
+                     post=lambda keywords: list(set(keywords) - {"taz", "tageszeitung "})),
+    extraction.field('image_links', 'list', xpath=['//meta[@property="og:image"]/@content'], post=add_host),
+    extraction.field('links', 'list', xpath=['//article /p[@xmlns=""]/a/@href'], post=add_host),
+])
+
 class TazSpider(scrapy.Spider):
     name = "taz"
     start_url = root
+    discovery = discovery_mode
 
 
     def start_requests(self):
-        yield scrapy.Request(self.start_url, callback=self.parse)
+        if self.discovery == 'feed':
+            yield scrapy.Request(feed_url, callback=self.parse_feed,
+                                 cb_kwargs=dict(since=utils.get_discovery_since(self)))
+        else:
+            yield scrapy.Request(self.start_url, callback=self.parse)
+
+    # read the feed for new articles
+    async def parse_feed(self, response, since):
+        entries = feeds.entries_since(feeds.parse_feed(response.body), since)
+        entries = utils.limit_crawl(entries, testrun_arts)
+
+        short_urls = [utils.get_short_url(entry.url, root, short_url_regex) for entry in entries]
+        # one lookup for the whole feed, the db-query runs in a worker thread if no url index is loaded
+        unseen_urls = utils.filter_unseen_async([url for url in short_urls if url], self.name)
+        unseen_urls = set(await maybe_deferred_to_future(unseen_urls))
+        for entry, short_url in zip(entries, short_urls):
+            if short_url and short_url in unseen_urls:
+                yield scrapy.Request(short_url+"/", callback=self.parse_article,
+                                     cb_kwargs=dict(short_url=short_url, long_url=entry.url))
+            else:
+                utils.log_event(utils(), self.name, short_url, 'exists', 'info')
+                logging.info('%s already in db', short_url)
 
     # scrape main page for categories
     def parse(self, response):
@@ -26,39 +84,22 @@ class TazSpider(scrapy.Spider):
         categories = utils.limit_crawl(categories,testrun_cats)
         for cat in categories:
             cat = utils.add_host_to_url(self, cat, root)
-            yield scrapy.Request(url=cat, callback=self.parse_category)
+            # skipped by the ConditionalRequestMiddleware if unchanged since the last crawl
+            yield scrapy.Request(url=cat, callback=self.parse_category, meta=dict(conditional=True))
 
     # scrape category pages for articles
-    def parse_category(self, response):
+    async def parse_category(self, response):
 
-        # taz.de has different classes of links which direct to an article
-        def getLinkselector():
-            linkclasses = [
-                "objlink report article",
-                "objlink report article leaded pictured",
-                "objlink report article leaded pictured noavatar",
-                "objlink longread article leaded pictured noavatar",
-                "objlink brief report article leaded",
-                "objlink brief report article leaded noavatar",
-                "objlink brief report article pictured",
-                "objlink subjective commentary article",
-                "objlink brief subjective column article leaded"]
-
-            linkselector = '//a[(@class=\"'
-            linkselector_middle = '\") or (@class=\"'
-            linkselector_end = '\")]/@href'
-            for linkclass in linkclasses:
-                linkselector+=linkclass + linkselector_middle
-            linkselector = linkselector[:-len(linkselector_middle)] + linkselector_end
-            return linkselector
-
-        linklist = response.xpath(getLinkselector()).extract()
+        linklist = extraction.select(response, article_links)
         linklist = utils.limit_crawl(linklist,testrun_arts)
 
         if len(linklist) > 0:
-            for long_url in linklist:
-                short_url = utils.get_short_url(long_url, root, short_url_regex)
-                if short_url and not utils.is_url_in_db(short_url):  # db-query
+            short_urls = [utils.get_short_url(long_url, root, short_url_regex) for long_url in linklist]
+            # one lookup for the whole page, the db-query runs in a worker thread if no url index is loaded
+            unseen_urls = utils.filter_unseen_async([url for url in short_urls if url], self.name)
+            unseen_urls = set(await maybe_deferred_to_future(unseen_urls))
+            for long_url, short_url in zip(linklist, short_urls):
+                if short_url and short_url in unseen_urls:
                     yield scrapy.Request(short_url+"/", callback=self.parse_article,
                                          cb_kwargs=dict(short_url=short_url, long_url=long_url))
                 else:
@@ -70,24 +111,15 @@ class TazSpider(scrapy.Spider):
 
         utils_obj = utils()
 
+        # only p tags with 'xmlns="" and class beginning with "article..." (=paragraphs)
+        # or h6-tags (=subheadings)
+        def is_text_block(element):
+            return element.tag == 'h6' or \
+                   (element.get('xmlns') == '' and element.get('class', '').startswith('article'))
+
         def get_article_text():
-            article_paragraphs = []
-            html_article = response.xpath('//article/*').extract()      # every tag in <article>
-            for tag in html_article:
-                line = ""
-                # only p tags with 'xmlns="" and class beginning with "article..." (=paragraphs)
-                # or h6-tags (=subheadings)
-                if "p xmlns=\"\" class=\"article" in tag or tag[2]=="6":
-                    tag_selector = Selector(text=tag)
-                    html_line = tag_selector.xpath('//*/text()').extract()
-                    for text in html_line:
-                        line+=text
-                    article_paragraphs.append(line)
-            article_text = ""
-            for paragraph in article_paragraphs:
-                if paragraph:
-                    article_text += paragraph + "\n\n"
-            text = article_text.strip()
+            html_article = response.xpath('//article/*')      # every tag in <article>
+            text = utils.extract_text(html_article, ('p', 'h6'), is_text_block)
             if not text:
                 utils.log_event(utils_obj, self.name, short_url, 'text', 'warning')
                 logging.warning("Cannot parse article text: %s", short_url)
@@ -122,6 +154,7 @@ class TazSpider(scrapy.Spider):
 
 
         # Preparing for Output -> see items.py
+        fields = utils.extract_fields(article_spec, response, short_url, self.name)
         item = ArticleItem()
 
         item['crawl_time'] = datetime.now()
@@ -129,28 +162,17 @@ class TazSpider(scrapy.Spider):
         item['short_url'] = short_url
 
         item['news_site'] = "taz"
-        item['title'] = utils.get_item_string(utils_obj, response, 'title', short_url, 'xpath',
-                                              ['//meta[@property="og:title"]/@content'], self.name)
-        item['authors'] = utils.get_item_list(utils_obj, response, 'authors', short_url, 'xpath',
-                                              ['//meta[@name="author"]/@content'], self.name)
-        item['description'] = utils.get_item_string(utils_obj, response, 'description', short_url, 'xpath',
-                                                    ['//meta[@name="description"]/@content'], self.name)
-        item['intro'] = utils.get_item_string(utils_obj, response, 'intro', short_url, 'xpath',
-                                              ['//article/p[@class="intro "]/text()'], self.name)
+        item['title'] = fields['title']
+        item['authors'] = fields['authors']
+        item['description'] = fields['description']
+        item['intro'] = fields['intro']
         item['text'] = get_article_text()
 
-        keywords = utils.get_item_list_from_str(utils_obj, response, 'keywords', short_url, 'xpath',
-                                                ['//meta[@name="keywords"]/@content'],', ', self.name)
-        item['keywords'] = list(set(keywords) - {"taz", "tageszeitung "})
+        item['keywords'] = fields['keywords']
         item['published_time'] = get_pub_time()
 
-        image_links = utils.get_item_list(utils_obj, response, 'image_links', short_url, 'xpath',
-                                          ['//meta[@property="og:image"]/@content'], self.name)
-        item['image_links'] = utils.add_host_to_url_list(utils_obj, image_links, root)
-
-        links = utils.get_item_list(utils_obj, response, 'links', short_url, 'xpath',
-                                    ['//article /p[@xmlns=""]/a/@href'], self.name)
-        item['links'] = utils.add_host_to_url_list(utils_obj, links, root)
+        item['image_links'] = fields['image_links']
+        item['links'] = fields['links']
 
         # don't save article without title or text
         if item['title'] and item['text']:
@@ -0,0 +1,99 @@
+# In-memory index of article urls already saved in the database
+from array import array
+from bisect import bisect_left
+import hashlib
+import logging
+
+
+class UrlIndex(object):
+    '''
+    Compact set of the short_urls of one news site that are already in the article collection.
+
+    Instead of keeping millions of url strings, every url is stored as a 64-bit hash:
+    the urls loaded from the database are kept in a sorted array, urls added during the crawl in a small set.
+    '''
+
+    def __init__(self, news_site):
+        self.news_site = news_site
+        self._hashes = array('Q')   # sorted hashes of the urls loaded from the database
+        self._added = set()         # hashes of the urls added since loading
+
+    @staticmethod
+    def hash_url(url):
+        '''
+        Map an url to a 64-bit integer
+
+        Parameters
+        ----------
+        url:
+            An url string
+
+        Returns
+        -------
+        64-bit hash of the url
+        '''
+        return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    @classmethod
+    def load(cls, collection, news_site, batch_size=10000):
+        '''
+        Stream all short_urls of a news site from the article collection into a new index
+
+        Parameters
+        ----------
+        collection:
+            pymongo collection containing the articles
+        news_site:
+            news site of the urls to load (taz, sz, heise, postillon, golem)
+        batch_size:
+            number of documents fetched per cursor round-trip
+
+        Returns
+        -------
+        UrlIndex containing all known urls of the news site
+        '''
+        index = cls(news_site)
+        cursor = collection.find({"news_site": news_site}, {"short_url": 1, "_id": 0}, batch_size=batch_size)
+        index._hashes = array('Q', sorted(cls.hash_url(doc['short_url']) for doc in cursor if doc.get('short_url')))
+        logging.info("Loaded %d known urls of %s into url index", len(index._hashes), news_site)
+        return index
+
+    def __len__(self):
+        return len(self._hashes) + len(self._added)
+
+    def _contains_hash(self, url_hash):
+        if url_hash in self._added:
+            return True
+        i = bisect_left(self._hashes, url_hash)
+        return i < len(self._hashes) and self._hashes[i] == url_hash
+
+    def __contains__(self, url):
+        return self._contains_hash(self.hash_url(url))
+
+    def add(self, url):
+        '''
+        Add an url to the index, e.g. after the article has been saved
+
+        Parameters
+        ----------
+        url:
+            short_url of the saved article
+        '''
+        url_hash = self.hash_url(url)
+        if not self._contains_hash(url_hash):
+            self._added.add(url_hash)
+
+    def filter_unseen(self, urls):
+        '''
+        Filter out all urls that are already known
+
+        Parameters
+        ----------
+        urls:
+            list of short_urls, e.g. all article links of a category page
+
+        Returns
+        -------
+        list of the urls not in the index, in their original order
+        '''
+        return [url for url in urls if url not in self]
@@ -1,38 +1,361 @@
 # Utils for spiders
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
-from pymongo import MongoClient
-from .settings import MONGO_URI, MONGO_DATABASE, ARTICLE_COLLECTION_NAME, LOG_COLLECTION_NAME
+from .settings import MONGO_URI, MONGO_DATABASE, ARTICLE_COLLECTION_NAME, LOG_COLLECTION_NAME, MONGO_THREADPOOL_SIZE, \
+    LOG_EVENT_BUFFER_SIZE, LOG_EVENT_FLUSH_INTERVAL, LOG_EVENT_AGGREGATE, LOG_EVENT_FALLBACK_PATH
 import re
+import hashlib
+import unicodedata
 from .items import LogItem
+from .url_index import UrlIndex
+from .seen_filter import SeenUrlFilter
+from .near_duplicates import NearDuplicateIndex, url_hash
+from .db_pool import DbThreadPool
+from .event_log import EventLogger
+from .crawl_state import CrawlState
+from . import connection as mongo_connection
+from .connection import LazyCollection
+from . import extraction
+from . import normalisation
+from twisted.internet import defer
+import os
+import threading
+from pymongo import UpdateOne
 
 
 article_collection_name = ARTICLE_COLLECTION_NAME
 log_collection_name = LOG_COLLECTION_NAME
 
-# opens DB-Connection
-client = MongoClient(MONGO_URI)
-db = client[MONGO_DATABASE]
+# DB-Connection of the running crawler, opened by MongoConnectionExtension (or lazily by utils.get_db)
+connection = None
+connection_lazy = False     # opened by get_db, released when a crawler opens or closes its connection
+# worker threads for db-queries, keeps the reactor thread free for downloads
+db_pool = DbThreadPool(MONGO_THREADPOOL_SIZE)
+# buffered log events, flushed in bulk
+event_logger = EventLogger(LazyCollection(lambda: utils.get_db(), log_collection_name), db_pool, LOG_EVENT_BUFFER_SIZE,
+                           LOG_EVENT_FLUSH_INTERVAL, LOG_EVENT_AGGREGATE, LOG_EVENT_FALLBACK_PATH)
+
+# known urls per news site, loaded once per spider by MongoPipeline.open_spider
+url_indexes = {}
+# bloom filter of all saved urls for archive builds, opened by MongoPipeline.open_spider
+seen_filter = None
+seen_filter_users = 0   # spiders of this process using seen_filter (run_all runs several spiders in one process)
+seen_filter_lock = threading.Lock()   # opened and closed in db_pool threads
+# MinHash index of the article texts of all news sites, opened by NearDuplicatePipeline.open_spider
+near_duplicate_index = None
+near_duplicate_index_users = 0
+near_duplicate_index_lock = threading.Lock()   # opened and closed in db_pool threads
+# url hashes of the near-duplicates that were not saved (NEAR_DUPLICATE_DROP), not crawled again
+dropped_near_duplicates = set()
 
 # TODO: pylint: add self as first argument of all functions and check usages
 class utils(object):
 
     # db
+    @staticmethod
+    def open_connection(settings):
+        '''
+        Open the connection of a crawler, shared with the other crawlers of the process
+
+        Parameters
+        ----------
+        settings:
+            crawler settings with MONGO_URI and MONGO_DATABASE
+
+        Returns
+        -------
+        MongoConnection, the client is created on first use
+        '''
+        global connection
+        crawler_connection = mongo_connection.acquire(settings.get('MONGO_URI', MONGO_URI),
+                                                      settings.get('MONGO_DATABASE', MONGO_DATABASE))
+        utils.release_lazy_connection()
+        connection = crawler_connection
+        return connection
+
+    @staticmethod
+    def close_connection(crawler_connection):
+        global connection
+        if crawler_connection is connection and connection_lazy:
+            utils.release_lazy_connection()
+            return
+        # released under the lock of the connections, another crawler may still use it
+        if mongo_connection.release(crawler_connection) and crawler_connection is connection:
+            connection = None
+        utils.release_lazy_connection()
+
+    @staticmethod
+    def release_lazy_connection():
+        global connection, connection_lazy
+        if connection_lazy:
+            connection_lazy = False
+            mongo_connection.release(connection)
+            connection = None
+
+    @staticmethod
+    def get_db():
+        # database of the current connection, scripts without a crawler connect with the project settings
+        global connection, connection_lazy
+        if connection is None:
+            connection = mongo_connection.acquire(MONGO_URI, MONGO_DATABASE)
+            connection_lazy = True
+        return connection.db
+
     @staticmethod
     def is_url_in_db(url):
-        url_db = db[article_collection_name].find_one({"short_url": url}, {"short_url": 1})
+        if seen_filter is not None and url not in seen_filter:
+            return False   # definitely not saved, no db-query needed
+        url_db = utils.get_db()[article_collection_name].find_one({"short_url": url}, {"short_url": 1})
         return url_db is not None
 
+    @staticmethod
+    def get_news_site(spider):
+        # news_site as saved in the database, e.g. 'sz' for the sueddeutsche spider
+        return getattr(spider, 'name_short', spider.name)
+
+    @staticmethod
+    def get_crawl_state(spider):
+        # crawl progress of all news sites, saved in CRAWL_STATE_PATH
+        return CrawlState(spider.settings.get('CRAWL_STATE_PATH', 'crawl_state.json'))
+
+    @staticmethod
+    def get_discovery_since(spider):
+        '''
+        Time since when feed entries are new for a spider in feed discovery mode
+
+        Parameters
+        ----------
+        spider:
+            the running spider
+
+        Returns
+        -------
+        ISO 8601 time of the last finished crawl minus DISCOVERY_OVERLAP_MINUTES, None if there was no finished crawl
+        '''
+        last_crawl = utils.get_crawl_state(spider).last_crawl(utils.get_news_site(spider))
+        if last_crawl is None:
+            return None
+        return (last_crawl - timedelta(minutes=spider.settings.getint('DISCOVERY_OVERLAP_MINUTES', 60))).isoformat()
+
+    @staticmethod
+    def load_url_index(news_site):
+        '''
+        Load all known short_urls of a news site into an in-memory index
+
+        Parameters
+        ----------
+        news_site:
+            news site as saved in the database (taz, sz, heise, postillon, golem)
+
+        Returns
+        -------
+        the loaded UrlIndex
+        '''
+        url_indexes[news_site] = UrlIndex.load(utils.get_db()[article_collection_name], news_site)
+        return url_indexes[news_site]
+
+    @staticmethod
+    def open_seen_filter(path, fp_rate, readonly=False):
+        '''
+        Open the bloom filter of saved urls, rebuild it from the article collection if it does not exist
+
+        Parameters
+        ----------
+        path:
+            filter file, shared by all spider processes
+        fp_rate:
+            false-positive rate used when the filter is rebuilt
+        readonly:
+            open without adding newly saved urls, also after a rebuild
+
+        Returns
+        -------
+        the opened SeenUrlFilter. While other spiders of the process use a filter, that filter is returned
+        (also for another path), it is closed when the last of them closes it.
+        '''
+        global seen_filter, seen_filter_users
+        with seen_filter_lock:
+            if seen_filter is not None and seen_filter_users > 0:
+                # shared with the other spiders of the process, one filter per process
+                if seen_filter.path != path:
+                    logging.warning("Seen url filter %s is used by %d spiders of this process, %s is not opened",
+                                    seen_filter.path, seen_filter_users, path)
+                seen_filter_users += 1
+                return seen_filter
+            if seen_filter is not None:
+                seen_filter.close()
+            if not os.path.exists(path):
+                SeenUrlFilter.rebuild(utils.get_db()[article_collection_name], path, fp_rate).close()
+            seen_filter = SeenUrlFilter(path, readonly=readonly)
+            seen_filter_users = 1
+            return seen_filter
+
+    @staticmethod
+    def close_seen_filter():
+        # closed when the last spider using it is closed
+        global seen_filter, seen_filter_users
+        with seen_filter_lock:
+            seen_filter_users = max(seen_filter_users - 1, 0)
+            if seen_filter is not None and seen_filter_users == 0:
+                seen_filter.close()
+                seen_filter = None
+
+    @staticmethod
+    def open_near_duplicate_index(path, threshold, drop=False):
+        '''
+        Open the near-duplicate index, rebuild it from the article collection if it does not exist
+
+        Parameters
+        ----------
+        path:
+            index file, shared by all spider processes
+        threshold:
+            similarity threshold used when the index is rebuilt
+        drop:
+            near-duplicates are not saved (NEAR_DUPLICATE_DROP): the near-duplicates of the index
+            are filtered out by filter_unseen, so they are not crawled again
+
+        Returns
+        -------
+        NearDuplicateIndex, shared with the other spiders of the process
+        '''
+        global near_duplicate_index, near_duplicate_index_users
+        with near_duplicate_index_lock:
+            if near_duplicate_index is None or near_duplicate_index.path != path:
+                near_duplicate_index_users = 0
+                if os.path.exists(path):
+                    near_duplicate_index = NearDuplicateIndex.open(path)
+                else:
+                    near_duplicate_index = NearDuplicateIndex.rebuild(utils.get_db()[article_collection_name], path,
+                                                                      threshold=threshold)
+            near_duplicate_index_users += 1
+            if drop:
+                dropped_near_duplicates.update(near_duplicate_index.near_duplicate_url_hashes())
+            return near_duplicate_index
+
+    @staticmethod
+    def save_near_duplicate_index():
+        # articles added since the last save are written for the other spider processes (runs in db_pool)
+        with near_duplicate_index_lock:
+            if near_duplicate_index is not None:
+                near_duplicate_index.save()
+
+    @staticmethod
+    def close_near_duplicate_index():
+        # the articles of the process are saved when the last spider using the index is closed
+        global near_duplicate_index, near_duplicate_index_users
+        with near_duplicate_index_lock:
+            near_duplicate_index_users = max(near_duplicate_index_users - 1, 0)
+            if near_duplicate_index is not None and near_duplicate_index_users == 0:
+                near_duplicate_index.save()
+                near_duplicate_index.close()
+                near_duplicate_index = None
+                dropped_near_duplicates.clear()
+
+    @staticmethod
+    def mark_near_duplicate_dropped(url):
+        # a dropped near-duplicate is not in the database, but must not be crawled again
+        dropped_near_duplicates.add(url_hash(url))
+
+    @staticmethod
+    def mark_url_saved(news_site, url):
+        # keep url index and seen filter up to date with the database
+        index = url_indexes.get(news_site)
+        if index is not None:
+            index.add(url)
+        if seen_filter is not None and not seen_filter.readonly:
+            seen_filter.add(url)
+
+    @staticmethod
+    def filter_unseen(urls, news_site):
+        '''
+        Bulk version of is_url_in_db for all article links of a page.
+        Answered from the url index of the news site if it is loaded (URL_INDEX_ENABLED), it is exact;
+        otherwise the seen filter (if opened) leaves out the urls that are definitely not saved and the
+        others are checked with one db-query.
+
+        Parameters
+        ----------
+        urls:
+            list of short_urls
+        news_site:
+            news site of the urls
+
+        Returns
+        -------
+        list of the urls that are not in the database (and no dropped near-duplicates), in their original order
+        '''
+        if dropped_near_duplicates:
+            urls = [url for url in urls if url_hash(url) not in dropped_near_duplicates]
+        index = url_indexes.get(news_site)
+        if index is not None:
+            return index.filter_unseen(urls)
+        # no index loaded: only the urls the seen filter reports as "maybe saved" need to be checked,
+        # with one query for the whole page instead of one per link
+        maybe_known = [url for url in urls if seen_filter is None or url in seen_filter]
+        known = set()
+        if maybe_known:
+            known = set(doc['short_url'] for doc in
+                        utils.get_db()[article_collection_name].find({"short_url": {"$in": maybe_known}}, {"short_url": 1}))
+        return [url for url in urls if url not in known]
+
+    @staticmethod
+    def filter_unseen_async(urls, news_site):
+        '''
+        Non-blocking version of filter_unseen for spider callbacks
+
+        Returns
+        -------
+        Deferred firing with the list of urls that are not in the database.
+        Answered directly from the url index if it is loaded, otherwise the db-query runs in db_pool.
+        '''
+        if news_site in url_indexes:
+            return defer.succeed(utils.filter_unseen(urls, news_site))
+        return db_pool.run(utils.filter_unseen, list(urls), news_site)
+
+    @staticmethod
+    def get_recrawl_candidates(news_sites, since):
+        '''
+        Articles published since a given time, the candidates of the recrawl spider
+
+        Parameters
+        ----------
+        news_sites:
+            news sites as saved in the database
+        since:
+            datetime, earliest published_time
+
+        Returns
+        -------
+        list of dicts with short_url, long_url, news_site, title, description, published_time, crawl_time,
+        updated_time and content_hash. The hash of articles saved before content hashes were introduced
+        is computed from the saved title and text.
+        '''
+        query = {"news_site": {"$in": list(news_sites)}, "published_time": {"$gte": since}}
+        fields = dict((name, 1) for name in ('short_url', 'long_url', 'news_site', 'title', 'description',
+                                             'published_time', 'crawl_time', 'updated_time', 'content_hash'))
+        collection = utils.get_db()[article_collection_name]
+        documents = list(collection.find(dict(query, content_hash={"$exists": True}), fields))
+        # the text is only loaded for articles without a hash
+        for document in collection.find(dict(query, content_hash={"$exists": False}), dict(fields, text=1)):
+            document['content_hash'] = utils.content_hash(document.get('title'), document.pop('text', None))
+            documents.append(document)
+        return documents
+
     # saving log item to log_collection in database
     def log_event(self, news_site, url, property_name, level):
-        print("logging event") # TODO: remove
         log_item = LogItem()
         log_item['news_site'] = news_site           # String: taz, sz, heise, postillon, golem
         log_item['log_time'] = datetime.now()       # datetime
         log_item['url'] = url                       # String 'https://taz.de/!5642421/'
         log_item['property'] = property_name        # String: text, title, keywords, ...
         log_item['level'] = level                   # String: warning, info
-        db[log_collection_name].insert(dict(log_item))
+        event_logger.log(log_item)
+
+    @staticmethod
+    def flush_event_log():
+        # write all buffered log events, returns a deferred
+        return event_logger.close()
 
 
     # url handling
@@ -86,7 +409,8 @@ class utils(object):
     @staticmethod
     def remove_whitespace(string):
         '''
-        Removes multiple whitespace and unnecessary whitespace before punctuation marks.
+        Removes multiple whitespace and unnecessary whitespace before punctuation marks,
+        see normalisation.normalise for all steps.
 
         Parameters
         ----------
@@ -96,61 +420,143 @@ class utils(object):
         Returns
         A cleaned string
         '''
-        return ' '.join(string.split()) \
-        .replace(' ,', ',') \
-        .replace(' .', '.') \
-        .replace(' :', ':') \
-        .replace(' !', '!') \
-        .replace(' ?', '?') \
-        .replace(' ;', ',') \
-        .replace(' %', '%')
+        return normalisation.normalise(string)
+
+
+    @staticmethod
+    def content_hash(title, text):
+        '''
+        Hash of the normalised title and text of an article, used to detect updated articles
+
+        The texts are normalised like the spiders do (normalisation.normalise), then with Unicode NFKC and
+        collapsed whitespace: changes of the markup, of the text extraction or of the normalisation rules
+        that do not change the words do not count as an update.
+        Hashes saved before the normalisation rules changed are recomputed with python -m inews_crawler.utils rehash.
+
+        Returns
+        -------
+        hex string of a 128 bit blake2b hash
+        '''
+        def normalise(string):
+            return ' '.join(unicodedata.normalize('NFKC', normalisation.normalise(string)).split())
+        content = normalise(title) + '\n' + normalise(text)
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+    @staticmethod
+    def recompute_content_hashes(collection, batch_size=1000):
+        '''
+        Recompute the content hashes of all saved articles with the current content_hash,
+        after its normalisation changed (otherwise the recrawl spider sees every affected article as updated)
+
+        Parameters
+        ----------
+        collection:
+            pymongo collection containing the articles
+        batch_size:
+            number of documents fetched and updated per round-trip
+
+        Returns
+        -------
+        number of changed hashes
+        '''
+        changed = 0
+        requests = []
+        for document in collection.find({"content_hash": {"$exists": True}}, {"title": 1, "text": 1, "content_hash": 1},
+                                        batch_size=batch_size):
+            content_hash = utils.content_hash(document.get('title'), document.get('text'))
+            if content_hash != document['content_hash']:
+                requests.append(UpdateOne({"_id": document['_id']}, {"$set": {"content_hash": content_hash}}))
+            if len(requests) >= batch_size:
+                changed += collection.bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if requests:
+            changed += collection.bulk_write(requests, ordered=False).modified_count
+        return changed
+
+    @staticmethod
+    def extract_text(selectors, block_tags=None, accept=None):
+        '''
+        Join the text of block elements (paragraphs, subheadings, ...) of an already parsed page.
+        The text nodes are collected from the lxml tree, the HTML of the blocks is neither serialised nor parsed again.
+
+        Parameters
+        ----------
+        selectors:
+            scrapy selectors of the block elements, e.g. response.xpath('//article/*')
+        block_tags:
+            tag names of the blocks to use, e.g. ('p', 'h3'). None: all
+        accept:
+            optional function(lxml element) -> bool for further filtering of the blocks
+
+        Returns
+        -------
+        the text of all non-empty blocks, separated by blank lines
+        '''
+        paragraphs = []
+        for selector in selectors:
+            element = selector.root
+            if not isinstance(getattr(element, 'tag', None), str):
+                continue  # text nodes, comments
+            if block_tags is not None and element.tag not in block_tags:
+                continue
+            if accept is not None and not accept(element):
+                continue
+            paragraph = ''.join(element.itertext())
+            if paragraph:
+                paragraphs.append(paragraph)
+        return '\n\n'.join(paragraphs).strip()
 
 
     # get_items with css and xpath option + multiple expressions
     # - including logging warnings
     # - avoiding None-objects
+    # - expressions are compiled once (extraction.compile_expression)
+
+    @staticmethod
+    def extract_fields(spec, response, url, news_site):
+        '''
+        Extract all fields of an extraction spec and log the missing ones like get_item_string
+
+        Parameters
+        ----------
+        spec:
+            extraction.Spec of the news site
+        response:
+            scrapy response or selector
+        url:
+            url for the log events
+        news_site:
+            news site for the log events
+
+        Returns
+        -------
+        dict field name -> value
+        '''
+        values, missing = spec.extract(response)
+        for property_name in missing:
+            utils.log_event(utils(), news_site, url, property_name, 'warning')
+            logging.warning("Cannot parse %s: %s", property_name, url)
+        return values
 
     # get simple string of item property
     def get_item_string(self, response, property_name, url, sel, expr_list, news_site):
         for expr in expr_list:
-            if sel=="css":
-                property = response.css(expr).get()
-            elif sel=="xpath":
-                property = response.xpath(expr).get()
-            else:
-                property = ""
-            if property is not None and len(property.strip()) > 0:
-                return property.strip()
+            property = extraction.select(response, extraction.compile_expression(sel, expr))
+            if property and len(property[0].strip()) > 0:
+                return property[0].strip()
         self.log_event(news_site, url, property_name, 'warning')
         logging.warning("Cannot parse %s: %s", property_name, url)
         return ""
 
-    # get list of item property
-    def get_item_list(self, response, property_name, url, sel, expr_list, news_site):
-        for expr in expr_list:
-            if sel=="css":
-                property = response.css(expr).extract()
-            elif sel=="xpath":
-                property = response.xpath(expr).extract()
-            else:
-                property = []
-            if property is not None:
-                return list(set(property))
-        self.log_event(news_site, url, property_name, 'warning')
-        logging.warning("Cannot parse %s: %s", property_name, url)
-        return []
 
-    # get list of item property by splitting string
-    def get_item_list_from_str(self, response, property_name, url, sel, expr_list, split_str, news_site):
-        for expr in expr_list:
-            if sel=="css":
-                property = response.css(expr).get()
-            elif sel=="xpath":
-                property = response.xpath(expr).get()
-            else:
-                property = ""
-            if property is not None:
-                return property.split(split_str)
-        self.log_event(news_site, url, property_name, 'warning')
-        logging.warning("Cannot parse %s: %s", property_name, url)
-        return []
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Maintenance of the article collection')
+    parser.add_argument('command', choices=('rehash',), help='rehash: recompute the content hashes of all articles')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    changed = utils.recompute_content_hashes(utils.get_db()[article_collection_name])
+    logging.info("Recomputed content hashes, %d changed", changed)
+    utils.close_connection(connection)
@@ -1,24 +1,348 @@
 #!/usr/bin/env python3
+'''
+Incremental sync of a MongoDB collection to an Elasticsearch index.
+
+Only documents newer than the high-water mark of the last run are read (one cursor, sorted by
+the watermark field) and indexed with the Elasticsearch bulk helper. The mark is saved in a
+checkpoint file after every acknowledged chunk, so an interrupted run resumes where it stopped.
+The crawler buffers its inserts, so documents do not commit in watermark order: every run re-reads
+the --lag seconds before the mark. Documents rejected by Elasticsearch because of load (429, 5xx)
+are retried, other rejections (e.g. mapping conflicts) are logged and skipped.
+
+    ./connector.py                      # sync new documents
+    ./connector.py --full               # ignore the checkpoint, re-index everything
+    ./connector.py --benchmark 100000   # index synthetic documents into an in-process fake bulk endpoint
+'''
+import argparse
+from collections import deque
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import threading
+import time
+
 import elasticsearch
-import pymongo
-import connector_security as sec
+from elasticsearch import helpers
+from bson import ObjectId
+
+DEFAULT_CHECKPOINT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'connector_checkpoint.json')
+# seconds re-read before the watermark, at least MONGO_FLUSH_INTERVAL of the crawler plus the time
+# an item spends in the pipelines between parse (crawl_time) and insert
+DEFAULT_LAG = 120
+
+
+def load_checkpoint(path, index):
+    '''
+    Read the high-water mark of the last run for an index
+
+    Returns
+    -------
+    the last indexed value of the watermark field, or None if there is no checkpoint
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f).get(index)
+    if checkpoint is None:
+        return None
+    if checkpoint['type'] == 'objectid':
+        return ObjectId(checkpoint['value'])
+    if checkpoint['type'] == 'datetime':
+        return datetime.fromisoformat(checkpoint['value'])
+    return checkpoint['value']
+
+
+def save_checkpoint(path, index, mark):
+    checkpoints = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            checkpoints = json.load(f)
+    if isinstance(mark, ObjectId):
+        checkpoints[index] = {'type': 'objectid', 'value': str(mark)}
+    elif isinstance(mark, datetime):
+        checkpoints[index] = {'type': 'datetime', 'value': mark.isoformat()}
+    else:
+        checkpoints[index] = {'type': 'value', 'value': mark}
+    # write and rename, so an interrupted run never leaves a broken checkpoint
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoints, f)
+    os.replace(tmp_path, path)
+
+
+def overlap_mark(mark, lag):
+    '''
+    Start of the window that is re-read before a watermark
+
+    Documents are not committed in watermark order (the MongoPipeline buffers inserts, crawl_time is
+    set at parse time and ObjectIds of parallel spider processes interleave), so a document with a
+    value below the mark can still appear after it was saved. Re-indexing the window is idempotent,
+    see document_id.
+
+    Parameters
+    ----------
+    mark:
+        ObjectId or datetime of the last indexed document
+    lag:
+        seconds to go back
+
+    Returns
+    -------
+    the mark lag seconds earlier, of the same type
+    '''
+    if not lag:
+        return mark
+    if isinstance(mark, ObjectId):
+        return ObjectId.from_datetime(mark.generation_time - timedelta(seconds=lag))
+    if isinstance(mark, datetime):
+        return mark - timedelta(seconds=lag)
+    raise ValueError("a lag needs an ObjectId or date watermark, got {!r} (use --lag 0)".format(mark))
+
+
+def retriable(info):
+    '''
+    True if a document was rejected because of load (429 or 5xx) and should be sent again
+    '''
+    status = info.get('status', 0)
+    return status == 429 or status >= 500
+
+
+def index_actions(es, actions, stopped=None):
+    '''
+    Blocking bulk index with retries
+
+    Transport errors and documents rejected because of load (429, 5xx) are retried with exponential
+    backoff, other rejections (e.g. mapping conflicts) are logged and skipped, so the caller can
+    advance its checkpoint.
+
+    Parameters
+    ----------
+    es:
+        Elasticsearch client
+    actions:
+        list of bulk index actions
+    stopped:
+        threading.Event, a RuntimeError is raised instead of waiting for the next retry when it is set
+
+    Returns
+    -------
+    number of skipped documents
+    '''
+    skipped = 0
+    backoff = 1
+    while actions:
+        try:
+            indexed, errors = helpers.bulk(es, actions, raise_on_error=False)
+            actions_by_id = dict((action['_id'], action) for action in actions)
+            actions = []
+            for error in errors:
+                info = next(iter(error.values()))
+                if retriable(info):
+                    actions.append(actions_by_id[info['_id']])
+                else:
+                    logging.error("Document %s rejected, skipped: %s", info.get('_id'), info.get('error'))
+                    skipped += 1
+            if not actions:
+                return skipped
+            logging.warning("%d documents rejected by an overloaded cluster, retrying in %ds", len(actions), backoff)
+        except elasticsearch.ElasticsearchException as e:
+            logging.warning("Bulk request failed, retrying in %ds: %s", backoff, e)
+        if stopped is not None and stopped.is_set():
+            raise RuntimeError("stopped before the batch was indexed")
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 60)
+    return skipped
+
+
+def document_id(document):
+    '''
+    Id of a mongo document in the index: the short_url of an article, the same id as used by
+    live_indexer.py and the ElasticsearchPipeline of the crawler, so all three can write to one index.
+    Documents without short_url (log events) keep their mongo _id.
+    '''
+    short_url = document.get('short_url')
+    return short_url if short_url else str(document['_id'])
+
+
+def generate_actions(documents, index, watermark_field, marks):
+    '''
+    Turn mongo documents into bulk index actions, see document_id for the id in the index
+
+    Parameters
+    ----------
+    documents:
+        iterable of mongo documents
+    index:
+        name of the Elasticsearch index
+    watermark_field:
+        field of the high-water mark
+    marks:
+        deque receiving (watermark value, action) of every action, in order
+    '''
+    for document in documents:
+        mark = document[watermark_field]
+        doc_id = document_id(document)
+        document.pop('_id')
+        action = {'_op_type': 'index', '_index': index, '_id': doc_id, '_source': document}
+        marks.append((mark, action))
+        yield action
+
+
+def sync(es, documents, index, watermark_field='_id', chunk_size=500, thread_count=4,
+         checkpoint_path=None):
+    '''
+    Bulk index documents and advance the checkpoint after every chunk
+
+    Documents rejected because of load (429, 5xx) are sent again before the checkpoint passes them,
+    other rejections are logged and skipped (see index_actions).
+
+    Parameters
+    ----------
+    es:
+        Elasticsearch client
+    documents:
+        iterable of mongo documents, sorted by watermark_field
+    index:
+        name of the Elasticsearch index
+    watermark_field:
+        field of the high-water mark, '_id' or e.g. 'crawl_time'
+    chunk_size:
+        number of documents per bulk request
+    thread_count:
+        number of parallel bulk requests
+    checkpoint_path:
+        checkpoint file, None to not save a checkpoint
+
+    Returns
+    -------
+    number of indexed documents
+    '''
+    marks = deque()
+    actions = generate_actions(documents, index, watermark_field, marks)
+    count = 0
+    skipped = 0
+    retry = []
+    # parallel_bulk returns the results in the order of the actions
+    for ok, info in helpers.parallel_bulk(es, actions, thread_count=thread_count, chunk_size=chunk_size,
+                                          raise_on_error=False):
+        mark, action = marks.popleft()
+        count += 1
+        if not ok:
+            info = next(iter(info.values()))
+            if retriable(info):
+                retry.append(action)
+            else:
+                logging.error("Document %s rejected, skipped: %s", info.get('_id'), info.get('error'))
+                skipped += 1
+        if count % chunk_size == 0:
+            if retry:
+                skipped += index_actions(es, retry)
+                retry = []
+            if checkpoint_path:
+                save_checkpoint(checkpoint_path, index, mark)
+    if retry:
+        skipped += index_actions(es, retry)
+    if checkpoint_path and count:
+        save_checkpoint(checkpoint_path, index, mark)
+    if skipped:
+        logging.warning("%d of %d documents were rejected and skipped", skipped, count)
+    return count - skipped
+
+
+def sync_collection(args):
+    import pymongo
+    import connector_security as sec
+
+    es = elasticsearch.Elasticsearch(sec.ELASTICSEARCH_HOST)
+    mongo = pymongo.MongoClient(host=sec.MONGO_URI, tz_aware=True)
+    mongo_coll = mongo[sec.MONGO_DATABASE][sec.MONGO_COLLECTION]
+
+    mark = None if args.full else load_checkpoint(args.checkpoint, sec.ELASTICSEARCH_INDEX)
+    query = {} if mark is None else {args.watermark_field: {'$gt': overlap_mark(mark, args.lag)}}
+    logging.info("Syncing %s where %s", sec.MONGO_COLLECTION, query or 'all documents')
+
+    cursor = mongo_coll.find(query).sort(args.watermark_field, 1).batch_size(args.chunk_size)
+    start = time.perf_counter()
+    count = sync(es, cursor, sec.ELASTICSEARCH_INDEX, args.watermark_field, args.chunk_size, args.threads,
+                 args.checkpoint)
+    elapsed = time.perf_counter() - start
+    logging.info("Indexed %d documents in %.1fs (%.0f docs/s)", count, elapsed, count / max(elapsed, 1e-9))
+    mongo.close()
+
+
+class FakeBulkHandler(BaseHTTPRequestHandler):
+    '''
+    Minimal stand-in for the Elasticsearch bulk endpoint, acknowledges every action
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_json({'version': {'number': '7.17.0', 'build_flavor': 'default'}, 'tagline': 'You Know, for Search'})
+
+    def do_POST(self):
+        lines = self.rfile.read(int(self.headers['Content-Length'])).splitlines()
+        # action and source lines alternate
+        items = [{'index': {'_id': json.loads(line)['index']['_id'], 'status': 201}} for line in lines[0::2]]
+        self.send_json({'took': 1, 'errors': False, 'items': items})
+
+    def log_message(self, *args):
+        pass
+
+
+def benchmark(args):
+    server = None
+    host = args.es_host
+    if host is None:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBulkHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+    text = 'Lorem ipsum dolor sit amet. ' * 150
+    documents = ({'_id': ObjectId(), 'crawl_time': datetime.now(), 'short_url': 'https://taz.de/!{}/'.format(i),
+                  'news_site': 'taz', 'title': 'Title {}'.format(i), 'text': text, 'keywords': ['a', 'b']}
+                 for i in range(args.benchmark))
+
+    es = elasticsearch.Elasticsearch(host)
+    start = time.perf_counter()
+    count = sync(es, documents, 'benchmark', chunk_size=args.chunk_size, thread_count=args.threads)
+    elapsed = time.perf_counter() - start
+    print("{} docs in {:.2f}s: {:.0f} docs/s (chunk size {}, {} threads, {})".format(
+        count, elapsed, count / elapsed, args.chunk_size, args.threads, 'fake bulk endpoint' if server else host))
+    if server is not None:
+        server.shutdown()
 
 
-es = elasticsearch.Elasticsearch(sec.ELASTICSEARCH_HOST)
-mongo = pymongo.MongoClient(host=sec.MONGO_URI, tz_aware=True)
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT, help='checkpoint file')
+    parser.add_argument('--watermark-field', default='_id', help="'_id' or a date field like 'crawl_time'")
+    parser.add_argument('--lag', type=float, default=DEFAULT_LAG,
+                        help='seconds before the checkpoint that are read again, for documents committed late')
+    parser.add_argument('--chunk-size', type=int, default=500, help='documents per bulk request')
+    parser.add_argument('--threads', type=int, default=4, help='parallel bulk requests')
+    parser.add_argument('--full', action='store_true', help='ignore the checkpoint and re-index all documents')
+    parser.add_argument('--benchmark', type=int, metavar='N', help='index N synthetic documents and report docs/s')
+    parser.add_argument('--es-host', help='benchmark against this Elasticsearch instead of the fake endpoint')
+    args = parser.parse_args()
 
-mongo_coll = mongo[sec.MONGO_DATABASE][sec.MONGO_COLLECTION]
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    logging.getLogger('elasticsearch').setLevel(logging.WARNING)   # one line per bulk request otherwise
+    if args.benchmark:
+        benchmark(args)
+    else:
+        sync_collection(args)
 
-def extract_mongo_id(document):
-    return document[u'_id']
 
-for mongo_id in map(extract_mongo_id, mongo_coll.find(dict(), {"_id":1})):
-    already_indexed = es.exists(index= sec.ELASTICSEARCH_INDEX,
-                               id=str(mongo_id))
-    if already_indexed:
-        continue
-    mongo_doc = mongo_coll.find_one({"_id":mongo_id})
-    del mongo_doc[u"_id"]
-    es.create(index=sec.ELASTICSEARCH_INDEX,
-              body=mongo_doc,
-              id=str(mongo_id))
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+'''
+Long-running live indexing of new MongoDB documents into Elasticsearch.
+
+A reader thread tails the collection - with a change stream on replica sets, or by polling
+for documents above the watermark field on a standalone mongod - and puts the documents into
+a bounded queue. The change stream also delivers updated documents (e.g. revisions saved by the
+recrawl spider), polling only finds new documents and re-reads the --lag seconds before the
+watermark, because the crawler does not commit its buffered inserts in watermark order.
+The writer sends them to Elasticsearch in micro-batches (at most --batch-size documents or
+--max-latency seconds) and persists the resume token / watermark after every batch.
+If Elasticsearch is slow the queue fills up and the reader blocks (backpressure), failed batches
+are retried with exponential backoff, see connector.index_actions.
+
+    ./live_indexer.py                          # change stream, falls back to polling
+    ./live_indexer.py --poll --watermark-field crawl_time
+'''
+import argparse
+from datetime import datetime, timezone
+import logging
+import queue
+import threading
+import time
+
+import elasticsearch
+from pymongo.errors import OperationFailure
+
+from connector import (DEFAULT_CHECKPOINT, DEFAULT_LAG, document_id, index_actions, load_checkpoint, overlap_mark,
+                       save_checkpoint)
+
+CHANGE_STREAM_NOT_SUPPORTED = 40573   # error code of watch() on a standalone mongod
+
+
+class Metrics(object):
+    '''
+    Counters for batch sizes and indexing lag, logged every interval seconds
+    '''
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.last_report = time.monotonic()
+        self.reset()
+
+    def reset(self):
+        self.batches = 0
+        self.documents = 0
+        self.max_batch = 0
+        self.lag_sum = 0.0
+        self.max_lag = 0.0
+
+    def add_batch(self, size, lag):
+        self.batches += 1
+        self.documents += size
+        self.max_batch = max(self.max_batch, size)
+        self.lag_sum += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def report(self, queue_size):
+        if time.monotonic() - self.last_report < self.interval:
+            return
+        self.last_report = time.monotonic()
+        if self.batches:
+            logging.info("indexed %d docs in %d batches (avg %.1f, max %d), lag avg %.2fs max %.2fs, queue %d",
+                         self.documents, self.batches, self.documents / self.batches, self.max_batch,
+                         self.lag_sum / self.batches, self.max_lag, queue_size)
+        else:
+            logging.info("idle, queue %d", queue_size)
+        self.reset()
+
+
+class LiveIndexer(object):
+
+    def __init__(self, collection, es, index, state_path, watermark_field='_id', batch_size=500, max_latency=2.0,
+                 queue_size=5000, poll_interval=5.0, force_poll=False, metrics_interval=60, overlap=DEFAULT_LAG):
+        self.collection = collection
+        self.es = es
+        self.index = index
+        self.state_path = state_path
+        self.watermark_field = watermark_field
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.poll_interval = poll_interval
+        self.force_poll = force_poll
+        self.overlap = overlap
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.metrics = Metrics(metrics_interval)
+        self.stopped = threading.Event()
+
+    # reader
+
+    def tail(self):
+        '''
+        Put (position, document) tuples into the queue, position is the resume token or the highest watermark value
+        '''
+        try:
+            self.tail_collection()
+        except Exception:
+            logging.exception("Tailing %s failed", self.collection.name)
+
+    def tail_collection(self):
+        if not self.force_poll:
+            try:
+                self.tail_change_stream()
+                return
+            except OperationFailure as e:
+                if e.code != CHANGE_STREAM_NOT_SUPPORTED:
+                    raise
+                logging.warning("Change streams are not supported by this mongod, polling %s instead",
+                                self.watermark_field)
+        self.tail_polling()
+
+    def tail_change_stream(self):
+        token = load_checkpoint(self.state_path, 'changestream:' + self.index)
+        # updates and replacements carry the whole document after the change, articles are re-indexed under their id
+        pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace']}}}]
+        with self.collection.watch(pipeline, resume_after=token, full_document='updateLookup',
+                                   max_await_time_ms=1000) as stream:
+            logging.info("Tailing change stream of %s", self.collection.name)
+            while not self.stopped.is_set():
+                change = stream.try_next()
+                if change is None:
+                    continue
+                if change['fullDocument'] is None:
+                    # updated document that was deleted before the lookup
+                    continue
+                self.put(('changestream', change['_id']), change['fullDocument'], change['clusterTime'].as_datetime())
+
+    def tail_polling(self):
+        mark = load_checkpoint(self.state_path, 'poll:' + self.index)
+        logging.info("Polling %s for %s > %s - %ss", self.collection.name, self.watermark_field, mark, self.overlap)
+        # _id -> watermark value of the documents put within the lag window, which is read again on every poll
+        recent = {}
+        while not self.stopped.is_set():
+            query = {} if mark is None else {self.watermark_field: {'$gt': overlap_mark(mark, self.overlap)}}
+            found = False
+            for document in self.collection.find(query).sort(self.watermark_field, 1).batch_size(self.batch_size):
+                if document['_id'] in recent:
+                    continue
+                value = document[self.watermark_field]
+                recent[document['_id']] = value
+                if mark is None or value > mark:
+                    mark = value
+                self.put(('poll', mark), document)
+                found = True
+                if self.stopped.is_set():
+                    return
+                if len(recent) >= 10 * self.batch_size:
+                    recent = self.prune(recent, mark)
+            if mark is not None:
+                recent = self.prune(recent, mark)
+            if not found:
+                self.stopped.wait(self.poll_interval)
+
+    def prune(self, recent, mark):
+        # documents before the lag window are not read again
+        start = overlap_mark(mark, self.overlap)
+        return dict((key, value) for key, value in recent.items() if value > start)
+
+    def put(self, position, document, changed=None):
+        # blocks while the queue is full, i.e. while Elasticsearch is behind
+        while not self.stopped.is_set():
+            try:
+                self.queue.put((position, document, time.time(), changed), timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    # writer
+
+    def next_batch(self):
+        batch = []
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def index_batch(self, batch):
+        actions = [{'_op_type': 'index', '_index': self.index, '_id': document_id(document),
+                    '_source': dict((key, value) for key, value in document.items() if key != '_id')}
+                   for position, document, received, changed in batch]
+        index_actions(self.es, actions, self.stopped)
+
+    def lag(self, batch):
+        # seconds between the change of the oldest document (for inserts the creation time of its ObjectId) and now
+        position, oldest, received, changed = batch[0]
+        if changed is not None:
+            return (datetime.now(timezone.utc) - changed).total_seconds()
+        if hasattr(oldest['_id'], 'generation_time'):
+            return (datetime.now(timezone.utc) - oldest['_id'].generation_time).total_seconds()
+        return time.time() - received
+
+    def run(self):
+        reader = threading.Thread(target=self.tail, name='tail', daemon=True)
+        reader.start()
+        try:
+            while reader.is_alive() or not self.queue.empty():
+                batch = self.next_batch()
+                if batch:
+                    self.index_batch(batch)
+                    kind, position = batch[-1][0]
+                    save_checkpoint(self.state_path, kind + ':' + self.index, position)
+                    self.metrics.add_batch(len(batch), self.lag(batch))
+                self.metrics.report(self.queue.qsize())
+        finally:
+            self.stopped.set()
+            reader.join(5)
+
+
+def main():
+    import pymongo
+    import connector_security as sec
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--state', default=DEFAULT_CHECKPOINT, help='file for resume token and watermark')
+    parser.add_argument('--poll', action='store_true', help='poll instead of using a change stream')
+    parser.add_argument('--watermark-field', default='_id', help="polling field, '_id' or e.g. 'crawl_time'")
+    parser.add_argument('--lag', type=float, default=DEFAULT_LAG,
+                        help='polling: seconds before the watermark that are read again, for documents committed late')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help='seconds between polls')
+    parser.add_argument('--batch-size', type=int, default=500, help='maximum documents per bulk request')
+    parser.add_argument('--max-latency', type=float, default=2.0, help='maximum seconds to fill a batch')
+    parser.add_argument('--queue-size', type=int, default=5000, help='documents buffered before the reader blocks')
+    parser.add_argument('--metrics-interval', type=float, default=60, help='seconds between metric log lines')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    logging.getLogger('elasticsearch').setLevel(logging.WARNING)
+
+    es = elasticsearch.Elasticsearch(sec.ELASTICSEARCH_HOST)
+    mongo = pymongo.MongoClient(host=sec.MONGO_URI, tz_aware=True)
+    indexer = LiveIndexer(mongo[sec.MONGO_DATABASE][sec.MONGO_COLLECTION], es, sec.ELASTICSEARCH_INDEX, args.state,
+                          args.watermark_field, args.batch_size, args.max_latency, args.queue_size,
+                          args.poll_interval, args.poll, args.metrics_interval, args.lag)
+    try:
+        indexer.run()
+    except KeyboardInterrupt:
+        logging.info("Stopped")
+    finally:
+        mongo.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Replay of the stored pages of benchmarks/fixtures through the spiders, without network and database
+import importlib
+import json
+import os
+
+import pytest
+from scrapy.settings import Settings
+
+from benchmarks.spider_benchmark import FIXTURES, LIMIT_SETTINGS, NullCollection, NullConnection, load_pages
+from inews_crawler import utils as utils_module
+from inews_crawler.event_log import EventLogger
+from inews_crawler.url_index import UrlIndex
+
+
+def load_corpus():
+    with open(os.path.join(FIXTURES, 'corpus.json')) as f:
+        return json.load(f)
+
+
+@pytest.fixture
+def stub_database(monkeypatch):
+    '''
+    Empty url indexes for all news sites (every link is new), log events are discarded
+
+    Returns
+    -------
+    function(news_site, urls) adding urls to the url index of a news site, i.e. marking them as crawled
+    '''
+    monkeypatch.setattr(utils_module, 'connection', NullConnection())
+    monkeypatch.setattr(utils_module, 'event_logger', EventLogger(NullCollection(), flush_interval=0))
+    monkeypatch.setattr(utils_module, 'url_indexes', {})
+    for name in load_corpus():
+        utils_module.url_indexes[name] = UrlIndex(name)
+
+    def add_seen(news_site, urls):
+        for url in urls:
+            utils_module.url_indexes[news_site].add(url)
+    return add_seen
+
+
+def load_spider_class(path):
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+@pytest.fixture
+def load_spider(monkeypatch, tmp_path, stub_database):
+    '''
+    Returns
+    -------
+    function(news site key of corpus.json) -> spider, with the testrun limits of its module set to zero
+    '''
+    def load(name):
+        spider_class = load_spider_class(load_corpus()[name]['spider'])
+        module = importlib.import_module(spider_class.__module__)
+        for setting in LIMIT_SETTINGS:
+            if hasattr(module, setting):
+                monkeypatch.setattr(module, setting, 0)
+        spider = spider_class()
+        spider.settings = Settings({'CRAWL_STATE_PATH': str(tmp_path / (spider.name + '.json'))})
+        return spider
+    return load
+
+
+@pytest.fixture
+def corpus_page():
+    '''
+    Returns
+    -------
+    function(news site key, callback, fixture=None) -> page of corpus.json with its response
+    '''
+    def page(name, callback, fixture=None):
+        for page in load_corpus()[name]['pages']:
+            if page['callback'] == callback and fixture in (None, page['fixture']):
+                return load_pages([page])[0]
+        raise KeyError((name, callback, fixture))
+    return page
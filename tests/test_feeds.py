@@ -0,0 +1,112 @@
+# Feed discovery mode: saved RSS/Atom feeds of benchmarks/fixtures read by inews_crawler.feeds and the spiders
+from datetime import datetime, timezone
+
+import pytest
+
+from benchmarks.spider_benchmark import replay
+from inews_crawler import feeds
+from inews_crawler.utils import utils
+
+FEED_SITES = ['heise', 'taz', 'sz', 'golem']
+
+SITEMAP = b'''<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:news="http://www.google.com/schemas/sitemap-news/0.9">
+<url><loc>https://taz.de/Eins/!5000001/?utm_source=sitemap</loc><lastmod>2021-01-06T10:00:00+01:00</lastmod></url>
+<url><loc>https://taz.de/Zwei/!5000002/</loc>
+<news:news><news:publication_date>2021-01-04T08:00:00Z</news:publication_date><news:title>Zwei</news:title></news:news></url>
+<url><loc>https://taz.de/Drei/!5000003/</loc></url>
+</urlset>'''
+
+
+def article_requests(spider, output):
+    return [request for request in output if request.callback == spider.parse_article]
+
+
+def test_parse_time_formats():
+    assert feeds.parse_time('2021-01-06T10:00:00+01:00') == datetime(2021, 1, 6, 9, 0, tzinfo=timezone.utc)
+    assert feeds.parse_time('2021-01-06T09:00:00Z') == datetime(2021, 1, 6, 9, 0, tzinfo=timezone.utc)
+    assert feeds.parse_time('Wed, 06 Jan 2021 10:00:00 +0100') == datetime(2021, 1, 6, 9, 0, tzinfo=timezone.utc)
+    assert feeds.parse_time('2021-01-06') == datetime(2021, 1, 6, tzinfo=timezone.utc)
+    assert feeds.parse_time('gestern') is None
+    assert feeds.parse_time(None) is None
+
+
+def test_parse_sitemap():
+    entries = feeds.parse_feed(SITEMAP)
+    assert [entry.url for entry in entries] == ['https://taz.de/Eins/!5000001/', 'https://taz.de/Zwei/!5000002/',
+                                                'https://taz.de/Drei/!5000003/']
+    assert entries[0].updated == datetime(2021, 1, 6, 9, 0, tzinfo=timezone.utc)
+    assert entries[1].updated == datetime(2021, 1, 4, 8, 0, tzinfo=timezone.utc)
+    assert entries[1].title == 'Zwei'
+    assert entries[2].updated is None
+
+
+def test_entries_since_keeps_entries_without_time():
+    entries = feeds.parse_feed(SITEMAP)
+    assert feeds.entries_since(entries, None) == entries
+    assert [entry.url for entry in feeds.entries_since(entries, '2021-01-05T00:00:00+00:00')] == \
+        ['https://taz.de/Eins/!5000001/', 'https://taz.de/Drei/!5000003/']
+
+
+@pytest.mark.parametrize('name', FEED_SITES)
+def test_saved_feed_entries(name, corpus_page):
+    entries = feeds.parse_feed(corpus_page(name, 'parse_feed')['response'].body)
+    assert entries
+    for entry in entries:
+        assert entry.url.startswith('https://')
+        assert '?' not in entry.url and '#' not in entry.url
+        assert entry.updated is not None and entry.updated.tzinfo is not None
+        assert entry.description is None or '<' not in entry.description
+
+
+@pytest.mark.parametrize('name', FEED_SITES)
+def test_feed_since_last_crawl(name, load_spider, corpus_page):
+    spider = load_spider(name)
+    page = corpus_page(name, 'parse_feed')
+    entries = feeds.parse_feed(page['response'].body)
+    times = sorted(entry.updated for entry in entries)
+
+    everything = article_requests(spider, replay(spider, dict(page, cb_kwargs={'since': None})))
+    since = times[len(times) // 2]
+    newer = article_requests(spider, replay(spider, dict(page, cb_kwargs={'since': since.isoformat()})))
+    nothing = article_requests(spider, replay(spider, dict(page, cb_kwargs={'since': times[-1].isoformat()})))
+
+    assert everything
+    assert 0 < len(newer) < len(everything)
+    assert set(request.url for request in newer) <= set(request.url for request in everything)
+    assert nothing == []
+
+
+@pytest.mark.parametrize('name', FEED_SITES)
+def test_feed_skips_crawled_articles(name, load_spider, corpus_page, stub_database):
+    spider = load_spider(name)
+    page = dict(corpus_page(name, 'parse_feed'), cb_kwargs={'since': None})
+    first = article_requests(spider, replay(spider, page))
+    news_site = utils.get_news_site(spider)
+    short_urls = [request.cb_kwargs.get('short_url') or spider.generate_short_url(request.url) for request in first]
+    stub_database(news_site, short_urls[:5])
+    again = article_requests(spider, replay(spider, page))
+    assert [request.url for request in again] == [request.url for request in first[5:]]
+
+
+@pytest.mark.parametrize('name', FEED_SITES)
+def test_discovery_switch(name, load_spider):
+    spider = load_spider(name)
+    spider.discovery = 'feed'
+    requests = list(spider.start_requests())
+    assert [request.callback for request in requests] == [spider.parse_feed]
+    # no finished crawl yet: all entries of the feed
+    assert requests[0].cb_kwargs['since'] is None
+
+    spider.discovery = 'category' if name != 'golem' else 'archive'
+    assert spider.parse_feed not in [request.callback for request in spider.start_requests()]
+
+
+def test_feed_since_last_finished_crawl(load_spider):
+    spider = load_spider('taz')
+    spider.discovery = 'feed'
+    utils.get_crawl_state(spider).set_last_crawl(utils.get_news_site(spider),
+                                                 datetime(2021, 1, 6, 12, 0, tzinfo=timezone.utc))
+    request = next(iter(spider.start_requests()))
+    # minus DISCOVERY_OVERLAP_MINUTES (60)
+    assert feeds.parse_time(request.cb_kwargs['since']) == datetime(2021, 1, 6, 11, 0, tzinfo=timezone.utc)
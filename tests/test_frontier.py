@@ -0,0 +1,224 @@
+# Lease, acknowledgement and expiry of the shared SQLite frontier (inews_crawler.frontier)
+import pytest
+from scrapy import Request, Spider
+from scrapy.utils.test import get_crawler
+
+from inews_crawler import frontier
+
+
+class Clock(object):
+    # replaces time.time() in the frontier, so leases expire without waiting
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(frontier.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'frontier.sqlite')
+
+
+@pytest.fixture
+def queue(path):
+    queue = frontier.SqliteFrontier(path, 'test')
+    yield queue
+    queue.close()
+
+
+class FrontierSpider(Spider):
+    name = 'frontier_test'
+
+    def parse(self, response):
+        pass
+
+    def parse_failed(self, failure):
+        return 'spider errback'
+
+
+def open_scheduler(path):
+    crawler = get_crawler(FrontierSpider, {'FRONTIER_URL': 'sqlite:///' + path, 'FRONTIER_LEASE_SECONDS': 60})
+    spider = FrontierSpider.from_crawler(crawler)
+    crawler.stats.open_spider(spider)
+    scheduler = frontier.DistributedScheduler.from_crawler(crawler)
+    scheduler.open(spider)
+    return scheduler
+
+
+class Failure(object):
+    # the part of twisted's Failure used by the errback
+
+    def __init__(self, request):
+        self.request = request
+
+
+def test_push_filters_fingerprints(queue):
+    assert queue.push(b'a', 0, 'fp-a')
+    assert not queue.push(b'a again', 0, 'fp-a')
+    assert queue.push(b'unfiltered', 0)
+    assert queue.push(b'unfiltered', 0)
+    assert queue.waiting() == 3
+
+
+def test_pop_by_priority_then_order(queue, clock):
+    queue.push(b'low', 0, 'low')
+    queue.push(b'high', 10, 'high')
+    queue.push(b'low 2', 0, 'low 2')
+    assert [queue.pop(60)[1] for _ in range(3)] == [b'high', b'low', b'low 2']
+    assert queue.pop(60) is None
+
+
+def test_leased_request_is_not_given_out_again(queue, clock):
+    queue.push(b'a', 0, 'a')
+    request_id, data = queue.pop(60)
+    assert queue.waiting() == 0
+    assert queue.leased() == 1
+    assert queue.pop(60) is None
+
+
+def test_ack_removes_request(queue, clock):
+    queue.push(b'a', 0, 'a')
+    request_id, data = queue.pop(60)
+    queue.ack(request_id)
+    assert queue.waiting() == 0
+    assert queue.leased() == 0
+    clock.now += 3600
+    assert queue.pop(60) is None
+
+
+def test_expired_lease_comes_back(queue, clock):
+    queue.push(b'a', 0, 'a')
+    request_id, data = queue.pop(60)
+    clock.now += 30
+    assert queue.pop(60) is None
+    clock.now += 31
+    assert queue.waiting() == 1
+    assert queue.pop(60) == (request_id, b'a')
+
+
+def test_request_leased_too_often_is_removed(path, clock):
+    queue = frontier.SqliteFrontier(path, 'test', max_leases=2)
+    queue.push(b'a', 0, 'a')
+    for _ in range(2):
+        assert queue.pop(60) is not None
+        clock.now += 61
+    assert queue.pop(60) is None
+    assert queue.waiting() == 0
+    queue.close()
+
+
+def test_fingerprints_cleared_only_when_drained(queue, clock):
+    queue.push(b'a', 0, 'a')
+    request_id, data = queue.pop(60)
+    assert not queue.clear_fingerprints_if_drained()
+    assert not queue.push(b'a', 0, 'a')
+    queue.ack(request_id)
+    assert queue.clear_fingerprints_if_drained()
+    assert queue.push(b'a', 0, 'a')
+
+
+def test_queues_are_separate(path):
+    first = frontier.SqliteFrontier(path, 'first')
+    second = frontier.SqliteFrontier(path, 'second')
+    first.push(b'a', 0, 'a')
+    assert second.push(b'a', 0, 'a')
+    first.clear()
+    assert first.waiting() == 0
+    assert second.waiting() == 1
+    first.close()
+    second.close()
+
+
+def test_two_frontiers_share_one_file(path, clock):
+    first = frontier.SqliteFrontier(path, 'test')
+    second = frontier.SqliteFrontier(path, 'test')
+    assert first.push(b'a', 0, 'a')
+    assert not second.push(b'a', 0, 'a')
+    assert second.push(b'b', 0, 'b')
+    leased = [first.pop(60), second.pop(60)]
+    assert sorted(data for request_id, data in leased) == [b'a', b'b']
+    assert first.pop(60) is None and second.pop(60) is None
+    # the second worker dies, its request goes to the first one when the lease expired
+    first.ack(leased[0][0])
+    clock.now += 61
+    assert first.pop(60) == leased[1]
+    first.close()
+    second.close()
+
+
+def test_open_frontier_urls(path):
+    queue = frontier.open_frontier('sqlite:///' + path, 'test')
+    assert isinstance(queue, frontier.SqliteFrontier)
+    assert queue.path == path
+    queue.close()
+    with pytest.raises(frontier.NotConfigured):
+        frontier.open_frontier('mysql://localhost/frontier', 'test')
+
+
+def test_schedulers_share_requests_and_fingerprints(path):
+    first = open_scheduler(path)
+    second = open_scheduler(path)
+    assert first.enqueue_request(Request('https://taz.de/'))
+    assert not second.enqueue_request(Request('https://taz.de/'))
+    assert second.has_pending_requests()
+
+    request = second.next_request()
+    assert request.url == 'https://taz.de/'
+    assert first.next_request() is None
+    assert not first.has_pending_requests()
+
+    second.request_done(request, second.spider)
+    assert first.frontier.leased() == 0
+    first.spider_idle(first.spider)
+    # drained: the fingerprints are removed and the next run starts again
+    assert first.enqueue_request(Request('https://taz.de/'))
+    first.close('finished')
+    second.close('finished')
+
+
+def test_scheduler_waits_for_leased_requests(path):
+    first = open_scheduler(path)
+    second = open_scheduler(path)
+    first.enqueue_request(Request('https://taz.de/'))
+    request = second.next_request()
+    with pytest.raises(frontier.DontCloseSpider):
+        first.spider_idle(first.spider)
+    second.request_done(request, second.spider)
+    first.spider_idle(first.spider)
+    first.close('finished')
+    second.close('finished')
+
+
+def test_failed_request_is_acknowledged_and_spider_errback_called(path):
+    scheduler = open_scheduler(path)
+    scheduler.enqueue_request(Request('https://taz.de/', errback=scheduler.spider.parse_failed))
+    request = scheduler.next_request()
+    assert request.errback == scheduler.request_failed
+    assert scheduler.request_failed(Failure(request)) == 'spider errback'
+    assert scheduler.frontier.leased() == 0
+    assert scheduler.frontier.waiting() == 0
+    assert scheduler.stats.get_value('frontier/failed') == 1
+    scheduler.close('finished')
+
+
+def test_retried_copy_replaces_leased_request(path):
+    scheduler = open_scheduler(path)
+    scheduler.enqueue_request(Request('https://taz.de/', errback=scheduler.spider.parse_failed))
+    request = scheduler.next_request()
+    retry = request.replace(dont_filter=True)
+    assert scheduler.enqueue_request(retry)
+    assert scheduler.frontier.leased() == 0
+    assert scheduler.frontier.waiting() == 1
+    again = scheduler.next_request()
+    assert again.url == 'https://taz.de/'
+    assert again.meta['frontier_errback'] == 'parse_failed'
+    scheduler.close('finished')
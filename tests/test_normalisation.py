@@ -0,0 +1,63 @@
+# Rules of inews_crawler.normalisation, checked against a table of inputs and expected outputs
+import pytest
+
+from inews_crawler.normalisation import normalise, normalise_batch
+from inews_crawler.utils import utils
+
+# (input, expected output of normalise)
+CASES = [
+    ('', ''),
+    ('   ', ''),
+    ('Die  Bundesregierung\n\nhat\tbeschlossen', 'Die Bundesregierung hat beschlossen'),
+    ('  am Anfang und am Ende  ', 'am Anfang und am Ende'),
+    ('erstens , zweitens . drittens : viertens ! fünftens ? sechstens ; 50 %',
+     'erstens, zweitens. drittens: viertens! fünftens? sechstens; 50%'),
+    ('Satz  .  Noch einer  ,', 'Satz. Noch einer,'),
+    ('geschützter\xa0Abstand und schmales\u202fLeerzeichen', 'geschützter Abstand und schmales Leerzeichen'),
+    ('Silben\u00adtren\u00adnung', 'Silbentrennung'),
+    ('null\u200bbreit \u200b und\ufeff ohne\u2060 Verbinder', 'nullbreit und ohne Verbinder'),
+    ('Mu\u0308nchen und Straße', 'München und Straße'),
+    ('Er sagte: „Das bleibt.“', 'Er sagte: „Das bleibt.“'),
+    ('Er sagte: “Das wird deutsch.”', 'Er sagte: „Das wird deutsch.“'),
+    ('(“in Klammern”) und ”falsch”', '(„in Klammern“) und „falsch“'),
+    ('‟Hoch‟ und ‛einfach‘', '„Hoch„ und ‚einfach‘'),
+    ('gibt´s \uff02breit\uff02', 'gibt’s "breit"'),
+    ('»Guillemets« bleiben', '»Guillemets« bleiben'),
+]
+
+# (input list, expected output of normalise_batch)
+BATCH_CASES = [
+    ([], []),
+    ([''], ['']),
+    (['Absatz  eins .', ' zwei ! ', None, '   ', ', drei'], ['Absatz eins.', 'zwei!', '', '', ', drei']),
+    (['Ende  ', ' .', '“Anfang”'], ['Ende', '.', '„Anfang“']),
+    (['mit \x00 Trenner', 'ohne'], ['mit \x00 Trenner', 'ohne']),
+]
+
+
+@pytest.mark.parametrize('text,expected', CASES)
+def test_normalise(text, expected):
+    assert normalise(text) == expected
+
+
+@pytest.mark.parametrize('texts,expected', BATCH_CASES)
+def test_normalise_batch(texts, expected):
+    assert normalise_batch(texts) == expected
+
+
+@pytest.mark.parametrize('texts', [texts for texts, expected in BATCH_CASES] + [[text for text, expected in CASES]])
+def test_normalise_batch_like_normalise_per_text(texts):
+    assert normalise_batch(texts) == [normalise(text or '') for text in texts]
+
+
+def test_remove_whitespace_keeps_semicolon():
+    # the previous chained replaces mapped ' ;' to ','
+    assert utils.remove_whitespace('eins ; zwei') == 'eins; zwei'
+
+
+def test_content_hash_ignores_normalised_differences():
+    title = 'Streit um neues Gesetz'
+    assert utils.content_hash(title, 'Er sagte: “Das bleibt.”  Ende .') == \
+        utils.content_hash(title, 'Er sagte: „Das bleibt.“ Ende.')
+    assert utils.content_hash(title, 'Silben\u00adtren\u00adnung') == utils.content_hash(title, 'Silbentrennung')
+    assert utils.content_hash(title, 'Das bleibt.') != utils.content_hash(title, 'Das ändert sich.')
@@ -0,0 +1,148 @@
+# Stored pages of benchmarks/fixtures replayed through the spider callbacks, checked against corpus.json
+import json
+import locale
+from datetime import datetime
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import scrapy
+from scrapy.http import HtmlResponse
+
+from benchmarks.spider_benchmark import replay
+from inews_crawler.spiders import postillon_spider
+from tests.conftest import load_corpus
+
+
+def check(output, expect):
+    '''
+    Compare the output of a callback with the "expect" entry of the corpus
+
+    Returns
+    -------
+    list of error messages, empty if the output matches
+    '''
+    requests = [obj for obj in output if isinstance(obj, scrapy.Request)]
+    items = [obj for obj in output if not isinstance(obj, scrapy.Request)]
+    errors = []
+    if 'requests' in expect and len(requests) != expect['requests']:
+        errors.append('{} requests, expected {}'.format(len(requests), expect['requests']))
+    if 'items' in expect and len(items) != expect['items']:
+        errors.append('{} items, expected {}'.format(len(items), expect['items']))
+    for item in items:
+        if 'title' in expect and item.get('title') != expect['title']:
+            errors.append('title {!r}, expected {!r}'.format(item.get('title'), expect['title']))
+        for field in expect.get('fields', []):
+            if not item.get(field):
+                errors.append('empty {}'.format(field))
+    return errors
+
+
+def german_locale():
+    # golem parses its dates with the German month names
+    current = locale.setlocale(locale.LC_ALL)
+    try:
+        locale.setlocale(locale.LC_ALL, 'de_DE.utf8')
+    except locale.Error:
+        return False
+    locale.setlocale(locale.LC_ALL, current)
+    return True
+
+
+CORPUS_PAGES = [pytest.param(name, page, id='{}-{}-{}'.format(name, page['callback'], page['fixture']))
+                for name, definition in load_corpus().items() for page in definition['pages']]
+
+
+@pytest.mark.parametrize('name,page', CORPUS_PAGES)
+def test_corpus_page(name, page, load_spider, corpus_page):
+    if name == 'golem' and page['callback'] == 'parse_article' and not german_locale():
+        pytest.skip('locale de_DE.utf8 is not installed')
+    spider = load_spider(name)
+    page = corpus_page(name, page['callback'], page['fixture'])
+    assert check(replay(spider, page), page.get('expect', {})) == []
+
+
+# postillon: Blogger feed instead of the archive widget
+
+def test_postillon_months_of_year_from_month(monkeypatch):
+    monkeypatch.setattr(postillon_spider, 'YEAR_TO_CRAWL', 2020)
+    monkeypatch.setattr(postillon_spider, 'LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL', 11)
+    months = postillon_spider.PostillonSpider.get_months_to_crawl(now=datetime(2021, 3, 1))
+    assert months == [('2020-11-01T00:00:00', '2020-12-01T00:00:00'), ('2020-12-01T00:00:00', '2021-01-01T00:00:00')]
+
+
+def test_postillon_months_of_whole_year(monkeypatch):
+    monkeypatch.setattr(postillon_spider, 'YEAR_TO_CRAWL', 2020)
+    monkeypatch.setattr(postillon_spider, 'LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL', 0)
+    months = postillon_spider.PostillonSpider.get_months_to_crawl(now=datetime(2021, 3, 1))
+    assert len(months) == 12
+    assert months[0][0] == '2020-01-01T00:00:00' and months[-1][1] == '2021-01-01T00:00:00'
+
+
+def test_postillon_months_not_in_the_future(monkeypatch):
+    monkeypatch.setattr(postillon_spider, 'YEAR_TO_CRAWL', 2021)
+    monkeypatch.setattr(postillon_spider, 'LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL', 0)
+    months = postillon_spider.PostillonSpider.get_months_to_crawl(now=datetime(2021, 3, 15))
+    assert [begin for begin, end in months] == ['2021-01-01T00:00:00', '2021-02-01T00:00:00', '2021-03-01T00:00:00']
+
+
+def test_postillon_months_of_all_years(monkeypatch):
+    monkeypatch.setattr(postillon_spider, 'YEAR_TO_CRAWL', 0)
+    monkeypatch.setattr(postillon_spider, 'LIMIT_MIN_MONTH_OF_YEAR_TO_CRAWL', 5)
+    months = postillon_spider.PostillonSpider.get_months_to_crawl(now=datetime(2021, 3, 15))
+    # the month limit only applies to YEAR_TO_CRAWL
+    assert months[0][0] == '{}-01-01T00:00:00'.format(postillon_spider.FIRST_ARCHIVE_YEAR)
+    assert months[-1][0] == '2021-03-01T00:00:00'
+
+
+def test_postillon_feed_requests_articles_and_next_page(load_spider, corpus_page):
+    spider = load_spider('postillon')
+    page = corpus_page('postillon', 'parse_feed')
+    output = replay(spider, page)
+    feed = json.loads(page['response'].text)['feed']
+
+    next_pages = [request for request in output if request.callback == spider.parse_feed]
+    articles = [request for request in output if request.callback == spider.parse_article]
+    assert len(articles) == len(feed['entry'])
+    assert len(next_pages) == 1
+    query = parse_qs(urlparse(next_pages[0].url).query)
+    assert query['start-index'] == [str(1 + len(feed['entry']))]
+    assert query['published-min'] == [page['cb_kwargs']['published_min']]
+    assert query['published-max'] == [page['cb_kwargs']['published_max']]
+    assert query['alt'] == ['json']
+    for request in articles:
+        assert request.cb_kwargs['long_url'] == request.url
+        assert datetime.strptime(request.cb_kwargs['published_time'], '%d.%m.%Y')
+
+
+def test_postillon_feed_skips_crawled_articles(load_spider, corpus_page, stub_database):
+    spider = load_spider('postillon')
+    page = corpus_page('postillon', 'parse_feed')
+    articles = [request.url for request in replay(spider, page) if request.callback == spider.parse_article]
+    stub_database('postillon', articles[:10])
+    again = [request.url for request in replay(spider, page) if request.callback == spider.parse_article]
+    assert again == articles[10:]
+
+
+def test_postillon_last_feed_page_has_no_next_page(load_spider, corpus_page):
+    spider = load_spider('postillon')
+    page = corpus_page('postillon', 'parse_feed')
+    feed = json.loads(page['response'].text)['feed']
+    # the fixture is the last page when it starts at the total minus its entries
+    start_index = int(feed['openSearch$totalResults']['$t']) - len(feed['entry']) + 1
+    page['cb_kwargs'] = dict(page['cb_kwargs'], start_index=start_index)
+    output = replay(spider, page)
+    assert not [request for request in output if request.callback == spider.parse_feed]
+
+
+def test_postillon_archive_skips_crawled_articles(load_spider, stub_database):
+    # archive_mode 'selenium': the page rendered and expanded by the browser pool
+    spider = load_spider('postillon')
+    body = ''.join('<li><a href="https://www.der-postillon.com/2021/01/artikel-{0}.html">Artikel {0}'
+                   '<div class="date">0{0}.01.2021</div></a></li>'.format(i) for i in range(1, 6))
+    page = {'callback': 'parse', 'response': HtmlResponse(url=postillon_spider.root, encoding='utf-8',
+                                                          body='<ul class="month-inner">{}</ul>'.format(body))}
+    stub_database('postillon', ['https://www.der-postillon.com/2021/01/artikel-2.html'])
+    output = replay(spider, page)
+    assert [request.url for request in output] == ['https://www.der-postillon.com/2021/01/artikel-{}.html'.format(i)
+                                                   for i in (1, 3, 4, 5)]
+    assert output[0].cb_kwargs == {'long_url': output[0].url, 'published_time': '01.01.2021'}